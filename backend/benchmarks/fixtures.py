@@ -0,0 +1,304 @@
+import asyncio
+from contextlib import contextmanager
+from csv import reader as csv_reader, writer as csv_writer
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from os import makedirs, path
+from random import Random
+from re import compile as compile_regex, Pattern
+from threading import Thread
+from time import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from backend.scripts.fetch_info import dict_to_json, fetch_bazaar_data, json_to_dict
+from backend.scripts.fetch_product_price_history import COFLNET_URL, fetch_product_histories
+from backend.scripts.price_history import DAY, HOUR, parse_timestamp
+
+# The fixtures and baselines depend on the machine and on when they were recorded, so they are kept out of the
+# repository, in this ignored directory
+CACHE_DIRECTORY: str = path.join(path.dirname(path.abspath(__file__)), 'cache')
+FIXTURE_DIRECTORY: str = path.join(CACHE_DIRECTORY, 'fixtures')
+BAZAAR_FIXTURE: str = 'bazaar.json'
+HISTORY_FIXTURE: str = 'coflnet_history.json'
+
+# The paths the replay server answers, matching the Hypixel and Coflnet endpoints
+BAZAAR_PATH: str = '/v2/skyblock/bazaar'
+HISTORY_PATH: Pattern = compile_regex(r'^/api/bazaar/([^/]+)/history/week$')
+
+# A CSV cell, e.g. "2x Grove (C1)"
+CELL_PATTERN: Pattern = compile_regex(r'^(\d+x )(.+?)(\s*\(.*\))?$')
+
+
+def copy_name(name: str, copy: int) -> str:
+    """
+    Function to name the copy of a shard in a scaled data set. The first copy is the shard itself.
+
+    :param name: The name of the shard.
+    :param copy: The copy number, from 0.
+    :return: The name of the copy.
+    """
+    return name if copy == 0 else f'{name} #{copy + 1}'
+
+
+def copy_product_id(product_id: str, copy: int) -> str:
+    """
+    Function to give the copy of a shard in a scaled data set its product ID. The first copy is the shard itself.
+
+    :param product_id: The product ID of the shard.
+    :param copy: The copy number, from 0.
+    :return: The product ID of the copy.
+    """
+    return product_id if copy == 0 else f'{product_id}_{copy + 1}'
+
+
+def scale_recipes(source: str, target: str, scale: int) -> int:
+    """
+    Function to write a fusion list `scale` times larger than the given one.
+
+    Each extra copy of the list has every shard renamed with `copy_name`, so the copies never deduplicate against each
+    other and a scaled list has exactly `scale` times the recipes of the original, with the same shape.
+
+    :param source: The fusion list CSV.
+    :param target: The path of the scaled CSV.
+    :param scale: How many copies of the list to write.
+    :return: The number of fusion rows written.
+    """
+    with open(source, newline='') as f:
+        rows: List[List[str]] = list(csv_reader(f))
+
+    # The credits and the column names come before the fusions
+    preamble, fusions = rows[:2], rows[2:]
+
+    def rename(cell: str, copy: int) -> str:
+        match = CELL_PATTERN.match(cell)
+        if copy == 0 or not match:
+            return cell
+        return f'{match.group(1)}{copy_name(match.group(2), copy)}{match.group(3) or ""}'
+
+    with open(target, 'w', newline='') as f:
+        writer = csv_writer(f)
+        writer.writerows(preamble)
+        for copy in range(scale):
+            writer.writerows([rename(cell, copy) for cell in fusion] for fusion in fusions)
+
+    return len(fusions) * scale
+
+
+def scale_shards(shards_data: Dict, scale: int) -> Dict:
+    """
+    Function to add the shard copies of a scaled data set to the cleaned shards data.
+
+    :param shards_data: The cleaned shards data, as loaded from `shards_cleaned.json`.
+    :param scale: How many copies of every shard to keep.
+    :return: The shards data of the scaled data set.
+    """
+    shards: Dict[str, Dict] = {}
+    for copy in range(scale):
+        for name, info in shards_data['shards'].items():
+            shards[copy_name(name, copy)] = {
+                **info,
+                'name': copy_name(info['name'], copy),
+                'productID': copy_product_id(info['productID'], copy) if info.get('productID') else None,
+                'id': copy_product_id(info['id'], copy) if info.get('id') else None
+            }
+    return {**shards_data, 'shards': shards}
+
+
+def scale_bazaar(payload: Dict, product_ids: List[str], scale: int) -> Dict:
+    """
+    Function to add the shard copies of a scaled data set to a Bazaar payload, each priced like its original.
+
+    :param payload: The Bazaar payload.
+    :param product_ids: The product IDs of the shards to copy.
+    :param scale: How many copies of every shard to list.
+    :return: The Bazaar payload of the scaled data set.
+    """
+    products: Dict[str, Dict] = dict(payload['products'])
+    for copy in range(1, scale):
+        for product_id in product_ids:
+            if product_id not in payload['products']:
+                continue
+            product: Dict = payload['products'][product_id]
+            products[copy_product_id(product_id, copy)] = {
+                **product,
+                'product_id': copy_product_id(product_id, copy),
+                'quick_status': {**product['quick_status'], 'productId': copy_product_id(product_id, copy)}
+            }
+    return {**payload, 'products': products}
+
+
+def synthesize_fixtures(shards_data: Dict, seed: int = 0, levels: int = 10) -> Tuple[Dict, Dict[str, List[Dict]]]:
+    """
+    Function to generate a Bazaar payload and Coflnet week histories for every shard, shaped like the real ones.
+    The same seed always gives the same fixtures.
+
+    :param shards_data: The cleaned shards data, as loaded from `shards_cleaned.json`.
+    :param seed: The seed of the random prices.
+    :param levels: The number of price levels on each side of the order books.
+    :return: The Bazaar payload and the history entries by product ID.
+    """
+    generator: Random = Random(seed)
+    start: int = int(datetime(2025, 8, 1, tzinfo=timezone.utc).timestamp())
+    products: Dict[str, Dict] = {}
+    histories: Dict[str, List[Dict]] = {}
+
+    for info in shards_data['shards'].values():
+        product_id: Optional[str] = info.get('productID')
+        if not product_id:
+            continue
+
+        price: float = 10 ** generator.uniform(2, 6)
+        # A few shards have no buy orders, like on the real Bazaar
+        buy_orders: int = 0 if generator.random() < 0.05 else levels
+        buy_summary: List[Dict] = [{'amount': generator.randint(1, 500), 'orders': generator.randint(1, 10),
+                                    'pricePerUnit': round(price * (1 + 0.01 * i), 1)} for i in range(levels)]
+        sell_summary: List[Dict] = [{'amount': generator.randint(1, 500), 'orders': generator.randint(1, 10),
+                                     'pricePerUnit': round(price * (0.9 - 0.01 * i), 1)} for i in range(buy_orders)]
+        products[product_id] = {
+            'product_id': product_id,
+            'sell_summary': sell_summary,
+            'buy_summary': buy_summary,
+            'quick_status': {
+                'productId': product_id,
+                'sellPrice': sell_summary[0]['pricePerUnit'] if sell_summary else 0.0,
+                'sellVolume': sum(level['amount'] for level in sell_summary),
+                'sellMovingWeek': generator.randint(0, 100000),
+                'sellOrders': levels,
+                'buyPrice': buy_summary[0]['pricePerUnit'],
+                'buyVolume': sum(level['amount'] for level in buy_summary),
+                'buyMovingWeek': generator.randint(0, 100000),
+                'buyOrders': buy_orders
+            }
+        }
+
+        entries: List[Dict] = []
+        for hour in range(7 * DAY // HOUR):
+            price *= generator.uniform(0.97, 1.03)
+            missing: bool = generator.random() < 0.01
+            entries.append({
+                'buy': None if missing else round(price, 1),
+                'sell': round(price * 0.9, 1),
+                'timestamp': datetime.fromtimestamp(start + hour * HOUR, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+            })
+        histories[product_id] = entries
+
+    return {'success': True, 'lastUpdated': start * 1000, 'products': products}, histories
+
+
+def record_fixtures(shards_data: Dict, directory: str = FIXTURE_DIRECTORY, base_url: str = COFLNET_URL) -> None:
+    """
+    Function to record the live Bazaar payload and the Coflnet week history of every shard as fixtures.
+
+    :param shards_data: The cleaned shards data, as loaded from `shards_cleaned.json`.
+    :param directory: The directory the fixtures are written to.
+    :param base_url: The base URL of the Coflnet API.
+    :return: None
+    """
+    payload, _ = fetch_bazaar_data()
+    if payload is None:
+        raise RuntimeError('The Bazaar payload could not be fetched')
+
+    product_ids: List[str] = [info['productID'] for info in shards_data['shards'].values() if info.get('productID')]
+    histories, failures = asyncio.run(fetch_product_histories(product_ids, base_url))
+    for product_id, error in failures.items():
+        print(f'Error fetching data for product {product_id}: {error}')
+
+    makedirs(directory, exist_ok=True)
+    dict_to_json(payload, path.join(directory, BAZAAR_FIXTURE))
+    dict_to_json(histories, path.join(directory, HISTORY_FIXTURE))
+
+
+def load_fixtures(shards_data: Dict, directory: str = FIXTURE_DIRECTORY) -> Tuple[Dict, Dict[str, List[Dict]]]:
+    """
+    Function to load the recorded fixtures. If none were recorded, synthetic ones are generated and saved first, so
+    every later run replays the same data.
+
+    :param shards_data: The cleaned shards data, as loaded from `shards_cleaned.json`.
+    :param directory: The directory holding the fixtures.
+    :return: The Bazaar payload and the history entries by product ID.
+    """
+    bazaar_path: str = path.join(directory, BAZAAR_FIXTURE)
+    history_path: str = path.join(directory, HISTORY_FIXTURE)
+
+    if not path.exists(bazaar_path) or not path.exists(history_path):
+        payload, histories = synthesize_fixtures(shards_data)
+        makedirs(directory, exist_ok=True)
+        dict_to_json(payload, bazaar_path)
+        dict_to_json(histories, history_path)
+        return payload, histories
+
+    return json_to_dict(bazaar_path), json_to_dict(history_path)
+
+
+def shift_histories(histories: Dict[str, List[Dict]], now: Optional[int] = None) -> Dict[str, bytes]:
+    """
+    Function to move recorded histories forward in time, by whole hours, so their newest entry is recent. The
+    retention of the price history is relative to the current time, so replaying the histories at their recorded
+    times would store less and less of them as the fixtures age.
+
+    :param histories: The history entries by product ID.
+    :param now: The current epoch timestamp, in seconds. Defaults to the current time.
+    :return: The shifted entries of each product, encoded as the API response.
+    """
+    if now is None:
+        now = int(time())
+
+    newest: int = max((parse_timestamp(entry['timestamp']) for entries in histories.values() for entry in entries),
+                      default=now)
+    shift: int = (now - newest) // HOUR * HOUR
+
+    return {
+        product_id: dumps([
+            {**entry, 'timestamp': datetime.fromtimestamp(parse_timestamp(entry['timestamp']) + shift, timezone.utc)
+             .strftime('%Y-%m-%dT%H:%M:%S')}
+            for entry in entries
+        ]).encode()
+        for product_id, entries in histories.items()
+    }
+
+
+@contextmanager
+def serve_fixtures(payload: Dict, histories: Dict[str, List[Dict]], originals: Optional[Dict[str, str]] = None) -> \
+        Iterator[str]:
+    """
+    Context manager replaying the fixtures over HTTP on a local port, in place of the Bazaar and Coflnet APIs.
+
+    :param payload: The Bazaar payload.
+    :param histories: The history entries by product ID.
+    :param originals: The product ID of the original of every shard copy, whose history the copy is served.
+    :return: The base URL of the server.
+    """
+    bazaar_body: bytes = dumps(payload).encode()
+    history_bodies: Dict[str, bytes] = shift_histories(histories)
+    originals = originals or {}
+
+    class ReplayHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self) -> None:
+            match = HISTORY_PATH.match(self.path)
+            if self.path.split('?')[0] == BAZAAR_PATH:
+                body: Optional[bytes] = bazaar_body
+            elif match:
+                product_id: str = match.group(1)
+                body = history_bodies.get(originals.get(product_id, product_id))
+            else:
+                body = None
+
+            self.send_response(200 if body is not None else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body or b'')))
+            self.end_headers()
+            self.wfile.write(body or b'')
+
+        def log_message(self, *args) -> None:
+            pass
+
+    server: ThreadingHTTPServer = ThreadingHTTPServer(('127.0.0.1', 0), ReplayHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        server.server_close()
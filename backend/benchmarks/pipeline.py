@@ -0,0 +1,297 @@
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, redirect_stdout
+from io import StringIO
+from json import dump as json_dump
+from multiprocessing import get_context
+from os import chdir, cpu_count, makedirs, path
+from platform import platform, python_version
+from resource import getrusage, RUSAGE_SELF
+from sqlite3 import connect, Connection, sqlite_version
+from sys import exit as sys_exit
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from polars import __version__ as polars_version
+
+from backend.benchmarks.fixtures import BAZAAR_PATH, CACHE_DIRECTORY, FIXTURE_DIRECTORY, copy_product_id, \
+    load_fixtures, record_fixtures, scale_bazaar, scale_recipes, scale_shards, serve_fixtures
+from backend.scripts.acquisition_costs import store_acquisition_costs
+from backend.scripts.build_database import fetch_and_process_information, store_data_in_database
+from backend.scripts.calculate_profits import calculate_accurate_profit
+from backend.scripts.fetch_info import get_bazaar_information, json_to_dict
+from backend.scripts.fetch_product_price_history import get_product_data
+from backend.scripts.order_book import store_fill_simulation
+
+DATA_DIRECTORY: str = path.join(path.dirname(path.dirname(path.dirname(path.abspath(__file__)))), 'data')
+BASELINE_PATH: str = path.join(CACHE_DIRECTORY, 'baseline.json')
+DATABASE_PATH: str = 'shard_recipes.db'
+
+# What a stage measurement holds
+StageResult = Dict[str, float or int]
+
+# Increases smaller than these are timing and allocator noise, never regressions
+NOISE_FLOOR: Dict[str, float] = {'seconds': 0.05, 'peak_rss_mib': 5.0}
+
+
+def count_rows(query: str) -> int:
+    """
+    Function to count rows in the benchmark database.
+
+    :param query: A query returning a single count.
+    :return: The count.
+    """
+    with closing(connect(DATABASE_PATH)) as db_connection:
+        return db_connection.execute(query).fetchone()[0]
+
+
+def parse_stage(inputs: Dict[str, str]) -> Tuple[float, int]:
+    """
+    Parse the fusion list CSV.
+
+    :param inputs: The paths and URLs of the benchmark inputs.
+    :return: The wall time of the stage, in seconds, and the number of recipes parsed.
+    """
+    start: float = perf_counter()
+    rows = fetch_and_process_information(inputs['csv'])
+    return perf_counter() - start, rows.height
+
+
+def store_stage(inputs: Dict[str, str]) -> Tuple[float, int]:
+    """
+    Store the parsed recipes and the shards in a new database. The CSV is parsed again first, outside the timing.
+
+    :param inputs: The paths and URLs of the benchmark inputs.
+    :return: The wall time of the stage, in seconds, and the number of recipes stored.
+    """
+    rows = fetch_and_process_information(inputs['csv'])
+    shards_data: Dict = json_to_dict(inputs['shards'])
+
+    start: float = perf_counter()
+    store_data_in_database(rows, shards_data)
+    return perf_counter() - start, rows.height
+
+
+def bazaar_stage(inputs: Dict[str, str]) -> Tuple[float, int]:
+    """
+    Fetch the replayed Bazaar payload and store it, with its order books.
+
+    :param inputs: The paths and URLs of the benchmark inputs.
+    :return: The wall time of the stage, in seconds, and the number of products stored.
+    """
+    with closing(connect(DATABASE_PATH)) as db_connection:
+        start: float = perf_counter()
+        get_bazaar_information(db_connection, url=inputs['url'] + BAZAAR_PATH)
+        seconds: float = perf_counter() - start
+
+    return seconds, count_rows('SELECT COUNT(*) FROM bazaar_info')
+
+
+def history_stage(inputs: Dict[str, str]) -> Tuple[float, int]:
+    """
+    Fetch the replayed week history of every shard, store it and update the price analytics. The rate limit is lifted,
+    so the stage measures the processing rather than the wait between requests.
+
+    :param inputs: The paths and URLs of the benchmark inputs.
+    :return: The wall time of the stage, in seconds, and the number of price points stored at every resolution.
+    """
+    with closing(connect(DATABASE_PATH)) as db_connection:
+        start: float = perf_counter()
+        get_product_data(db_connection, base_url=inputs['url'], requests_per_second=10000.0, max_concurrency=16)
+        seconds: float = perf_counter() - start
+
+    return seconds, count_rows('SELECT COUNT(*) FROM price_history_points')
+
+
+def recipe_stage(function: Callable[[Connection], None]) -> Callable[[Dict[str, str]], Tuple[float, int]]:
+    """
+    Function to make a stage out of a step that processes every stored recipe.
+
+    :param function: The step, called with a connection to the benchmark database.
+    :return: The stage, which reports the number of recipes as its rows.
+    """
+
+    def stage(inputs: Dict[str, str]) -> Tuple[float, int]:
+        with closing(connect(DATABASE_PATH)) as db_connection:
+            start: float = perf_counter()
+            function(db_connection)
+            seconds: float = perf_counter() - start
+
+        return seconds, count_rows('SELECT COUNT(*) FROM shard_recipes_processed')
+
+    return stage
+
+
+# The stages of the pipeline, in the order they run. Each one works on the database left by the previous ones
+STAGES: Dict[str, Callable[[Dict[str, str]], Tuple[float, int]]] = {
+    'fetch_and_process_information': parse_stage,
+    'store_data_in_database': store_stage,
+    'get_bazaar_information': bazaar_stage,
+    'get_product_data': history_stage,
+    'store_acquisition_costs': recipe_stage(store_acquisition_costs),
+    'store_fill_simulation': recipe_stage(store_fill_simulation),
+    'calculate_accurate_profit': recipe_stage(calculate_accurate_profit)
+}
+
+
+def measure_stage(stage: str, directory: str, inputs: Dict[str, str]) -> StageResult:
+    """
+    Function to run one stage in the current process and measure it. It is meant to run in a fresh process, so the
+    peak RSS is the one of that stage alone (with the interpreter and its inputs).
+
+    :param stage: The name of the stage, one of `STAGES`.
+    :param directory: The working directory of the benchmark, holding its database.
+    :param inputs: The paths and URLs of the benchmark inputs.
+    :return: The wall time in seconds, the peak RSS in MiB, the number of rows and the rows per second.
+    """
+    chdir(directory)
+    with redirect_stdout(StringIO()):
+        seconds, rows = STAGES[stage](inputs)
+
+    # ru_maxrss is in KiB on Linux
+    return {
+        'seconds': seconds,
+        'peak_rss_mib': getrusage(RUSAGE_SELF).ru_maxrss / 1024,
+        'rows': rows,
+        'rows_per_second': rows / seconds if seconds > 0 else 0.0
+    }
+
+
+def run_pipeline(scale: int, csv_path: str, shards_data: Dict, payload: Dict, histories: Dict[str, List[Dict]]) -> \
+        Dict[str, StageResult]:
+    """
+    Function to run every stage of the pipeline once on a data set `scale` times the size of the fusion list, each
+    stage in its own process, against a new database and the replayed fixtures.
+
+    :param scale: How many copies of the fusion list and the shards to benchmark with (see `fixtures.scale_recipes`).
+    :param csv_path: The fusion list CSV.
+    :param shards_data: The cleaned shards data.
+    :param payload: The Bazaar payload fixture.
+    :param histories: The history fixtures, by product ID.
+    :return: The measurements of every stage, by stage name.
+    """
+    product_ids: List[str] = [info['productID'] for info in shards_data['shards'].values() if info.get('productID')]
+    originals: Dict[str, str] = {copy_product_id(product_id, copy): product_id
+                                 for copy in range(1, scale) for product_id in product_ids}
+
+    with TemporaryDirectory() as directory:
+        inputs: Dict[str, str] = {'csv': path.join(directory, 'fusions.csv'),
+                                  'shards': path.join(directory, 'shards_cleaned.json')}
+        scale_recipes(csv_path, inputs['csv'], scale)
+        with open(inputs['shards'], 'w') as f:
+            json_dump(scale_shards(shards_data, scale), f)
+
+        results: Dict[str, StageResult] = {}
+        with serve_fixtures(scale_bazaar(payload, product_ids, scale), histories, originals) as url:
+            inputs['url'] = url
+            for stage in STAGES:
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                    results[stage] = executor.submit(measure_stage, stage, directory, inputs).result()
+
+    return results
+
+
+def compare_to_baseline(results: Dict[str, Dict[str, StageResult]], baseline: Dict[str, Dict[str, StageResult]],
+                        tolerance: float) -> List[str]:
+    """
+    Function to find the stages that got slower or used more memory than in the baseline.
+
+    :param results: The measurements, by scale and stage.
+    :param baseline: The baseline measurements, by scale and stage.
+    :param tolerance: The allowed relative increase, e.g. 0.25 for 25%. Increases below the `NOISE_FLOOR` are always
+    allowed.
+    :return: A description of every regression (empty if there are none).
+    """
+    regressions: List[str] = []
+    for scale, stages in results.items():
+        for stage, result in stages.items():
+            expected: Optional[StageResult] = baseline.get(scale, {}).get(stage)
+            if expected is None:
+                continue
+
+            for metric, noise in NOISE_FLOOR.items():
+                if result[metric] > expected[metric] * (1 + tolerance) and result[metric] - expected[metric] > noise:
+                    regressions.append(f'{scale}x {stage}: {metric} went from {expected[metric]:.3f} to '
+                                       f'{result[metric]:.3f} ({result[metric] / expected[metric] - 1:+.0%})')
+    return regressions
+
+
+def main() -> None:
+    """
+    Run the benchmarks from the command line.
+
+    :return: None
+    """
+    parser: ArgumentParser = ArgumentParser(description='Benchmark every stage of the backend pipeline.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10], metavar='N',
+                        help='the sizes of the data sets, as multiples of the fusion list (default: 1 10)')
+    parser.add_argument('--repeat', type=int, default=1, metavar='N',
+                        help='run every scale N times and keep the fastest run of each stage (default: 1)')
+    parser.add_argument('--csv', default=path.join(DATA_DIRECTORY, 'Full Fusion List - Hypixel SkyBlock - List.csv'),
+                        help='the fusion list CSV')
+    parser.add_argument('--shards', default=path.join(DATA_DIRECTORY, 'shards_cleaned.json'),
+                        help='the cleaned shards data')
+    parser.add_argument('--fixtures', default=FIXTURE_DIRECTORY, metavar='DIRECTORY',
+                        help='the directory of the recorded Bazaar and Coflnet fixtures (synthetic ones are '
+                             'generated there if it is empty)')
+    parser.add_argument('--record', action='store_true',
+                        help='record the live Bazaar payload and Coflnet histories as the fixtures first')
+    parser.add_argument('--baseline', default=BASELINE_PATH, metavar='FILE',
+                        help='the JSON baseline to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the new baseline instead of comparing against it')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='the relative increase of wall time or peak RSS reported as a regression (default: 0.25)')
+    arguments: Namespace = parser.parse_args()
+
+    shards_data: Dict = json_to_dict(path.abspath(arguments.shards))
+    if arguments.record:
+        record_fixtures(shards_data, arguments.fixtures)
+    payload, histories = load_fixtures(shards_data, arguments.fixtures)
+
+    results: Dict[str, Dict[str, StageResult]] = {}
+    for scale in arguments.scales:
+        for _ in range(arguments.repeat):
+            run: Dict[str, StageResult] = run_pipeline(scale, path.abspath(arguments.csv), shards_data, payload,
+                                                       histories)
+            best: Dict[str, StageResult] = results.setdefault(str(scale), run)
+            for stage, result in run.items():
+                if result['seconds'] < best[stage]['seconds']:
+                    best[stage] = result
+
+        for stage, result in results[str(scale)].items():
+            print(f'{scale:>4}x {stage:<30} {result["seconds"]:9.3f} s {result["peak_rss_mib"]:9.1f} MiB '
+                  f'{result["rows"]:>10} rows {result["rows_per_second"]:>12,.0f} rows/s')
+
+    if arguments.save_baseline:
+        makedirs(path.dirname(path.abspath(arguments.baseline)), exist_ok=True)
+        with open(arguments.baseline, 'w') as f:
+            json_dump({
+                'environment': {
+                    'platform': platform(),
+                    'python': python_version(),
+                    'polars': polars_version,
+                    'sqlite': sqlite_version,
+                    'cpus': cpu_count()
+                },
+                'results': results
+            }, f, indent=4)
+        print(f'Baseline saved to {arguments.baseline}')
+        return
+
+    if not path.exists(arguments.baseline):
+        print(f'No baseline at {arguments.baseline}, run with --save-baseline to create one')
+        return
+
+    regressions: List[str] = compare_to_baseline(results, json_to_dict(arguments.baseline)['results'],
+                                                 arguments.tolerance)
+    for regression in regressions:
+        print(f'Regression: {regression}')
+    if regressions:
+        sys_exit(1)
+    print('No regressions against the baseline')
+
+
+if __name__ == '__main__':
+    main()
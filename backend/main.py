@@ -1,17 +1,151 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, Namespace
 from sqlite3 import connect as sqlite_connect, Connection
+from typing import List, Optional, Set, TYPE_CHECKING
+
+from backend.scripts.build_database import build_recipe_database
+from backend.scripts.metrics import store_metrics, write_exposition
+from backend.scripts.recipe_snapshot import RecipeSnapshot, read_snapshot, snapshot_path
+
+if TYPE_CHECKING:
+    from polars import DataFrame
+
+    from backend.scripts.recipe_store import RecipeStore
+    from backend.scripts.scenarios import Scenario
 
-from backend.scripts.build_database import fetch_and_process_information, store_data_in_database
-from backend.scripts.calculate_profits import calculate_accurate_profit
-from backend.scripts.fetch_info import get_bazaar_information, json_to_dict
+parser: ArgumentParser = ArgumentParser(description='Refresh the bazaar information and the shard fusion profits.')
+parser.add_argument('--incremental', action='store_true',
+                    help='only recompute the profits of recipes whose bazaar prices changed since the last run')
+parser.add_argument('--keep-snapshots', type=int, default=0, metavar='N',
+                    help='keep the last N bazaar snapshots in the bazaar_snapshots table')
+parser.add_argument('--acquisition-costs', action='store_true',
+                    help='price ingredients at the cheaper of buying and fusing them instead of their buy price')
+parser.add_argument('--fill-simulation', action='store_true',
+                    help='also simulate batches of every recipe against the order books into shard_fill_simulation')
+parser.add_argument('--poll', action='store_true',
+                    help='keep running and refresh the bazaar information and profits every --interval seconds '
+                         '(--arbitrage and --top are rerun after every poll, --scenarios, --chains and --plan are '
+                         'not supported)')
+parser.add_argument('--interval', type=float, default=60.0, metavar='SECONDS',
+                    help='the polling interval used with --poll (default: 60)')
+parser.add_argument('--scenarios', metavar='FILE',
+                    help='also evaluate the profit scenarios listed in this JSON file into shard_profit_scenarios')
+parser.add_argument('--chains', type=int, metavar='DEPTH',
+                    help='also list the most profitable chains of at most DEPTH fusions, buying or fusing ingredients')
+parser.add_argument('--arbitrage', action='store_true',
+                    help='also list the loops of fusions that end with more value than they started with')
+parser.add_argument('--plan', type=float, metavar='COINS',
+                    help='also plan the most profitable fusions to run with this many coins')
+parser.add_argument('--held', metavar='FILE',
+                    help='with --plan, a JSON file of the shards already held, by product ID (used before buying)')
+parser.add_argument('--top', type=int, default=0, metavar='K',
+                    help='also print the K most profitable recipes (with --poll, after every new bazaar payload)')
+parser.add_argument('--metrics-file', metavar='FILE',
+                    help='also write the stage timings and counters of the run to FILE in the Prometheus text format '
+                         '(with --poll, rewritten after every poll)')
+arguments: Namespace = parser.parse_args()
 
-rows = fetch_and_process_information()
+# The poller only refreshes the profits, the arbitrage loops and the top recipes after every poll
+if arguments.poll:
+    for flag, value in (('--scenarios', arguments.scenarios), ('--chains', arguments.chains),
+                        ('--plan', arguments.plan), ('--held', arguments.held)):
+        if value is not None:
+            parser.error(f'{flag} cannot be used with --poll')
 
-shards_cleaned_data: dict = json_to_dict("shards_cleaned.json")
-store_data_in_database(rows, shards_cleaned_data)
+# The scenarios are read before anything runs, so a missing or malformed file fails fast
+scenarios: Optional[List[Scenario]] = None
+if arguments.scenarios:
+    from backend.scripts.scenarios import read_scenarios
+
+    try:
+        scenarios = read_scenarios(arguments.scenarios)
+    except ValueError as e:
+        parser.error(str(e))
+
+# Skipped when neither the fusion list nor the shards data changed since the last build
+changed_recipes: Optional[int] = build_recipe_database()
 
 sqlite_connection: Connection = sqlite_connect('shard_recipes.db')
 
-bazaar_data = get_bazaar_information(sqlite_connection)
+# The recipes and shard metadata are mapped from the snapshot written by the build, and shared by every stage below.
+# The stages only import Polars and the HTTP client once they run, so a refresh does not pay for what it skips.
+snapshot: Optional[RecipeSnapshot] = read_snapshot(sqlite_connection, snapshot_path('shard_recipes.db'))
+store: Optional[RecipeStore] = snapshot.store if snapshot else None
+products: Optional[DataFrame] = snapshot.products_frame() if snapshot else None
+
+if arguments.poll:
+    from backend.scripts.poller import BazaarPoller
+
+    BazaarPoller(sqlite_connection, arguments.interval, keep_snapshots=arguments.keep_snapshots, store=store,
+                 products=products, detect_arbitrage=arguments.arbitrage,
+                 use_acquisition_costs=arguments.acquisition_costs,
+                 simulate_fills=arguments.fill_simulation, top=arguments.top,
+                 metrics_file=arguments.metrics_file).run()
+else:
+    from backend.scripts.calculate_profits import calculate_accurate_profit, update_profit_data
+    from backend.scripts.fetch_info import get_bazaar_information
+
+    changed_product_ids: Set[str] = get_bazaar_information(sqlite_connection,
+                                                             keep_snapshots=arguments.keep_snapshots)
+
+    if arguments.acquisition_costs:
+        from backend.scripts.acquisition_costs import store_acquisition_costs
+
+        # Ingredients priced at their acquisition cost also move when a shard upstream of them does
+        changed_product_ids |= store_acquisition_costs(sqlite_connection, store=store, products=products)
+
+    if arguments.fill_simulation:
+        from backend.scripts.order_book import store_fill_simulation
+
+        store_fill_simulation(sqlite_connection, store=store)
+
+    # Profits of added or changed recipes are missing from the last run, so they need a full recomputation
+    if arguments.incremental and not changed_recipes:
+        updated: int = update_profit_data(sqlite_connection, changed_product_ids,
+                                          use_acquisition_costs=arguments.acquisition_costs, store=store,
+                                          products=products)
+        print(f'{len(changed_product_ids)} bazaar products changed, {updated} recipes recomputed')
+    else:
+        calculate_accurate_profit(sqlite_connection, use_acquisition_costs=arguments.acquisition_costs, store=store,
+                                  products=products)
+
+    if scenarios is not None:
+        from backend.scripts.scenarios import store_scenario_profits
+
+        store_scenario_profits(sqlite_connection, scenarios, store=store)
+
+    if arguments.chains is not None:
+        from backend.scripts.fusion_chains import calculate_chain_profits, describe_chain
+
+        for chain in calculate_chain_profits(sqlite_connection, arguments.chains, store=store):
+            print(f"{chain['profit']:,} coins in {chain['depth']} fusions: {describe_chain(chain['chain'])}")
+
+    if arguments.arbitrage:
+        from backend.scripts.arbitrage import find_arbitrage_loops
+
+        for loop in find_arbitrage_loops(sqlite_connection, store=store).profitable_loops():
+            print(f"{' -> '.join(loop['shards'] + loop['shards'][:1])}: {loop['gain']:.2%} per loop "
+                  f"({loop['profit']:,} coins)")
+
+    if arguments.plan is not None:
+        from backend.scripts.fetch_info import json_to_dict
+        from backend.scripts.fusion_planner import calculate_fusion_plan
+
+        for step in calculate_fusion_plan(sqlite_connection, arguments.plan,
+                                          json_to_dict(arguments.held) if arguments.held else None, store):
+            print(f"{step['fusions']}x recipe {step['recipe_id']} ({step['output_item']}): {step['cost']:,} coins "
+                  f"for {step['profit']:,} profit")
+
+    if arguments.top > 0:
+        from backend.scripts.profit_cache import ProfitCache, describe_profit
+
+        for row in ProfitCache(sqlite_connection).top_k(arguments.top):
+            print(describe_profit(row))
+
+    # The timings and counters of the run are kept in the pipeline_metrics table (the poller stores them every poll)
+    store_metrics(sqlite_connection)
+    if arguments.metrics_file:
+        write_exposition(arguments.metrics_file)
 
-calculate_accurate_profit(sqlite_connection, bazaar_data)
 sqlite_connection.close()
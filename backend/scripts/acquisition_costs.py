@@ -0,0 +1,159 @@
+from math import inf
+from sqlite3 import Connection, Cursor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from polars import DataFrame, Float64, Int64, Utf8
+
+from backend.scripts.calculate_profits import load_bazaar_frame, load_product_frame
+from backend.scripts.fusion_chains import ProductionCosts, load_buy_prices, relax_production_costs
+from backend.scripts.metrics import instrumented, metrics
+from backend.scripts.recipe_store import RecipeStore
+
+ACQUISITION_SCHEMA = {
+    'product_id': Utf8,
+    'buy_price': Float64,
+    'craft_cost': Float64,
+    'acquisition_cost': Float64,
+    'source': Utf8,
+    'recipe_id': Int64
+}
+
+
+def downstream_products(store: RecipeStore, products: Iterable[int]) -> Set[int]:
+    """
+    Function to find the products that can be fused, directly or through other fusions, from the given ones.
+
+    :param store: The recipes.
+    :param products: The interned products to start from.
+    :return: The given products and every product downstream of them.
+    """
+    reached: Set[int] = set(products)
+    pending: List[int] = list(reached)
+    while pending:
+        product: int = pending.pop()
+        for position in store.by_ingredient[store.by_ingredient_offsets[product]:
+                                            store.by_ingredient_offsets[product + 1]]:
+            if store.output_item[position] not in reached:
+                reached.add(store.output_item[position])
+                pending.append(store.output_item[position])
+    return reached
+
+
+def compute_acquisition_costs(store: RecipeStore, bazaar: DataFrame, products: DataFrame,
+                              skip_empty_orders: bool = True) -> DataFrame:
+    """
+    Function to compute, for every shard, whether it is cheaper to insta-buy it or to fuse it, and at what cost.
+
+    The cheapest cost of every shard is the fixed point of the buy-or-fuse relaxation over the whole recipe graph, so
+    fusing from ingredients that are themselves cheaper to fuse is taken into account. A loop of fusions that ends
+    with more of a shard than it started with has no fixed point: its costs keep dropping until the relaxation gives
+    up. The shards of such loops, and every shard fused from them, are then priced at their buy price only.
+
+    :param store: The recipes.
+    :param bazaar: The bazaar snapshot, as returned by `load_bazaar_frame`.
+    :param products: The shard metadata, as returned by `load_product_frame`.
+    :param skip_empty_orders: If True, products without buy orders cannot be bought.
+    :return: A DataFrame with one row per shard: its buy price, its cheapest fusion cost, the minimum of both, which
+    of them it is ('buy' or 'craft', None if the shard cannot be obtained) and the recipe to fuse it with.
+    """
+    buy_prices: Dict[str, float] = load_buy_prices(bazaar, skip_empty_orders)
+    rounds: List[ProductionCosts] = relax_production_costs(store, buy_prices)
+    costs, _ = rounds[-1]
+
+    # One more pass over the recipes with the settled costs gives the best fusion cost even for shards that are
+    # cheaper to buy, which the relaxation alone does not keep
+    craft_costs: List[float] = [inf] * len(store.product_ids)
+    craft_recipes: List[int] = [-1] * len(store.product_ids)
+    for position in range(len(store)):
+        if store.output_quantity[position] <= 0:
+            continue
+
+        unit_cost: float = (store.quantity_1[position] * costs[store.ingredient_1[position]] +
+                            store.quantity_2[position] * costs[store.ingredient_2[position]]) / \
+            store.output_quantity[position]
+        if unit_cost < craft_costs[store.output_item[position]]:
+            craft_costs[store.output_item[position]] = unit_cost
+            craft_recipes[store.output_item[position]] = position
+
+    # A relaxation that settled cannot get any cheaper, so a fusion beating the relaxed cost means it did not
+    unsettled: Set[int] = downstream_products(store, [product for product, cost in enumerate(costs)
+                                                      if craft_costs[product] < cost])
+    if unsettled:
+        print(f'The acquisition costs of {len(unsettled)} shards did not settle (a loop of fusions gains value), '
+              f'keeping their buy price')
+        metrics.increment('rows_skipped', len(unsettled), stage='store_acquisition_costs', reason='unsettled_cost')
+        for product in unsettled:
+            craft_costs[product], craft_recipes[product] = inf, -1
+
+    rows: List[Tuple[str, Optional[float], Optional[float], Optional[float], Optional[str], Optional[int]]] = []
+    for product_id in products['productID'].to_list():
+        buy_price: Optional[float] = buy_prices.get(product_id)
+        product: Optional[int] = store.product_index.get(product_id)
+
+        craft_cost: Optional[float] = None
+        recipe_id: Optional[int] = None
+        if product is not None and craft_recipes[product] >= 0:
+            craft_cost, recipe_id = craft_costs[product], store.recipe_ids[craft_recipes[product]]
+
+        if craft_cost is not None and (buy_price is None or craft_cost < buy_price):
+            rows.append((product_id, buy_price, craft_cost, craft_cost, 'craft', recipe_id))
+        else:
+            rows.append((product_id, buy_price, craft_cost, buy_price, None if buy_price is None else 'buy',
+                         recipe_id))
+
+    return DataFrame(rows, schema=ACQUISITION_SCHEMA, orient='row')
+
+
+@instrumented('store_acquisition_costs')
+def store_acquisition_costs(db_connection: Connection, skip_empty_orders: bool = True,
+                            store: Optional[RecipeStore] = None, products: Optional[DataFrame] = None) -> Set[str]:
+    """
+    Function to compute the acquisition cost of every shard from the stored recipes and bazaar data, and replace the
+    content of `shard_acquisition_cost` with it.
+    A shard can get cheaper to fuse when any shard upstream of it moves, so the shards whose acquisition cost changed
+    are returned, for the incremental profit update (see `calculate_profits.update_profit_data`).
+
+    :param db_connection: The connection to the SQLite database containing the shard recipes and bazaar data.
+    :param skip_empty_orders: If True, products without buy orders cannot be bought.
+    :param store: The recipes, if they are already loaded. They are read from the database otherwise.
+    :param products: The shard metadata, if it is already loaded. It is read from the database otherwise.
+    :return: The product IDs whose acquisition cost changed since the last call.
+    """
+    if store is None:
+        store = RecipeStore.from_connection(db_connection)
+    if products is None:
+        products = load_product_frame(db_connection)
+
+    acquisition: DataFrame = compute_acquisition_costs(store, load_bazaar_frame(db_connection), products,
+                                                       skip_empty_orders)
+
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS shard_acquisition_cost
+                   (
+                       product_id       TEXT PRIMARY KEY,
+                       buy_price        REAL,
+                       craft_cost       REAL,
+                       acquisition_cost REAL,
+                       source           TEXT,
+                       recipe_id        INTEGER
+                   )
+                   ''')
+
+    cursor.execute('SELECT product_id, acquisition_cost FROM shard_acquisition_cost')
+    previous: Dict[str, Optional[float]] = dict(cursor.fetchall())
+    changed: Set[str] = set()
+    for product_id, cost in acquisition.select('product_id', 'acquisition_cost').iter_rows():
+        if product_id not in previous or previous.pop(product_id) != cost:
+            changed.add(product_id)
+
+    with db_connection:
+        cursor.execute('DELETE FROM shard_acquisition_cost')
+        cursor.executemany('''
+                           INSERT INTO shard_acquisition_cost
+                           (product_id, buy_price, craft_cost, acquisition_cost, source, recipe_id)
+                           VALUES (?, ?, ?, ?, ?, ?)
+                           ''', acquisition.iter_rows())
+
+    # Shards left in `previous` are no longer listed at all
+    return changed | set(previous)
@@ -0,0 +1,252 @@
+from collections import deque
+from math import exp, floor, inf, log, log1p
+from sqlite3 import Connection
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from backend.scripts.calculate_profits import load_bazaar_frame
+from backend.scripts.fusion_chains import load_buy_prices
+from backend.scripts.metrics import instrumented, metrics
+from backend.scripts.recipe_store import RecipeStore
+
+# The weight and the position of the best recipe turning one product into another
+Edge = Tuple[float, int]
+
+# A loop is identified by its products, rotated so the smallest interned product comes first
+Loop = Tuple[int, ...]
+
+
+class FusionArbitrage:
+    """
+    Profitable loops of fusions, kept up to date as the Bazaar prices move.
+
+    Every recipe is an edge from each of its ingredients to its output, weighted by the log of the ratio between the
+    value of its ingredients and the value of its output (at their insta-buy prices). Carrying a shard around a loop
+    multiplies the value held by the product of the ratios, and the prices of the carried shards cancel out, so a loop
+    is profitable exactly when it is a negative cycle. Only the best recipe between two products is kept as an edge.
+
+    A Bellman-Ford pass keeps a potential for every product. When it settles, no edge is cheaper than the difference
+    of the potentials at its ends, which proves there is no negative cycle at all. Otherwise, loops of at most
+    `max_length` fusions are enumerated by a depth-first search over the weights reduced by the potentials (which
+    leave the weight of every loop unchanged), stopping as soon as a path is not negative: every negative cycle has a
+    rotation whose prefixes are all negative, so no loop is missed, and with good potentials almost every path stops
+    at its first edge. `update` only rescores the recipes referencing a product whose price changed (through the
+    reverse indexes of the store), and only relaxes the potentials from the edges that changed.
+    """
+
+    def __init__(self, store: RecipeStore, buy_prices: Dict[str, float], max_length: int = 4,
+                 min_gain: float = 0.001):
+        self.store: RecipeStore = store
+        self.max_length: int = max_length
+        # Loops gaining less than `min_gain` per iteration are ignored, which also keeps rounding noise out
+        self.threshold: float = -log1p(min_gain)
+
+        self.prices: List[float] = [buy_prices.get(product_id, inf) for product_id in store.product_ids]
+
+        self.pair_recipes: Dict[Tuple[int, int], List[int]] = {}
+        for position in range(len(store)):
+            for ingredient in {store.ingredient_1[position], store.ingredient_2[position]}:
+                self.pair_recipes.setdefault((ingredient, store.output_item[position]), []).append(position)
+
+        self.edges: List[Dict[int, Edge]] = [{} for _ in store.product_ids]
+        for (ingredient, output) in self.pair_recipes:
+            edge: Optional[Edge] = self.best_edge(ingredient, output)
+            if edge is not None:
+                self.edges[ingredient][output] = edge
+
+        self.potentials: List[float] = [0.0] * len(store.product_ids)
+        # Whether the potentials settled, i.e. no edge can lower them
+        self.settled: bool = False
+        self.loops: Dict[Loop, float] = self.search() if self.relax(range(len(self.edges))) else {}
+
+    def recipe_weight(self, position: int) -> Optional[float]:
+        """
+        The weight of a recipe: the log of the value of its ingredients over the value of its output.
+
+        :param position: The position of the recipe in the store.
+        :return: The weight, or None if one of its products cannot be bought.
+        """
+        store: RecipeStore = self.store
+        output_value: float = store.output_quantity[position] * self.prices[store.output_item[position]]
+        input_value: float = store.quantity_1[position] * self.prices[store.ingredient_1[position]] + \
+            store.quantity_2[position] * self.prices[store.ingredient_2[position]]
+        if not 0 < output_value < inf or not 0 < input_value < inf:
+            return None
+        return log(input_value) - log(output_value)
+
+    def best_edge(self, ingredient: int, output: int) -> Optional[Edge]:
+        """
+        The best recipe turning an ingredient into an output.
+
+        :param ingredient: The interned ingredient.
+        :param output: The interned output.
+        :return: The weight and position of the recipe with the lowest weight, or None if none can be priced.
+        """
+        best: Optional[Edge] = None
+        for position in self.pair_recipes.get((ingredient, output), ()):
+            weight: Optional[float] = self.recipe_weight(position)
+            if weight is not None and (best is None or weight < best[0]):
+                best = (weight, position)
+        return best
+
+    def relax(self, products: Iterable[int]) -> bool:
+        """
+        Lower the potentials along the edges leaving the given products, and along the edges of every product whose
+        potential was lowered, until no edge can lower one (a queue-based Bellman-Ford).
+
+        :param products: The interned products whose edges changed.
+        :return: True if a negative cycle exists, i.e. some potential was lowered once per product without settling.
+        """
+        self.settled = False
+        potentials: List[float] = self.potentials
+        queue: Deque[int] = deque(products)
+        queued: Set[int] = set(queue)
+        lowered: List[int] = [0] * len(potentials)
+
+        while queue:
+            product: int = queue.popleft()
+            queued.discard(product)
+            for target, (weight, _) in self.edges[product].items():
+                # The tolerance keeps rounding errors from lowering the potentials of a zero-weight loop forever
+                if potentials[product] + weight < potentials[target] - 1e-12:
+                    potentials[target] = potentials[product] + weight
+                    lowered[target] += 1
+                    if lowered[target] > len(potentials):
+                        return True
+                    if target not in queued:
+                        queue.append(target)
+                        queued.add(target)
+
+        self.settled = True
+        return False
+
+    def search(self) -> Dict[Loop, float]:
+        """
+        Find every profitable loop of at most `max_length` fusions.
+
+        :return: The weight of every loop whose weight is below the threshold, by loop.
+        """
+        potentials: List[float] = self.potentials
+        loops: Dict[Loop, float] = {}
+        path: List[int] = []
+
+        def extend(start: int, reduced: float) -> None:
+            product: int = path[-1]
+            for target, (weight, _) in self.edges[product].items():
+                total: float = reduced + weight + potentials[product] - potentials[target]
+                if total >= 0:
+                    continue
+                if target == start:
+                    if total < self.threshold:
+                        first: int = path.index(min(path))
+                        loops[tuple(path[first:] + path[:first])] = total
+                elif target not in path and len(path) < self.max_length:
+                    path.append(target)
+                    extend(start, total)
+                    path.pop()
+
+        for start in range(len(self.edges)):
+            path.append(start)
+            extend(start, 0.0)
+            path.pop()
+
+        return loops
+
+    @instrumented('arbitrage_update')
+    def update(self, buy_prices: Dict[str, float]) -> int:
+        """
+        Bring the loops up to date with new prices.
+
+        :param buy_prices: The price of every buyable product, as returned by `fusion_chains.load_buy_prices`.
+        :return: The number of edges whose weight or recipe changed.
+        """
+        changed_products: List[str] = []
+        for product, product_id in enumerate(self.store.product_ids):
+            price: float = buy_prices.get(product_id, inf)
+            if price != self.prices[product]:
+                self.prices[product] = price
+                changed_products.append(product_id)
+
+        store: RecipeStore = self.store
+        pairs: Set[Tuple[int, int]] = {(ingredient, store.output_item[position])
+                                       for position in store.recipes_referencing(changed_products)
+                                       for ingredient in (store.ingredient_1[position], store.ingredient_2[position])}
+
+        changed: Set[int] = set()
+        for ingredient, output in pairs:
+            previous: Optional[Edge] = self.edges[ingredient].get(output)
+            edge: Optional[Edge] = self.best_edge(ingredient, output)
+            if edge == previous:
+                continue
+
+            changed.add(ingredient)
+            if edge is None:
+                del self.edges[ingredient][output]
+            else:
+                self.edges[ingredient][output] = edge
+
+        metrics.increment('rows_processed', len(pairs), stage='arbitrage_update')
+        if not changed:
+            return 0
+
+        # Potentials only need to go down from the changed edges once they settled, and stay valid (if less tight)
+        # elsewhere. If they did not, the relaxation stopped at a negative cycle and starts again from every product.
+        self.loops = self.search() if self.relax(changed if self.settled else range(len(self.edges))) else {}
+        return len(changed)
+
+    def profitable_loops(self) -> List[Dict[str, str or int or float or List]]:
+        """
+        The current profitable loops, most profitable first.
+
+        :return: For every loop, its gain per iteration (the fraction by which the value of the carried shards grows),
+        the profit of one iteration started with one fusion of its first recipe, the shards it goes through and its
+        fusions.
+        """
+        store: RecipeStore = self.store
+        loops: List[Dict[str, str or int or float or List]] = []
+        for loop, weight in self.loops.items():
+            steps: List[Dict[str, str or int or List]] = []
+            for index, product in enumerate(loop):
+                _, position = self.edges[product][loop[(index + 1) % len(loop)]]
+                steps.append({
+                    'recipe_id': store.recipe_ids[position],
+                    'ingredients': [{'product_id': store.product_ids[ingredient], 'amount': quantity}
+                                    for quantity, ingredient in ((store.quantity_1[position],
+                                                                  store.ingredient_1[position]),
+                                                                 (store.quantity_2[position],
+                                                                  store.ingredient_2[position]))],
+                    'output_item': store.product_ids[store.output_item[position]],
+                    'output_quantity': store.output_quantity[position]
+                })
+
+            first: int = self.edges[loop[0]][loop[1 % len(loop)]][1]
+            input_value: float = store.quantity_1[first] * self.prices[store.ingredient_1[first]] + \
+                store.quantity_2[first] * self.prices[store.ingredient_2[first]]
+            loops.append({
+                'gain': exp(-weight) - 1,
+                'profit': floor(input_value * (exp(-weight) - 1)),
+                'shards': [store.product_ids[product] for product in loop],
+                'steps': steps
+            })
+
+        loops.sort(key=lambda loop: loop['gain'], reverse=True)
+        return loops
+
+
+@instrumented('find_arbitrage_loops')
+def find_arbitrage_loops(db_connection: Connection, max_length: int = 4, min_gain: float = 0.001,
+                         skip_empty_orders: bool = True, store: Optional[RecipeStore] = None) -> FusionArbitrage:
+    """
+    Function to find the profitable fusion loops using the recipes and bazaar data stored in the database.
+
+    :param db_connection: The connection to the SQLite database containing the shard recipes and bazaar data.
+    :param max_length: The maximum number of fusions in a loop.
+    :param min_gain: The minimum gain per iteration of a loop, as a fraction of the value carried around it.
+    :param skip_empty_orders: If True, products without buy orders cannot be bought.
+    :param store: The recipes, if they are already loaded. They are read from the database otherwise.
+    :return: The loops, which can be kept up to date with `FusionArbitrage.update`.
+    """
+    if store is None:
+        store = RecipeStore.from_connection(db_connection)
+
+    return FusionArbitrage(store, load_buy_prices(load_bazaar_frame(db_connection), skip_empty_orders), max_length,
+                           min_gain)
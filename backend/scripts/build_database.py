@@ -1,184 +1,363 @@
 from __future__ import annotations
 
-from re import sub as re_sub
+from hashlib import sha256
 from sqlite3 import connect, Connection, Cursor
-from typing import Dict, Tuple, List, Set
+from time import time
+from typing import Dict, List, Optional, Set, Tuple, TYPE_CHECKING
 
-from polars import read_csv, DataFrame
+from backend.scripts.metrics import instrumented, metrics
+from backend.scripts.recipe_snapshot import read_snapshot_key, snapshot_path, source_key, write_snapshot
+from backend.scripts.schema import RECIPE_INDEXES, RECIPE_TABLE, SHARD_TABLE, migrate_database, table_exists
 
+# Polars (and the scripts using it) are imported by the functions that parse and store the sources, so a build that
+# is skipped by the build cache never loads them
+if TYPE_CHECKING:
+    from polars import DataFrame, Expr
 
-def fetch_and_process_information(filename: str = 'Full Fusion List - Hypixel SkyBlock - List.csv') -> \
-        List[Dict[str, int or str]]:
+RECIPE_COLUMNS: List[str] = ['quantity_1', 'ingredient_1', 'quantity_2', 'ingredient_2', 'output_quantity',
+                             'output_item']
+
+# The digest of every source file as of the last build
+BUILD_CACHE_TABLE: str = '''
+                         CREATE TABLE IF NOT EXISTS build_cache
+                         (
+                             source   TEXT PRIMARY KEY,
+                             digest   TEXT    NOT NULL,
+                             built_at INTEGER NOT NULL
+                         )
+                         '''
+
+
+@instrumented('fetch_and_process_information')
+def fetch_and_process_information(filename: str = 'Full Fusion List - Hypixel SkyBlock - List.csv') -> DataFrame:
     """
-    Uses Polars for efficient CSV parsing and transformation.
-    Extracts fusion data from a CSV and returns normalized list of records.
+    Uses a lazy Polars scan so the CSV is parsed, cleaned and deduplicated with string expressions in a single pass.
+    Extracts fusion data from a CSV and returns the normalized records, in the order they appear in the file.
+    The result is collected whole, as deduplicating the fusions (in file order) and diffing them against the stored
+    recipes both need every fusion at once, so the memory used grows with the fusion list.
 
     :param filename: The name of the CSV file containing the fusion list.
-    :return: A list of dictionaries, each containing the quantities and names of ingredients and outputs.
+    :return: A DataFrame with the quantities and names of ingredients and outputs, one row per unique fusion.
     """
+    from polars import Int64, col, lit, scan_csv, when
 
-    def split_and_clean(value: str) -> Tuple[int, str]:
+    def split_and_clean(column: str) -> List[Expr]:
         """
-        Function to split a string into quantity and name, cleaning up the name.
+        Function to split a column into quantity and name, cleaning up the name.
 
-        :param value: The string to be split, expected to be in the format "x quantity name (optional description)".
-        :return: A tuple containing the quantity as an integer and the cleaned name as a string.
+        :param column: The column to be split, its values expected to be in the format "x quantity name (optional
+        description)".
+        :return: Two expressions, the quantity as an integer (0 if missing) and the cleaned name ('' if missing).
         """
-        if not value:
-            return 0, ''
-        parts: List[str] = value.split(' ', 1)
-        quantity: int = int(parts[0].replace('x', '')) if parts[0].replace('x', '').isdigit() else 0
-        name: str = re_sub(r'\s*\(.*\)', '', parts[1]) if len(parts) > 1 else ''
-        return quantity, name.strip()
+        parts: Expr = col(column).fill_null('').str.splitn(' ', 2)
+        quantity: Expr = parts.struct.field('field_0').str.replace_all('x', '', literal=True)
+        name: Expr = parts.struct.field('field_1').str.replace_all(r'\s*\(.*\)', '').str.strip_chars()
+        return [
+            when(quantity.str.contains(r'^\d+$')).then(quantity.cast(Int64, strict=False)).otherwise(lit(0)),
+            name.fill_null('')
+        ]
+
+    quantity_1, ingredient_1 = split_and_clean('Input #1')
+    quantity_2, ingredient_2 = split_and_clean('Input #2')
+    outputs: List[str] = [f'Output #{i}' for i in range(1, 4)]
+    first_is_smaller: Expr = col('ingredient_1') <= col('ingredient_2')
+
+    rows: DataFrame = (
+        scan_csv(filename, skip_rows=1, infer_schema=False)
+        .select(
+            quantity_1.alias('quantity_1'),
+            ingredient_1.alias('ingredient_1'),
+            quantity_2.alias('quantity_2'),
+            ingredient_2.alias('ingredient_2'),
+            *outputs
+        )
+        .with_row_index('row')
+        .unpivot(index=['row', *RECIPE_COLUMNS[:4]], on=outputs, variable_name='position', value_name='output')
+        .with_columns(*(expression.alias(name) for expression, name in
+                        zip(split_and_clean('output'), ('output_quantity', 'output_item'))))
+        .filter(col('output_item') != '')
+        .sort('row', 'position')
+        .with_columns(
+            when(first_is_smaller).then(col('ingredient_1')).otherwise(col('ingredient_2')).alias('first_input'),
+            when(first_is_smaller).then(col('ingredient_2')).otherwise(col('ingredient_1')).alias('second_input')
+        )
+        .unique(subset=['first_input', 'second_input', 'output_item'], keep='first', maintain_order=True)
+        .select(RECIPE_COLUMNS)
+        .collect(engine='streaming')
+    )
+    metrics.increment('rows_processed', rows.height, stage='fetch_and_process_information')
+    return rows
+
+
+def diff_recipes(stored: DataFrame, recipes: DataFrame) -> Tuple[DataFrame, DataFrame, DataFrame]:
+    """
+    Function to compare the stored processed recipes with a new list of them.
+    Recipes are matched on their pair of ingredients (in any order) and their output, the key the fusion list is
+    deduplicated on, so a recipe keeps its `recipe_id` as long as it is in the list, wherever it moved to.
+
+    :param stored: The stored recipes, as returned by `calculate_profits.load_recipe_frame`.
+    :param recipes: The new recipes, in order, with the `RECIPE_COLUMNS` (ingredients and outputs as product IDs).
+    :return: The recipes to insert, numbered after the largest stored recipe ID in the order of the new list, the
+    recipes whose quantities or ingredient order changed, with their stored recipe ID, and the IDs of the recipes to
+    delete.
+    """
+    from polars import Int64, any_horizontal, col, when
+
+    def keyed(frame: DataFrame) -> DataFrame:
+        first_is_smaller: Expr = col('ingredient_1') <= col('ingredient_2')
+        return frame.with_columns(
+            when(first_is_smaller).then(col('ingredient_1')).otherwise(col('ingredient_2')).alias('first_input'),
+            when(first_is_smaller).then(col('ingredient_2')).otherwise(col('ingredient_1')).alias('second_input')
+        )
 
-    df: DataFrame = read_csv(filename, skip_rows=1)
+    joined: DataFrame = keyed(recipes.with_row_index('position')).join(
+        keyed(stored.with_columns(col('recipe_id').cast(Int64))),
+        on=['first_input', 'second_input', 'output_item'], how='full', coalesce=True, nulls_equal=True,
+        suffix='_stored'
+    )
 
-    seen_combinations: Set[Tuple[str, str, str]] = set()
-    processed_rows: List[Dict[str, int or str]] = []
+    next_recipe_id: int = 0 if stored.is_empty() else stored['recipe_id'].max() + 1
+    inserted: DataFrame = (
+        joined
+        .filter(col('recipe_id').is_null())
+        .sort('position')
+        .with_row_index('offset')
+        .select((col('offset').cast(Int64) + next_recipe_id).alias('recipe_id'), *RECIPE_COLUMNS)
+    )
+    updated: DataFrame = joined.filter(
+        col('position').is_not_null() & col('recipe_id').is_not_null() &
+        any_horizontal(col(name).ne_missing(col(f'{name}_stored')) for name in RECIPE_COLUMNS[:5])
+    ).select('recipe_id', *RECIPE_COLUMNS)
+    deleted: DataFrame = joined.filter(col('position').is_null()).select('recipe_id')
 
-    for row in df.iter_rows(named=True):
-        quantity_1, ingredient_1 = split_and_clean(row.get('Input #1', ''))
-        quantity_2, ingredient_2 = split_and_clean(row.get('Input #2', ''))
+    return inserted, updated, deleted
 
-        for i in range(1, 4):
-            output_quantity, output_item = split_and_clean(row.get(f'Output #{i}', ''))
-            if output_item:
 
-                input_pair: Tuple[str, ...] = tuple(sorted([ingredient_1, ingredient_2]))
-                fusion_key: Tuple[str, str, str] = (input_pair[0], input_pair[1], output_item)
+def rows_match(cursor: Cursor, query: str, rows: DataFrame, batch_size: int = 4096) -> bool:
+    """
+    Function to compare the rows of a query with the rows of a DataFrame, in order.
+    The stored rows are fetched one batch at a time, so the comparison never holds a second copy of the table.
 
-                if fusion_key not in seen_combinations:
-                    seen_combinations.add(fusion_key)
-                    processed_rows.append({
-                        'quantity_1': quantity_1,
-                        'ingredient_1': ingredient_1,
-                        'quantity_2': quantity_2,
-                        'ingredient_2': ingredient_2,
-                        'output_quantity': output_quantity,
-                        'output_item': output_item
-                    })
+    :param cursor: A cursor on the database.
+    :param query: The query selecting the stored rows, with the columns of the DataFrame in the same order.
+    :param rows: The rows to compare against.
+    :param batch_size: The number of rows compared at a time.
+    :return: True if the query returns exactly the rows of the DataFrame.
+    """
+    cursor.execute(query)
+    for batch in rows.iter_slices(batch_size):
+        if cursor.fetchmany(batch_size) != list(batch.iter_rows()):
+            return False
 
-    return processed_rows
+    return not cursor.fetchmany(1)
 
 
-def store_data_in_database(processed_rows: List[Dict[str, int or str]], cleaned_shards_data: Dict[str, int or str]):
+@instrumented('store_data_in_database')
+def store_data_in_database(processed_rows: DataFrame, cleaned_shards_data: Dict[str, int or str],
+                           batch_size: int = 4096, db_path: str = 'shard_recipes.db') -> int:
     """
     Function to store processed rows and cleaned shards data into an SQLite database.
-    [OUTDATED info]
+    Existing databases are first migrated to the current schema version (see `schema.migrate_database`).
     It will make three tables:
-        - `shard_to_productid`: Maps shard names to their product IDs and other relevant information.
+        - `shard_to_productid`: Maps shard names to their product IDs and other relevant information, keyed by an
+          integer `shard_id`.
         - `shard_recipes`: Contains the recipes for shards.
-        - `shard_recipes_processed`: Contains processed recipes with corrected names for easy bazaar lookups.
+        - `shard_recipes_processed`: Contains processed recipes with corrected names for easy bazaar lookups, keyed
+          by an integer `recipe_id` and indexed on both ingredients and the output.
+    Tables that already hold data are brought in sync with the given data rather than rebuilt: removed shards are
+    deleted, renamed ones (same product ID) are renamed in place, the others are upserted by name (after freeing the
+    product IDs that moved to another shard), `shard_recipes` is only rewritten if it differs, and the processed
+    recipes are diffed (see `diff_recipes`) so only the added, changed and removed recipes are written.
 
     :param processed_rows: The data coming from the CSV file which contains the fusion list information.
     :param cleaned_shards_data: A dictionary containing different information about shards
-    :return: None
+    :param batch_size: The number of recipes handed to each `executemany` call.
+    :param db_path: The path of the SQLite database.
+    :return: The number of processed recipes that were added, changed or removed.
     """
-    db_path: str = 'shard_recipes.db'
+    from polars import col
+
+    from backend.scripts.calculate_profits import load_recipe_frame
 
     conn: Connection = connect(db_path)
     cur: Cursor = conn.cursor()
+    migrate_database(conn)
 
-    def table_has_data(table_name: str) -> bool:
-        cur.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-        if cur.fetchone():
-            cur.execute(f"SELECT 1 FROM {table_name} LIMIT 1")
-            return cur.fetchone() is not None
-        return False
-
-    if not table_has_data('shard_to_productid'):
-        cur.execute('''
-                    CREATE TABLE IF NOT EXISTS shard_to_productid
-                    (
-                        name       TEXT PRIMARY KEY,
-                        productID  TEXT,
-                        rarity     TEXT,
-                        family     TEXT,
-                        craftingID TEXT
-                    )
-                    ''')
-        name_corrections: Dict[str, str] = {
-            'Sea Serpant': 'Sea Serpent',
-            'Star Centry': 'Star Sentry'
-        }
-        cur.executemany('''
-                        INSERT INTO shard_to_productid
-                            (name, productID, rarity, family, craftingID)
-                        VALUES (?, ?, ?, ?, ?)
-                        ''', [
-                            (
-                                name_corrections.get(name, name),
-                                info.get('productID'),
-                                info.get('rarity'),
-                                info.get('family')[0] if info.get('family') else None,
-                                info.get('id')
-                            )
-                            for name, info in cleaned_shards_data['shards'].items()
-                        ])
-        conn.commit()
+    name_corrections: Dict[str, str] = {
+        'Sea Serpant': 'Sea Serpent',
+        'Star Centry': 'Star Sentry'
+    }
 
-    if not table_has_data('shard_recipes'):
-        cur.execute('''
-                    CREATE TABLE IF NOT EXISTS shard_recipes
-                    (
-                        quantity_1      INTEGER,
-                        ingredient_1    TEXT,
-                        quantity_2      INTEGER,
-                        ingredient_2    TEXT,
-                        output_quantity INTEGER,
-                        output_item     TEXT
-                    )
-                    ''')
-        cur.executemany('''
-                        INSERT INTO shard_recipes
-                        (quantity_1, ingredient_1, quantity_2, ingredient_2, output_quantity, output_item)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                        ''', [
-                            (
-                                row['quantity_1'],
-                                row['ingredient_1'],
-                                row['quantity_2'],
-                                row['ingredient_2'],
-                                row['output_quantity'],
-                                row['output_item']
-                            )
-                            for row in processed_rows
-                        ])
+    cur.execute(SHARD_TABLE)
+    shards: List[Tuple[str, str, str, str, str]] = [
+        (
+            name_corrections.get(name, name),
+            info.get('productID'),
+            info.get('rarity'),
+            info.get('family')[0] if info.get('family') else None,
+            info.get('id')
+        )
+        for name, info in cleaned_shards_data['shards'].items()
+    ]
+    changes: int = conn.total_changes
+
+    # Removed shards go first, and renamed ones (same product ID under a new name) keep their row and `shard_id`, so
+    # the upsert never collides with the unique product ID of a stale row
+    cur.execute("SELECT name, productID FROM shard_to_productid")
+    stored_shards: Dict[str, Optional[str]] = dict(cur.fetchall())
+    new_names: Dict[str, str] = {product_id: name for name, product_id, *_ in shards
+                                 if product_id is not None and name not in stored_shards}
+    removed_shards: Set[str] = set(stored_shards) - {shard[0] for shard in shards}
+    renamed_shards: List[Tuple[str, str]] = [(new_names[stored_shards[name]], name) for name in removed_shards
+                                             if stored_shards[name] in new_names]
+    cur.executemany("UPDATE shard_to_productid SET name = ? WHERE name = ?", renamed_shards)
+    cur.executemany("DELETE FROM shard_to_productid WHERE name = ?",
+                    ((name,) for name in removed_shards - {old_name for _, old_name in renamed_shards}))
+    # Shards whose product ID changed give it up first, so a product ID moving to another shard (or two shards swapping
+    # theirs) never collides with the shard it comes from during the upsert
+    cur.executemany("UPDATE shard_to_productid SET productID = NULL WHERE name = ?",
+                    ((name,) for name, product_id, *_ in shards if stored_shards.get(name) not in (None, product_id)))
+
+    cur.executemany('''
+                    INSERT INTO shard_to_productid
+                        (name, productID, rarity, family, craftingID)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE SET productID  = excluded.productID,
+                                                     rarity     = excluded.rarity,
+                                                     family     = excluded.family,
+                                                     craftingID = excluded.craftingID
+                    WHERE productID IS NOT excluded.productID
+                       OR rarity IS NOT excluded.rarity
+                       OR family IS NOT excluded.family
+                       OR craftingID IS NOT excluded.craftingID
+                    ''', shards)
+    conn.commit()
+    metrics.increment('rows_processed', conn.total_changes - changes, stage='store_data_in_database',
+                      table='shard_to_productid')
+
+    cur.execute('''
+                CREATE TABLE IF NOT EXISTS shard_recipes
+                (
+                    quantity_1      INTEGER,
+                    ingredient_1    TEXT,
+                    quantity_2      INTEGER,
+                    ingredient_2    TEXT,
+                    output_quantity INTEGER,
+                    output_item     TEXT
+                )
+                ''')
+    if not rows_match(cur, f"SELECT {', '.join(RECIPE_COLUMNS)} FROM shard_recipes ORDER BY rowid", processed_rows,
+                      batch_size):
+        cur.execute("DELETE FROM shard_recipes")
+        for batch in processed_rows.iter_slices(batch_size):
+            cur.executemany('''
+                            INSERT INTO shard_recipes
+                            (quantity_1, ingredient_1, quantity_2, ingredient_2, output_quantity, output_item)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                            ''', batch.iter_rows())
         conn.commit()
+        metrics.increment('rows_processed', processed_rows.height, stage='store_data_in_database',
+                          table='shard_recipes')
 
-    if not table_has_data('shard_recipes_processed'):
-        cur.execute('''
-                    CREATE TABLE IF NOT EXISTS shard_recipes_processed
-                    (
-                        quantity_1      INTEGER,
-                        ingredient_1    TEXT,
-                        quantity_2      INTEGER,
-                        ingredient_2    TEXT,
-                        output_quantity INTEGER,
-                        output_item     TEXT
-                    )
-                    ''')
-        name_corrections: Dict[str, str] = {
-            'Sea Serpant': 'Sea Serpent',
-            'Star Centry': 'Star Sentry'
-        }
-        name_id_map = {name_corrections.get(info['name'], info['name']): info['productID'] for info in
-                       cleaned_shards_data['shards'].values()}
+    cur.execute(RECIPE_TABLE)
+    name_id_map = {name_corrections.get(info['name'], info['name']): info['productID'] for info in
+                   cleaned_shards_data['shards'].values()}
+    inserted, updated, deleted = diff_recipes(load_recipe_frame(conn), processed_rows.with_columns(
+        col(name).replace(name_id_map) for name in ('ingredient_1', 'ingredient_2', 'output_item')
+    ))
+
+    cur.executemany("DELETE FROM shard_recipes_processed WHERE recipe_id = ?", deleted.iter_rows())
+    cur.executemany('''
+                    UPDATE shard_recipes_processed
+                    SET quantity_1      = ?,
+                        ingredient_1    = ?,
+                        quantity_2      = ?,
+                        ingredient_2    = ?,
+                        output_quantity = ?,
+                        output_item     = ?
+                    WHERE recipe_id = ?
+                    ''', updated.select(*RECIPE_COLUMNS, 'recipe_id').iter_rows())
+    for batch in inserted.iter_slices(batch_size):
         cur.executemany('''
                         INSERT INTO shard_recipes_processed
-                        (quantity_1, ingredient_1, quantity_2, ingredient_2, output_quantity, output_item)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                        ''', [
-                            (
-                                row['quantity_1'],
-                                name_id_map.get(row['ingredient_1'], row['ingredient_1']),
-                                row['quantity_2'],
-                                name_id_map.get(row['ingredient_2'], row['ingredient_2']),
-                                row['output_quantity'],
-                                name_id_map.get(row['output_item'], row['output_item'])
-                            )
-                            for row in processed_rows
-                        ])
-        conn.commit()
+                        (recipe_id, quantity_1, ingredient_1, quantity_2, ingredient_2, output_quantity,
+                         output_item)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ''', batch.iter_rows())
 
+    # On a new table the indexes are built once it is filled, which is cheaper than maintaining them on every insert
+    for statement in RECIPE_INDEXES:
+        cur.execute(statement)
+    conn.commit()
+
+    changed_recipes: int = inserted.height + updated.height + deleted.height
+    metrics.increment('rows_processed', changed_recipes, stage='store_data_in_database',
+                      table='shard_recipes_processed')
+
+    conn.close()
+    return changed_recipes
+
+
+def file_digest(filename: str) -> str:
+    """
+    Function to hash the content of a file.
+
+    :param filename: The name of the file.
+    :return: The SHA-256 digest of the file, in hexadecimal.
+    """
+    digest = sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@instrumented('build_recipe_database')
+def build_recipe_database(csv_filename: str = 'Full Fusion List - Hypixel SkyBlock - List.csv',
+                          shards_filename: str = 'shards_cleaned.json', db_path: str = 'shard_recipes.db') -> \
+        Optional[int]:
+    """
+    Function to build the recipe database from the fusion list and the cleaned shards data, unless neither changed
+    since the last build.
+    The SHA-256 digests of both files are recorded in the `build_cache` table after every build. When they still
+    match and the recipes are stored, the files are not even parsed; otherwise `store_data_in_database` only writes
+    what differs from the stored tables.
+    Either way, the recipe snapshot next to the database (see `recipe_snapshot`) is rewritten if it does not match
+    the sources.
+
+    :param csv_filename: The name of the CSV file containing the fusion list.
+    :param shards_filename: The name of the JSON file containing the cleaned shards data.
+    :param db_path: The path of the SQLite database.
+    :return: The number of processed recipes that were added, changed or removed, or None if the build was skipped.
+    """
+    digests: Dict[str, str] = {'fusion_list': file_digest(csv_filename), 'shards': file_digest(shards_filename)}
+
+    conn: Connection = connect(db_path)
+    cur: Cursor = conn.cursor()
+    cur.execute(BUILD_CACHE_TABLE)
+    cur.execute("SELECT source, digest FROM build_cache")
+    cached: Dict[str, str] = dict(cur.fetchall())
+    up_to_date: bool = cached == digests and table_exists(cur, 'shard_recipes_processed')
+    if up_to_date and read_snapshot_key(snapshot_path(db_path)) != source_key(cur):
+        write_snapshot(conn, snapshot_path(db_path))
     conn.close()
+
+    metrics.increment('build_cache_lookups', result='hit' if up_to_date else 'miss')
+    if up_to_date:
+        print('The recipe database is up to date with its sources, skipping the build')
+        return None
+
+    from backend.scripts.fetch_info import json_to_dict
+
+    changed_recipes: int = store_data_in_database(fetch_and_process_information(csv_filename),
+                                                  json_to_dict(shards_filename), db_path=db_path)
+
+    conn = connect(db_path)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO build_cache (source, digest, built_at) VALUES (?, ?, ?)",
+                         ((source, digest, int(time())) for source, digest in digests.items()))
+    write_snapshot(conn, snapshot_path(db_path))
+    conn.close()
+
+    print(f'{changed_recipes} recipes added, changed or removed')
+    return changed_recipes
@@ -1,152 +1,437 @@
-from math import floor
 from sqlite3 import Connection, Cursor
-from typing import Dict, List
+from typing import Collection, Dict, List, Optional, Sequence, Type
 
+from polars import DataFrame, DataType, Expr, Float64, Int64, UInt32, Utf8, col, concat_str, lit, struct, when
 
-def calculate_accurate_profit(db_connection: Connection, skip_empty_orders: bool = True, cope_mode: bool = False) -> None:
+from backend.scripts.metrics import instrumented, metrics
+from backend.scripts.price_analytics import load_analytics_frame
+from backend.scripts.profit_history import add_profit_history
+from backend.scripts.recipe_store import RecipeStore
+from backend.scripts.schema import PROFIT_INDEXES, PROFIT_TABLE
+
+RECIPE_SCHEMA = {
+    'recipe_id': UInt32,
+    'quantity_1': Int64,
+    'ingredient_1': Utf8,
+    'quantity_2': Int64,
+    'ingredient_2': Utf8,
+    'output_quantity': Int64,
+    'output_item': Utf8
+}
+
+BAZAAR_SCHEMA = {
+    'product_id': Utf8,
+    'sell_price': Float64,
+    'sell_volume': Int64,
+    'sell_moving_week': Int64,
+    'sell_orders': Int64,
+    'buy_price': Float64,
+    'buy_volume': Int64,
+    'buy_moving_week': Int64,
+    'buy_orders': Int64
+}
+
+PRODUCT_SCHEMA = {
+    'productID': Utf8,
+    'name': Utf8,
+    'rarity': Utf8,
+    'family': Utf8,
+    'craftingID': Utf8
+}
+
+
+def fetch_frame(db_connection: Connection, query: str, schema: Dict[str, Type[DataType]],
+                parameters: Sequence = ()) -> DataFrame:
+    """
+    Function to run a query and load its result into a DataFrame.
+    The rows are transposed into columns before building the frame, which is much faster than a row-oriented load.
+
+    :param db_connection: The connection to the SQLite database.
+    :param query: The query to run, selecting the columns in the same order as the schema.
+    :param schema: The names and types of the selected columns.
+    :param parameters: The parameters bound to the query.
+    :return: A DataFrame with the query result.
+    """
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute(query, parameters)
+    return DataFrame(list(zip(*cursor.fetchall())), schema=schema, orient='col')
+
+
+def load_recipe_frame(db_connection: Connection) -> DataFrame:
+    """
+    Function to load the processed recipes into a DataFrame, ordered by recipe ID.
+
+    :param db_connection: The connection to the SQLite database containing the shard recipes.
+    :return: A DataFrame with one row per recipe and a `recipe_id` column.
+    """
+    return fetch_frame(db_connection, """
+                       SELECT recipe_id,
+                              quantity_1,
+                              ingredient_1,
+                              quantity_2,
+                              ingredient_2,
+                              output_quantity,
+                              output_item
+                       FROM shard_recipes_processed
+                       ORDER BY recipe_id
+                       """, RECIPE_SCHEMA)
+
+
+def load_bazaar_frame(db_connection: Connection) -> DataFrame:
+    """
+    Function to load the current bazaar snapshot into a DataFrame.
+
+    :param db_connection: The connection to the SQLite database containing the bazaar information.
+    :return: A DataFrame with one row per bazaar product.
+    """
+    return fetch_frame(db_connection, f"SELECT {', '.join(BAZAAR_SCHEMA)} FROM bazaar_info", BAZAAR_SCHEMA)
+
+
+def load_product_frame(db_connection: Connection) -> DataFrame:
     """
-    Function to calculate the profit for each recipe based on the bazaar data.
+    Function to load the shard metadata (names, rarity, family and crafting ID) into a DataFrame.
 
     :param db_connection: The connection to the SQLite database containing the shard recipes.
+    :return: A DataFrame with one row per shard product ID.
+    """
+    return fetch_frame(db_connection, f"SELECT {', '.join(PRODUCT_SCHEMA)} FROM shard_to_productid", PRODUCT_SCHEMA)
+
+
+def load_acquisition_frame(db_connection: Connection) -> DataFrame:
+    """
+    Function to load the cheapest acquisition cost of every shard (see `acquisition_costs`) into a DataFrame.
+
+    :param db_connection: The connection to the SQLite database containing the `shard_acquisition_cost` table.
+    :return: A DataFrame with the product ID and acquisition cost of every obtainable shard.
+    """
+    return fetch_frame(db_connection, """
+                       SELECT product_id, acquisition_cost
+                       FROM shard_acquisition_cost
+                       WHERE acquisition_cost IS NOT NULL
+                       """, {'product_id': Utf8, 'acquisition_cost': Float64})
+
+
+def compute_profit_frame(recipes: DataFrame, bazaar: DataFrame, products: DataFrame,
+                         skip_empty_orders: bool = True, cope_mode: bool = False,
+                         acquisition: Optional[DataFrame] = None, analytics: Optional[DataFrame] = None) -> DataFrame:
+    """
+    Function to compute the profit of every recipe as whole-column expressions.
+
+    The recipes are joined against the bazaar prices of both ingredients and the output, recipes whose output is not
+    on the bazaar (or, if requested, whose ingredients have no buy orders) are dropped, and the costs, revenue and
+    profit are computed for all the remaining recipes at once.
+
+    :param recipes: The recipes, as returned by `load_recipe_frame`.
+    :param bazaar: The bazaar snapshot, as returned by `load_bazaar_frame`.
+    :param products: The shard metadata, as returned by `load_product_frame`.
     :param skip_empty_orders: If True, it skips recipes with empty insta buy orders for ingredients.
+    :param cope_mode: If True, recipes with a reptile ingredient get a 20% revenue bonus.
+    :param acquisition: The acquisition costs, as returned by `load_acquisition_frame`. If given, ingredients are
+    priced at their cheapest buy-or-fuse cost instead of their buy price, and empty buy orders are already accounted
+    for by it.
+    :param analytics: The price statistics, as returned by `price_analytics.load_analytics_frame`. If given, the
+    profit at the 7-day median prices and the median profit per unit of price volatility are computed too (they are
+    null otherwise).
+    :return: A DataFrame with one row per priced recipe, still keyed by product IDs.
     """
-    cursor: Cursor = db_connection.cursor()
-    cursor.execute("""
-                   SELECT quantity_1,
-                          ingredient_1,
-                          quantity_2,
-                          ingredient_2,
-                          output_quantity,
-                          output_item
-                   FROM shard_recipes_processed
-                   """)
-    recipes: List = cursor.fetchall()
-
-    profit_data: Dict[str, Dict[str, str or float or List]] = {}
-
-    cursor.execute("SELECT * FROM bazaar_info")
-    bazaar_data: Dict[str, Dict[str, int or str or float]] = {row[0]: {
-        'sellPrice': row[1],
-        'sellVolume': row[2],
-        'sellOrders': row[4],
-        'buyOrders': row[8],
-        'buyPrice': row[5]
-    } for row in cursor.fetchall()}
-
-    # Get product family data for COPE calculations if needed
-    family_data: Dict[str, str] = {}
+    prices: DataFrame = bazaar.select('product_id', 'buy_price', 'sell_volume', 'buy_orders')
+    ingredient_prices: DataFrame = prices if acquisition is None else acquisition.select(
+        'product_id',
+        col('acquisition_cost').alias('buy_price'),
+        lit(None, Int64).alias('sell_volume'),
+        lit(None, Int64).alias('buy_orders')
+    )
+    families: DataFrame = products.select(col('productID').alias('product_id'), 'family')
+
+    def prefixed(frame: DataFrame, prefix: str) -> DataFrame:
+        return frame.rename({name: f'{prefix}_{name}' for name in frame.columns})
+
+    frame: DataFrame = (
+        recipes
+        .join(prefixed(prices, 'output'), left_on='output_item', right_on='output_product_id', how='inner')
+        .join(prefixed(ingredient_prices, 'ingredient_1'), left_on='ingredient_1',
+              right_on='ingredient_1_product_id', how='left')
+        .join(prefixed(ingredient_prices, 'ingredient_2'), left_on='ingredient_2',
+              right_on='ingredient_2_product_id', how='left')
+    )
+    metrics.increment('rows_skipped', recipes.height - frame.height, stage='compute_profit_frame',
+                      reason='output_not_on_bazaar')
+
+    if skip_empty_orders:
+        priced: int = frame.height
+        frame = frame.filter(
+            ~(col('ingredient_1_buy_orders').eq(0).fill_null(False) |
+              col('ingredient_2_buy_orders').eq(0).fill_null(False))
+        )
+        metrics.increment('rows_skipped', priced - frame.height, stage='compute_profit_frame',
+                          reason='empty_buy_orders')
+
+    frame = frame.with_columns(
+        (col('ingredient_1_buy_price') * col('quantity_1')).alias('cost_1'),
+        (col('ingredient_2_buy_price') * col('quantity_2')).alias('cost_2'),
+        (col('output_buy_price') * col('output_quantity')).alias('revenue')
+    )
+
+    frame = frame.with_columns(lit(1.0).alias('revenue_bonus'))
     if cope_mode:
-        cursor.execute("SELECT productID, family FROM shard_to_productid")
-        family_data = {row[0]: row[1] for row in cursor.fetchall()}
+        is_reptile: DataFrame = families.select('product_id', (col('family') == 'Reptile').alias('is_reptile'))
+        frame = (
+            frame
+            .join(prefixed(is_reptile, 'ingredient_1'), left_on='ingredient_1', right_on='ingredient_1_product_id',
+                  how='left')
+            .join(prefixed(is_reptile, 'ingredient_2'), left_on='ingredient_2', right_on='ingredient_2_product_id',
+                  how='left')
+            .with_columns(
+                # Multiply revenue by 1.2 because reptile shards have 20% chance to double output
+                when(col('ingredient_1_is_reptile').fill_null(False) | col('ingredient_2_is_reptile').fill_null(False))
+                .then(1.2)
+                .otherwise(1.0)
+                .alias('revenue_bonus')
+            )
+            .with_columns((col('revenue') * col('revenue_bonus')).alias('revenue'))
+        )
 
-    for idx, recipe in enumerate(recipes):
-        quantity_1, ingredient_1, quantity_2, ingredient_2, output_quantity, output_item = recipe
+    if analytics is None:
+        frame = frame.with_columns(
+            lit(None, Float64).alias('median_profit'),
+            lit(None, Float64).alias('profit_per_volatility')
+        )
+    else:
+        frame = (
+            frame
+            .join(prefixed(analytics, 'output'), left_on='output_item', right_on='output_product_id', how='left')
+            .join(prefixed(analytics, 'ingredient_1'), left_on='ingredient_1', right_on='ingredient_1_product_id',
+                  how='left')
+            .join(prefixed(analytics, 'ingredient_2'), left_on='ingredient_2', right_on='ingredient_2_product_id',
+                  how='left')
+            .with_columns(
+                (col('output_median_price') * col('output_quantity') * col('revenue_bonus') -
+                 col('ingredient_1_median_price') * col('quantity_1') -
+                 col('ingredient_2_median_price') * col('quantity_2')).alias('median_profit'),
+                # The prices are treated as independent, so the variance of the profit is the sum of the variances
+                ((col('output_std_price') * col('output_quantity') * col('revenue_bonus')).pow(2) +
+                 (col('ingredient_1_std_price') * col('quantity_1')).pow(2) +
+                 (col('ingredient_2_std_price') * col('quantity_2')).pow(2)).sqrt().alias('profit_std')
+            )
+            .with_columns(
+                when(col('profit_std') > 0)
+                .then(col('median_profit') / col('profit_std'))
+                .alias('profit_per_volatility')
+            )
+        )
 
-        if output_item not in bazaar_data:
-            print(f"Output item {output_item} not found in bazaar data. Skipping this recipe.")
-            continue
+    candidates: int = frame.height
+    frame = frame.filter(col('cost_1').is_not_null() & col('cost_2').is_not_null())
+    metrics.increment('rows_skipped', candidates - frame.height, stage='compute_profit_frame',
+                      reason='ingredient_not_priced')
 
-        product_info = bazaar_data[output_item]
-        ingredient_1_info: Dict[str, int or str or float] = bazaar_data.get(ingredient_1, {})
-        ingredient_2_info: Dict[str, int or str or float] = bazaar_data.get(ingredient_2, {})
+    return (
+        frame
+        .select(
+            'recipe_id',
+            'output_item',
+            'ingredient_1',
+            'quantity_1',
+            'ingredient_2',
+            'quantity_2',
+            col('output_sell_volume').alias('demand'),
+            (col('revenue') - (col('cost_1') + col('cost_2'))).floor().cast(Int64).alias('profit'),
+            col('cost_1').floor().cast(Int64),
+            col('cost_2').floor().cast(Int64),
+            col('output_buy_price').floor().cast(Int64).alias('product_price'),
+            col('median_profit').floor().cast(Int64),
+            'profit_per_volatility'
+        )
+        .sort('recipe_id')
+    )
 
-        if skip_empty_orders and (ingredient_1_info.get('buyOrders') == 0 or ingredient_2_info.get('buyOrders') == 0):
-            print(f"Skipping recipe {idx} for {output_item} due to empty buy orders for ingredients.")
-            continue
 
-        cost_ingredient_1: float = ingredient_1_info.get('buyPrice') * quantity_1
-        cost_ingredient_2: float = ingredient_2_info.get('buyPrice') * quantity_2
+def format_profit_frame(profit_frame: DataFrame, products: DataFrame) -> DataFrame:
+    """
+    Function to turn a profit frame keyed by product IDs into the rows stored in `shard_profit_data`.
 
-        product_price: float = product_info.get('buyPrice')
+    Product IDs are replaced by the shard names, the display ID is built from the rarity and crafting ID, and the
+    ingredients are serialised as a JSON list of their name, amount and cost (the format the frontend writes too).
 
-        # Apply COPE mode bonus if enabled and reptile shards are present
-        revenue: float = product_price * output_quantity
-        if cope_mode:
-            ingredient_1_is_reptile = family_data.get(ingredient_1) == "Reptile"
-            ingredient_2_is_reptile = family_data.get(ingredient_2) == "Reptile"
-            
-            if ingredient_1_is_reptile or ingredient_2_is_reptile:
-                # Multiply revenue by 1.2 because reptile shards have 20% chance to double output
-                revenue = revenue * 1.2
-
-        profit: float = revenue - (cost_ingredient_1 + cost_ingredient_2)
-
-        profit_data[idx] = {
-            'output_item': output_item,
-            'demand': floor(product_info['sellVolume']),
-            'profit': floor(profit),
-            'ingredients': [
-                {
-                    'name': ingredient_1,
-                    'amount': quantity_1,
-                    'cost': floor(cost_ingredient_1)
-                },
-                {
-                    'name': ingredient_2,
-                    'amount': quantity_2,
-                    'cost': floor(cost_ingredient_2)
-                }
-            ],
-            'product_price': floor(product_price)
-        }
+    :param profit_frame: The profits, as returned by `compute_profit_frame`.
+    :param products: The shard metadata, as returned by `load_product_frame`.
+    :return: A DataFrame whose columns match the `shard_profit_data` table.
+    """
+    names: DataFrame = products.select(
+        col('productID').alias('product_id'),
+        'name',
+        concat_str(col('rarity').str.slice(0, 1).str.to_uppercase(), col('craftingID')).alias('id')
+    )
 
-    cursor.execute('''DROP TABLE IF EXISTS shard_profit_data''')
+    def named(column: str) -> Expr:
+        return col(f'{column}_name').fill_null(col(column))
 
-    # Store the profit data in the database
+    def ingredient(position: int) -> Expr:
+        return struct(
+            named(f'ingredient_{position}').alias('name'),
+            col(f'quantity_{position}').alias('amount'),
+            col(f'cost_{position}').alias('cost')
+        ).struct.json_encode()
+
+    return (
+        profit_frame
+        .join(names.rename({'name': 'output_item_name'}), left_on='output_item', right_on='product_id', how='left',
+              maintain_order='left')
+        .join(names.select('product_id', col('name').alias('ingredient_1_name')), left_on='ingredient_1',
+              right_on='product_id', how='left', maintain_order='left')
+        .join(names.select('product_id', col('name').alias('ingredient_2_name')), left_on='ingredient_2',
+              right_on='product_id', how='left', maintain_order='left')
+        .select(
+            'recipe_id',
+            named('output_item').alias('output_item'),
+            'demand',
+            'profit',
+            (col('cost_1') + col('cost_2')).alias('cost'),
+            concat_str(lit('['), ingredient(1), lit(','), ingredient(2), lit(']')).alias('ingredients'),
+            'id',
+            col('product_price').alias('current_price'),
+            'median_profit',
+            'profit_per_volatility'
+        )
+    )
+
+
+def insert_profit_rows(cursor: Cursor, profit_rows: DataFrame) -> None:
+    """
+    Function to bulk-insert formatted profit rows into `shard_profit_data`, without committing.
+
+    :param cursor: A cursor on the database containing the `shard_profit_data` table.
+    :param profit_rows: The rows to store, as returned by `format_profit_frame`.
+    :return: None
+    """
+    cursor.executemany('''
+                       INSERT INTO shard_profit_data (recipe_id, output_item, demand, profit, cost, ingredients, id,
+                                                      current_price, median_profit, profit_per_volatility)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                       ''', profit_rows.iter_rows())
+
+
+def bump_profit_version(cursor: Cursor) -> int:
+    """
+    Function to increment the version stamp of `shard_profit_data`, without committing. It is bumped in the same
+    transaction as every write, so readers caching the profits (see `profit_cache`) can tell when they are stale.
+
+    :param cursor: A cursor on the database containing the `shard_profit_data` table.
+    :return: The new version.
+    """
     cursor.execute('''
-                   CREATE TABLE IF NOT EXISTS shard_profit_data
+                   CREATE TABLE IF NOT EXISTS profit_data_version
                    (
-                       recipe_id     INTEGER PRIMARY KEY,
-                       output_item   TEXT,
-                       demand        REAL,
-                       profit        REAL,
-                       ingredients   TEXT,
-                       id            TEXT,
-                       current_price REAL
+                       id      INTEGER PRIMARY KEY CHECK (id = 0),
+                       version INTEGER NOT NULL
                    )
                    ''')
+    cursor.execute('''
+                   INSERT INTO profit_data_version (id, version)
+                   VALUES (0, 1)
+                   ON CONFLICT (id) DO UPDATE SET version = version + 1
+                   ''')
+    cursor.execute('SELECT version FROM profit_data_version WHERE id = 0')
+    return cursor.fetchone()[0]
 
-    # Fetch the data from shard_to_productid to use those product names instead of the ID's
-    cursor.execute('''SELECT productID, name, rarity, craftingID
-                      FROM shard_to_productid''')
-    product_data: Dict[str, Dict[str, str]] = {
-        row[0]: {
-            'name': row[1],
-            'rarity': row[2],
-            'craftingID': row[3]
-        } for row in cursor.fetchall()
-    }
-
-    # Update the output_item in profit_data with the product names
-    for _, data in profit_data.items():
-        product_information = product_data.get(data['output_item'], {})
-        data['ID'] = f"{str(product_information['rarity'])[0].upper()}{product_information['craftingID']}"
-
-        if data['output_item'] in product_data:
-            data['output_item'] = product_information['name']
-        else:
-            print(f"Warning: Output item {data['output_item']} not found in product names mapping.")
-
-        for ingredient in data['ingredients']:
-            if ingredient['name'] in product_data:
-                ingredient['name'] = product_data[ingredient['name']]['name']
-            else:
-                print(f"Warning: Ingredient {ingredient['name']} not found in product names mapping.")
 
-    cursor.executemany('''
-                       INSERT INTO shard_profit_data (recipe_id, output_item, demand, profit, ingredients, id,
-                                                      current_price)
-                       VALUES (?, ?, ?, ?, ?, ?, ?)
-                       ''', [
-                           (
-                               idx,
-                               data['output_item'],
-                               data['demand'],
-                               data['profit'],
-                               str(data['ingredients']),
-                               data['ID'],
-                               data['product_price']
-                           )
-                           for idx, data in profit_data.items()
-                       ])
+def write_profit_data(db_connection: Connection, profit_rows: DataFrame) -> None:
+    """
+    Function to replace the content of `shard_profit_data` with the given rows in a single bulk insert, and record
+    their changes in the profit history (see `profit_history`).
+
+    :param db_connection: The connection to the SQLite database containing the shard recipes.
+    :param profit_rows: The rows to store, as returned by `format_profit_frame`.
+    :return: None
+    """
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute('''DROP TABLE IF EXISTS shard_profit_data''')
+    cursor.execute(PROFIT_TABLE)
+
+    insert_profit_rows(cursor, profit_rows)
+    for statement in PROFIT_INDEXES:
+        cursor.execute(statement)
+    add_profit_history(cursor, profit_rows)
+    bump_profit_version(cursor)
+    db_connection.commit()
+
+
+@instrumented('calculate_accurate_profit')
+def calculate_accurate_profit(db_connection: Connection, skip_empty_orders: bool = True, cope_mode: bool = False,
+                              use_acquisition_costs: bool = False, store: Optional[RecipeStore] = None,
+                              products: Optional[DataFrame] = None) -> None:
+    """
+    Function to calculate the profit for each recipe based on the bazaar data, and its risk-adjusted profit if price
+    analytics are available (see `price_analytics`).
+
+    :param db_connection: The connection to the SQLite database containing the shard recipes.
+    :param skip_empty_orders: If True, it skips recipes with empty insta buy orders for ingredients.
+    :param cope_mode: If True, recipes with a reptile ingredient get a 20% revenue bonus.
+    :param use_acquisition_costs: If True, ingredients are priced from `shard_acquisition_cost` (the cheaper of
+    buying and fusing them) instead of their raw buy price.
+    :param store: The recipes, if they are already loaded. They are read from the database otherwise.
+    :param products: The shard metadata, if it is already loaded. It is read from the database otherwise.
+    """
+    recipes: DataFrame = load_recipe_frame(db_connection) if store is None else store.to_frame()
+    if products is None:
+        products = load_product_frame(db_connection)
+    acquisition: Optional[DataFrame] = load_acquisition_frame(db_connection) if use_acquisition_costs else None
+    profit_frame: DataFrame = compute_profit_frame(recipes, load_bazaar_frame(db_connection), products,
+                                                   skip_empty_orders, cope_mode, acquisition,
+                                                   load_analytics_frame(db_connection))
+    write_profit_data(db_connection, format_profit_frame(profit_frame, products))
+    metrics.increment('rows_processed', recipes.height, stage='calculate_accurate_profit')
+
+
+@instrumented('update_profit_data')
+def update_profit_data(db_connection: Connection, changed_product_ids: Collection[str], skip_empty_orders: bool = True,
+                       cope_mode: bool = False, use_acquisition_costs: bool = False,
+                       store: Optional[RecipeStore] = None, products: Optional[DataFrame] = None) -> int:
+    """
+    Function to recompute only the profit rows affected by a set of changed bazaar products.
+    The affected recipes are found through the reverse indexes of the recipe store, recomputed against the current
+    bazaar snapshot and replaced in `shard_profit_data` in place, and their changes are recorded in the profit history.
+    If the table does not exist yet, every profit is calculated.
+
+    :param db_connection: The connection to the SQLite database containing the shard recipes.
+    :param changed_product_ids: The product IDs whose bazaar information changed, e.g. from `get_bazaar_information`.
+    :param skip_empty_orders: If True, it skips recipes with empty insta buy orders for ingredients.
+    :param cope_mode: If True, recipes with a reptile ingredient get a 20% revenue bonus.
+    :param use_acquisition_costs: If True, ingredients are priced from `shard_acquisition_cost` (the cheaper of
+    buying and fusing them) instead of their raw buy price. It must match the setting of the run that wrote the rows.
+    :param store: The recipes, if they are already loaded. They are read from the database otherwise.
+    :param products: The shard metadata, if it is already loaded. It is read from the database otherwise.
+    :return: The number of recipes that were recomputed.
+    """
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='shard_profit_data'")
+    if not cursor.fetchone():
+        calculate_accurate_profit(db_connection, skip_empty_orders, cope_mode, use_acquisition_costs, store, products)
+        cursor.execute("SELECT COUNT(*) FROM shard_recipes_processed")
+        return cursor.fetchone()[0]
+
+    if store is None:
+        store = RecipeStore.from_connection(db_connection)
+
+    positions: List[int] = store.recipes_referencing(changed_product_ids)
+    if not positions:
+        return 0
+
+    if products is None:
+        products = load_product_frame(db_connection)
+
+    acquisition: Optional[DataFrame] = load_acquisition_frame(db_connection) if use_acquisition_costs else None
+    profit_frame: DataFrame = compute_profit_frame(store.to_frame(positions), load_bazaar_frame(db_connection),
+                                                   products, skip_empty_orders, cope_mode, acquisition,
+                                                   load_analytics_frame(db_connection))
+
+    # Recipes that are no longer priced (e.g. their output left the bazaar) are removed along with the changed ones
+    cursor.executemany("DELETE FROM shard_profit_data WHERE recipe_id = ?",
+                       ((store.recipe_ids[position],) for position in positions))
+    profit_rows: DataFrame = format_profit_frame(profit_frame, products)
+    insert_profit_rows(cursor, profit_rows)
+    add_profit_history(cursor, profit_rows, [store.recipe_ids[position] for position in positions])
+    bump_profit_version(cursor)
     db_connection.commit()
+    metrics.increment('rows_processed', len(positions), stage='update_profit_data')
+    return len(positions)
@@ -2,9 +2,15 @@ from json import dump as json_dump, load as json_load
 from os import getenv
 import sqlite3
 from sqlite3 import Connection, Cursor
-from typing import Dict
+from time import time
+from typing import Dict, Iterable, Optional, Set, Tuple
 
-from requests import get, Response
+from requests import get, Response, Session
+
+from backend.scripts.metrics import instrumented, metrics
+from backend.scripts.order_book import store_order_books
+
+BAZAAR_URL: str = 'https://api.hypixel.net/v2/skyblock/bazaar'
 
 
 def dict_to_json(data: Dict, filename: str) -> None:
@@ -43,56 +49,88 @@ def json_to_dict(filename: str) -> Dict:
         return {}
 
 
-def get_bazaar_information(db_connection: Connection):
-    """
-    Function to fetch and store Bazaar information and store in the database.
+BAZAAR_COLUMN_DEFINITIONS: str = """
+    product_id       TEXT,
+    sell_price       REAL,
+    sell_volume      INTEGER,
+    sell_moving_week INTEGER,
+    sell_orders      INTEGER,
+    buy_price        REAL,
+    buy_volume       INTEGER,
+    buy_moving_week  INTEGER,
+    buy_orders       INTEGER
+"""
 
-    :param db_connection: The SQLite database connection to store the Bazaar information.
-    :return: Nothing
+PROFIT_COLUMNS: Tuple[str, ...] = ('buy_price', 'sell_volume', 'buy_orders')
+
+
+def read_bazaar_snapshot(db_connection: Connection, columns: Iterable[str] = PROFIT_COLUMNS) -> \
+        Dict[str, Tuple[float or int, ...]]:
     """
+    Function to read the stored Bazaar snapshot, keeping only the given columns.
 
+    :param db_connection: The SQLite database connection holding the Bazaar information.
+    :param columns: The `bazaar_info` columns to read for each product.
+    :return: A dictionary mapping each product ID to the tuple of its column values (empty if there is no snapshot).
+    """
     cursor: Cursor = db_connection.cursor()
-    cursor.execute("DROP TABLE IF EXISTS bazaar_info")
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='bazaar_info'")
+    if not cursor.fetchone():
+        return {}
 
-    hypixel_token: str = getenv('HYPIXEL_TOKEN')
-    if not hypixel_token:
-        response: Response = get('https://api.hypixel.net/v2/skyblock/bazaar')
+    cursor.execute(f"SELECT product_id, {', '.join(columns)} FROM bazaar_info")
+    return {row[0]: row[1:] for row in cursor.fetchall()}
 
-    else:
-        response: Response = get('https://api.hypixel.net/v2/skyblock/bazaar',
-                                 params={
-                                     'key': getenv('HYPIXEL_TOKEN'),
-                                 })
 
-    if response.status_code == 200:
-        data: Dict[str, str or float or int] = response.json()
+def diff_bazaar_snapshots(previous: Dict[str, Tuple], current: Dict[str, Tuple]) -> Set[str]:
+    """
+    Function to find the products whose values differ between two Bazaar snapshots.
+    Products that only appear in one of the snapshots count as changed.
 
-        data: Dict[str, str or float or int] = data['products']
-        for key in data.keys():
-            data[key] = data[key]['quick_status']
+    :param previous: The older snapshot, as returned by `read_bazaar_snapshot`.
+    :param current: The newer snapshot, as returned by `read_bazaar_snapshot`.
+    :return: The set of changed product IDs.
+    """
+    changed: Set[str] = set(previous.keys() ^ current.keys())
+    changed.update(product_id for product_id, values in current.items()
+                   if product_id in previous and previous[product_id] != values)
+    return changed
 
-        cursor.execute("""
-                       CREATE TABLE IF NOT EXISTS bazaar_info
-                       (
-                           product_id       TEXT PRIMARY KEY,
-                           sell_price       REAL,
-                           sell_volume      INTEGER,
-                           sell_moving_week INTEGER,
-                           sell_orders      INTEGER,
-                           buy_price        REAL,
-                           buy_volume       INTEGER,
-                           buy_moving_week  INTEGER,
-                           buy_orders       INTEGER
-                       )
-                       """)
 
-        for product in data.values():
-            cursor.execute("""
-                INSERT OR REPLACE INTO bazaar_info (
-                    product_id, sell_price, sell_volume, sell_moving_week, sell_orders,
-                    buy_price, buy_volume, buy_moving_week, buy_orders
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
+def store_bazaar_snapshot(db_connection: Connection, products: Iterable[Dict[str, str or float or int]],
+                          fetched_at: Optional[int] = None, keep_snapshots: int = 0) -> None:
+    """
+    Function to replace the stored Bazaar information with a new snapshot in a single transaction.
+    The rows are staged in a temporary table with one `executemany` and then swapped into `bazaar_info`. The database
+    runs in WAL mode, so readers keep seeing the previous snapshot until the swap is committed and never an empty or
+    partially filled table.
+
+    :param db_connection: The SQLite database connection to store the Bazaar information.
+    :param products: The `quick_status` of every product, as returned by the Bazaar endpoint.
+    :param fetched_at: The fetch time of the snapshot in milliseconds since the epoch. Defaults to now.
+    :param keep_snapshots: How many snapshots to keep in the `bazaar_snapshots` history ring. 0 disables the ring.
+    :return: Nothing
+    """
+    if fetched_at is None:
+        fetched_at = int(time() * 1000)
+
+    cursor: Cursor = db_connection.cursor()
+    if not db_connection.in_transaction:
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"""
+                   CREATE TEMP TABLE IF NOT EXISTS bazaar_info_staging
+                   ({BAZAAR_COLUMN_DEFINITIONS}, PRIMARY KEY (product_id))
+                   """)
+
+    with db_connection:
+        cursor.execute("DELETE FROM bazaar_info_staging")
+        cursor.executemany("""
+            INSERT OR REPLACE INTO bazaar_info_staging (
+                product_id, sell_price, sell_volume, sell_moving_week, sell_orders,
+                buy_price, buy_volume, buy_moving_week, buy_orders
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            (
                 product['productId'],
                 product['sellPrice'],
                 product['sellVolume'],
@@ -102,9 +140,108 @@ def get_bazaar_information(db_connection: Connection):
                 product['buyVolume'],
                 product['buyMovingWeek'],
                 product['buyOrders']
-            ))
-        db_connection.commit()
+            )
+            for product in products
+        ))
+
+        cursor.execute(f"""
+                       CREATE TABLE IF NOT EXISTS bazaar_info
+                       ({BAZAAR_COLUMN_DEFINITIONS}, PRIMARY KEY (product_id))
+                       """)
+        cursor.execute("DELETE FROM bazaar_info")
+        cursor.execute("INSERT INTO bazaar_info SELECT * FROM bazaar_info_staging")
+
+        if keep_snapshots > 0:
+            cursor.execute(f"""
+                           CREATE TABLE IF NOT EXISTS bazaar_snapshots
+                           (
+                               fetched_at INTEGER,
+                               {BAZAAR_COLUMN_DEFINITIONS},
+                               PRIMARY KEY (fetched_at, product_id)
+                           ) WITHOUT ROWID
+                           """)
+            cursor.execute("INSERT OR REPLACE INTO bazaar_snapshots SELECT ?, * FROM bazaar_info_staging",
+                           (fetched_at,))
+            cursor.execute("""
+                           DELETE
+                           FROM bazaar_snapshots
+                           WHERE fetched_at NOT IN (SELECT DISTINCT fetched_at
+                                                    FROM bazaar_snapshots
+                                                    ORDER BY fetched_at DESC
+                                                    LIMIT ?)
+                           """, (keep_snapshots,))
+
+
+def fetch_bazaar_data(session: Optional[Session] = None, etag: Optional[str] = None, url: str = BAZAAR_URL) -> \
+        Tuple[Optional[Dict[str, str or float or int]], Optional[str]]:
+    """
+    Function to request the Bazaar endpoint, as a conditional request if an ETag from a previous response is given.
+
+    :param session: The HTTP session to reuse between requests. A one-off request is made if it is not given.
+    :param etag: The ETag of the last payload that was processed.
+    :param url: The URL of the Bazaar endpoint.
+    :return: The payload (None if it did not change since the given ETag or if the request failed) and the ETag of
+    the response (the given one if the payload did not change).
+    """
+    hypixel_token: str = getenv('HYPIXEL_TOKEN')
+    params: Dict[str, str] = {'key': hypixel_token} if hypixel_token else {}
+    headers: Dict[str, str] = {'If-None-Match': etag} if etag else {}
+
+    with metrics.timer('http_request_seconds', endpoint='bazaar'):
+        response: Response = (session.get if session else get)(url, params=params, headers=headers)
+    metrics.increment('http_responses', endpoint='bazaar', status=str(response.status_code))
+
+    if response.status_code == 304:
+        return None, etag
+
+    if response.status_code == 200:
+        return response.json(), response.headers.get('ETag')
+
+    print(f'An error occurred with the request\n'
+          f'{response.status_code}')
+    return None, etag
+
+
+@instrumented('get_bazaar_information')
+def get_bazaar_information(db_connection: Connection, tracked_columns: Iterable[str] = PROFIT_COLUMNS,
+                           keep_snapshots: int = 0, url: str = BAZAAR_URL) -> Set[str]:
+    """
+    Function to fetch and store Bazaar information and store in the database.
+
+    :param db_connection: The SQLite database connection to store the Bazaar information.
+    :param tracked_columns: The `bazaar_info` columns compared against the previous snapshot. By default, only the
+    columns the profit calculation reads are tracked.
+    :param keep_snapshots: How many snapshots to keep in the `bazaar_snapshots` history ring. 0 disables the ring.
+    :param url: The URL of the Bazaar endpoint.
+    :return: The product IDs whose tracked columns changed since the previous snapshot (every product if there was
+    no previous snapshot, none if the request failed).
+    """
+    data, _ = fetch_bazaar_data(url=url)
+    if data is None:
+        return set()
+
+    return store_bazaar_data(db_connection, data, tracked_columns, keep_snapshots)
+
+
+@instrumented('store_bazaar_data')
+def store_bazaar_data(db_connection: Connection, data: Dict[str, str or float or int],
+                      tracked_columns: Iterable[str] = PROFIT_COLUMNS, keep_snapshots: int = 0) -> Set[str]:
+    """
+    Function to store a Bazaar payload as the current snapshot, along with its order books, and report which products
+    changed.
+
+    :param db_connection: The SQLite database connection to store the Bazaar information.
+    :param data: The payload returned by the Bazaar endpoint.
+    :param tracked_columns: The `bazaar_info` columns compared against the previous snapshot.
+    :param keep_snapshots: How many snapshots to keep in the `bazaar_snapshots` history ring. 0 disables the ring.
+    :return: The product IDs whose tracked columns changed since the previous snapshot.
+    """
+    tracked_columns = tuple(tracked_columns)
+    previous_snapshot: Dict[str, Tuple] = read_bazaar_snapshot(db_connection, tracked_columns)
+
+    store_bazaar_snapshot(db_connection, (product['quick_status'] for product in data['products'].values()),
+                          keep_snapshots=keep_snapshots)
+    store_order_books(db_connection, data['products'])
+    metrics.increment('rows_processed', len(data['products']), stage='store_bazaar_data')
 
-    else:
-        print(f'An error occurred with the request\n'
-              f'{response.status_code}')
+    return diff_bazaar_snapshots(previous_snapshot, read_bazaar_snapshot(db_connection, tracked_columns))
@@ -1,91 +1,214 @@
-import datetime
+import asyncio
 import sqlite3
 import time
-from typing import Dict, List
+from typing import Dict, List, Optional, Set, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from backend.scripts.metrics import instrumented, metrics, store_metrics
+from backend.scripts.price_analytics import update_price_analytics
+from backend.scripts.price_history import RAW, create_price_history_tables, parse_timestamp, store_price_points
+from backend.scripts.schema import migrate_database
+
+COFLNET_URL: str = 'https://sky.coflnet.com'
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Asynchronous token bucket limiting how many requests are started per second.
+    The bucket holds up to `capacity` tokens and refills at `rate` tokens per second, so short bursts are allowed
+    while the average rate stays bounded.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate: float = rate
+        self.capacity: int = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+        self.lock: asyncio.Lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """
+        Wait until a token is available and consume it.
+
+        :return: None
+        """
+        async with self.lock:
+            while True:
+                now: float = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def create_session(max_connections: int) -> requests.Session:
+    """
+    Function to create an HTTP session whose keep-alive connection pool is large enough for every concurrent request.
+
+    :param max_connections: The maximum number of connections kept open to the API.
+    :return: The session.
+    """
+    session: requests.Session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_connections))
+    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=max_connections))
+    session.headers['accept'] = 'text/plain'
+    return session
+
+
+async def fetch_product_history(session: requests.Session, product_id: str, bucket: TokenBucket,
+                                semaphore: asyncio.Semaphore, base_url: str = COFLNET_URL, max_retries: int = 3,
+                                backoff: float = 1.0) -> List[Dict[str, float or str]]:
+    """
+    Function to fetch the week history of a single product, retrying with exponential backoff on network errors,
+    rate limiting and server errors.
+
+    :param session: The HTTP session used for the request.
+    :param product_id: The bazaar product ID.
+    :param bucket: The token bucket shared by every request.
+    :param semaphore: The semaphore capping the number of requests in flight.
+    :param base_url: The base URL of the Coflnet API.
+    :param max_retries: The number of retries after the first attempt.
+    :param backoff: The delay before the first retry, in seconds. It doubles on every retry.
+    :return: The history entries returned by the API.
+    """
+    url: str = f'{base_url}/api/bazaar/{product_id}/history/week'
+
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+        try:
+            async with semaphore:
+                with metrics.timer('http_request_seconds', endpoint='coflnet'):
+                    response: requests.Response = await asyncio.to_thread(session.get, url, timeout=30)
+            metrics.increment('http_responses', endpoint='coflnet', status=str(response.status_code))
+
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                response.raise_for_status()
+                return response.json()
 
+            error: Exception = requests.HTTPError(f'{response.status_code} for {url}', response=response)
 
-def get_product_data(db_connection: sqlite3.Connection) -> None:
+        except requests.HTTPError:
+            raise
+
+        except requests.RequestException as e:
+            error = e
+
+        if attempt == max_retries:
+            raise error
+
+        metrics.increment('http_retries', endpoint='coflnet')
+        await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def fetch_product_histories(product_ids: List[str], base_url: str = COFLNET_URL,
+                                  requests_per_second: float = 5.0, max_concurrency: int = 8, max_retries: int = 3,
+                                  backoff: float = 1.0) -> \
+        Tuple[Dict[str, List[Dict[str, float or str]]], Dict[str, Exception]]:
+    """
+    Function to fetch the week history of many products concurrently.
+    A failure for one product never stops the others, it is reported next to the successful results instead.
+
+    :param product_ids: The bazaar product IDs to fetch.
+    :param base_url: The base URL of the Coflnet API.
+    :param requests_per_second: The average number of requests started per second.
+    :param max_concurrency: The maximum number of requests in flight at the same time.
+    :param max_retries: The number of retries for each product after the first attempt.
+    :param backoff: The delay before the first retry, in seconds. It doubles on every retry.
+    :return: A tuple with the history entries by product ID and the errors by product ID.
+    """
+    bucket: TokenBucket = TokenBucket(requests_per_second, max(1, min(max_concurrency, int(requests_per_second))))
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(max_concurrency)
+
+    with create_session(max_concurrency) as session:
+        results: List[List[Dict] or BaseException] = await asyncio.gather(
+            *(fetch_product_history(session, product_id, bucket, semaphore, base_url, max_retries, backoff)
+              for product_id in product_ids),
+            return_exceptions=True
+        )
+
+    histories: Dict[str, List[Dict[str, float or str]]] = {}
+    failures: Dict[str, Exception] = {}
+    for product_id, result in zip(product_ids, results):
+        if isinstance(result, Exception):
+            failures[product_id] = result
+        else:
+            histories[product_id] = result
+
+    return histories, failures
+
+
+@instrumented('get_product_data')
+def get_product_data(db_connection: sqlite3.Connection, base_url: str = COFLNET_URL,
+                     requests_per_second: float = 5.0, max_concurrency: int = 8, max_retries: int = 3,
+                     backoff: float = 1.0) -> None:
+    """
+    Function to fetch the week price history of every shard and store it in `price_history_points`, rolled up and
+    trimmed by the retention policies of the `price_history` module, then update the price analytics of the shards
+    that got new points.
+
+    :param db_connection: The SQLite database connection holding the shard information.
+    :param base_url: The base URL of the Coflnet API.
+    :param requests_per_second: The average number of requests started per second.
+    :param max_concurrency: The maximum number of requests in flight at the same time.
+    :param max_retries: The number of retries for each product after the first attempt.
+    :param backoff: The delay before the first retry, in seconds. It doubles on every retry.
+    :return: None
+    """
+    migrate_database(db_connection)
     cursor = db_connection.cursor()
 
     # Select all the product_ids from the shard_to_productid table
     cursor.execute('SELECT productID FROM shard_to_productid')
     product_ids: List[str] = [row[0] for row in cursor.fetchall()]
 
-    cursor.execute('''
-                   CREATE TABLE IF NOT EXISTS product_price_history
-                   (
-                       product_id TEXT,
-                       buy_price  REAL,
-                       sell_price REAL,
-                       timestamp  TEXT,
-                       PRIMARY KEY (product_id, timestamp)
-                   )
-                   ''')
-
-    cursor.execute('''
-                   SELECT MAX(timestamp)
-                   FROM product_price_history
-                   ''')
-    last_timestamp = cursor.fetchone()[0]
-
-    if last_timestamp:
-        # Parse ISO string and set UTC-6 timezone
-        dt = datetime.datetime.fromisoformat(last_timestamp)
-        utc_minus_6 = datetime.timezone(datetime.timedelta(hours=-6))
-        dt = dt.replace(tzinfo=utc_minus_6)
-        last_timestamp_local = int(dt.timestamp())
-
-        # Get current time in UTC-6
-        now_utc = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-        now_local = now_utc.astimezone(utc_minus_6)
-        current_time_local = int(now_local.timestamp())
-
-        if current_time_local - last_timestamp_local < 7200:
-            print("Data is already up to date. Exiting.")
-            return
-
-    for product_id in product_ids:
-        try:
-            product_data = requests.get(
-                f'https://sky.coflnet.com/api/bazaar/{product_id}/history/week',
-                headers={
-                    'accept': 'text/plain'
-                }
-            ).json()
+    create_price_history_tables(cursor)
 
-        except requests.RequestException as e:
-            print(f"Error fetching data for product {product_id}: {e}")
-            continue
+    cursor.execute('SELECT MAX(bucket) FROM price_history_points WHERE resolution = ?', (RAW,))
+    last_timestamp: Optional[int] = cursor.fetchone()[0]
+
+    if last_timestamp and time.time() - last_timestamp < 7200:
+        print("Data is already up to date. Exiting.")
+        return
+
+    histories, failures = asyncio.run(fetch_product_histories(product_ids, base_url, requests_per_second,
+                                                              max_concurrency, max_retries, backoff))
 
-        filtered_data: Dict[str, List[float or str]] = {
-            'buy': [],
-            'sell': [],
-            'timestamp': []
-        }
+    for product_id, error in failures.items():
+        print(f"Error fetching data for product {product_id}: {error}")
+    metrics.increment('fetch_failures', len(failures), stage='get_product_data')
 
+    points: List[Tuple[str, int, float, float]] = []
+    skipped: int = 0
+    for product_id, product_data in histories.items():
         for entry in product_data:
 
             if entry.get('buy') is None or entry.get('sell') is None:
-                print(
-                    f"Skipping entry with missing buy or sell price for product {product_id} at timestamp {entry['timestamp']}")
+                skipped += 1
                 continue
 
-            filtered_data['buy'].append(entry['buy'])
-            filtered_data['sell'].append(entry['sell'])
-            filtered_data['timestamp'].append(entry['timestamp'])
+            points.append((product_id, parse_timestamp(entry['timestamp']), entry['buy'], entry['sell']))
 
-        for i in range(len(filtered_data['timestamp'])):
-            cursor.execute('''
-                           INSERT OR IGNORE INTO product_price_history (product_id, buy_price, sell_price, timestamp)
-                           VALUES (?, ?, ?, ?)
-                           ''', (product_id, filtered_data['buy'][i], filtered_data['sell'][i],
-                                 filtered_data['timestamp'][i]))
+    metrics.increment('rows_processed', len(points), stage='get_product_data')
+    metrics.increment('rows_skipped', skipped, stage='get_product_data', reason='missing_price')
+    if skipped:
+        print(f'Skipped {skipped} entries with a missing buy or sell price')
 
-        time.sleep(1)  # To avoid hitting the API too hard
+    stored: int = store_price_points(db_connection, points)
+    print(f'{stored} new price points stored')
 
-    db_connection.commit()
+    analysed: Set[str] = update_price_analytics(db_connection)
+    print(f'Price analytics updated for {len(analysed)} products')
 
 
-get_product_data(sqlite3.connect('shard_recipes.db'))
+if __name__ == '__main__':
+    sqlite_connection: sqlite3.Connection = sqlite3.connect('shard_recipes.db')
+    get_product_data(sqlite_connection)
+    store_metrics(sqlite_connection)
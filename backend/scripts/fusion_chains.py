@@ -0,0 +1,204 @@
+from math import floor, inf
+from sqlite3 import Connection
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from polars import DataFrame, col
+
+from backend.scripts.calculate_profits import load_bazaar_frame
+from backend.scripts.metrics import instrumented
+from backend.scripts.recipe_store import RecipeStore
+
+# Per-unit cost of every interned product, and the position of the recipe used to make it (-1 when it is bought)
+ProductionCosts = Tuple[List[float], List[int]]
+
+
+def load_buy_prices(bazaar: DataFrame, skip_empty_orders: bool = True) -> Dict[str, float]:
+    """
+    Function to extract the price paid to insta-buy each product from a bazaar snapshot.
+
+    :param bazaar: The bazaar snapshot, as returned by `load_bazaar_frame`.
+    :param skip_empty_orders: If True, products without buy orders are considered impossible to buy, like the profit
+    calculation does.
+    :return: A dictionary mapping each buyable product ID to its buy price.
+    """
+    if skip_empty_orders:
+        bazaar = bazaar.filter(col('buy_orders') != 0)
+    bazaar = bazaar.filter(col('buy_price').is_not_null())
+    return dict(zip(bazaar['product_id'].to_list(), bazaar['buy_price'].to_list()))
+
+
+def relax_production_costs(store: RecipeStore, buy_prices: Dict[str, float], max_depth: Optional[int] = None) -> \
+        List[ProductionCosts]:
+    """
+    Function to compute the cheapest way to obtain every product using chains of at most `max_depth` fusions.
+
+    This is a Bellman-Ford style relaxation: round k prices every recipe with the costs of round k - 1 and keeps the
+    cheaper of buying and fusing. Only recipes with an ingredient that got cheaper in the previous round are priced
+    again, and the relaxation stops as soon as a round changes nothing.
+
+    :param store: The recipes.
+    :param buy_prices: The price of every buyable product, as returned by `load_buy_prices`.
+    :param max_depth: The maximum number of chained fusions. If not given, it runs until no cost changes (capped at
+    one round per product, since a loop of fusions that multiplies value would never settle).
+    :return: For each depth from 0 (buy only) onwards, the per-unit cost of every interned product and the position
+    of the recipe used to make it.
+    """
+    quantities_1, ingredients_1 = store.quantity_1, store.ingredient_1
+    quantities_2, ingredients_2 = store.quantity_2, store.ingredient_2
+    output_quantities, outputs = store.output_quantity, store.output_item
+
+    costs: List[float] = [buy_prices.get(product_id, inf) for product_id in store.product_ids]
+    via: List[int] = [-1] * len(costs)
+    rounds: List[ProductionCosts] = [(costs, via)]
+
+    if max_depth is None:
+        max_depth = len(store.product_ids)
+
+    candidates: Iterable[int] = range(len(store))
+    for _ in range(max_depth):
+        previous: List[float] = costs
+        costs, via = list(costs), list(via)
+        improved: Set[int] = set()
+
+        for position in candidates:
+            if output_quantities[position] <= 0:
+                continue
+
+            unit_cost: float = (quantities_1[position] * previous[ingredients_1[position]] +
+                                quantities_2[position] * previous[ingredients_2[position]]) / \
+                output_quantities[position]
+
+            if unit_cost < costs[outputs[position]]:
+                costs[outputs[position]] = unit_cost
+                via[outputs[position]] = position
+                improved.add(outputs[position])
+
+        if not improved:
+            break
+
+        rounds.append((costs, via))
+        candidates = {position for product in improved for position in
+                      store.by_ingredient[store.by_ingredient_offsets[product]:
+                                          store.by_ingredient_offsets[product + 1]]}
+
+    return rounds
+
+
+def expand_chain(position: int, depth: int, store: RecipeStore, rounds: List[ProductionCosts]) -> \
+        Dict[str, str or int or float or List]:
+    """
+    Function to turn a recipe and the relaxation rounds into a tree of fusion steps.
+
+    :param position: The position of the recipe of the last step in the store.
+    :param depth: The number of fusions still allowed, including this one.
+    :param store: The recipes.
+    :param rounds: The relaxation rounds, as returned by `relax_production_costs`.
+    :return: The step, whose ingredients are either bought or made by a nested step.
+    """
+    costs, via = rounds[min(depth - 1, len(rounds) - 1)]
+
+    ingredients: List[Dict[str, str or int or float or Dict]] = []
+    for quantity, ingredient in ((store.quantity_1[position], store.ingredient_1[position]),
+                                 (store.quantity_2[position], store.ingredient_2[position])):
+        ingredients.append({
+            'product_id': store.product_ids[ingredient],
+            'amount': quantity,
+            'unit_cost': costs[ingredient],
+            'source': 'buy' if via[ingredient] < 0 else expand_chain(via[ingredient], depth - 1, store, rounds)
+        })
+
+    return {
+        'recipe_id': store.recipe_ids[position],
+        'output_item': store.product_ids[store.output_item[position]],
+        'output_quantity': store.output_quantity[position],
+        'ingredients': ingredients
+    }
+
+
+def chain_depth(step: Dict[str, str or int or float or List]) -> int:
+    """
+    Function to count the number of chained fusions in a step tree.
+
+    :param step: The step, as returned by `expand_chain`.
+    :return: The length of the longest branch, in fusions.
+    """
+    return 1 + max((chain_depth(ingredient['source']) for ingredient in step['ingredients']
+                    if ingredient['source'] != 'buy'), default=0)
+
+
+def describe_chain(step: Dict[str, str or int or float or List]) -> str:
+    """
+    Function to write a step tree on one line, e.g. '2x SHARD_C = 1x SHARD_A + 3x (1x SHARD_B = 2x SHARD_D + ...)'.
+
+    :param step: The step, as returned by `expand_chain`.
+    :return: The output of the step and what it is fused from, with the ingredients made by a nested step in brackets.
+    """
+    ingredients: List[str] = [f"{ingredient['amount']}x {ingredient['product_id']}" if ingredient['source'] == 'buy'
+                              else f"{ingredient['amount']}x ({describe_chain(ingredient['source'])})"
+                              for ingredient in step['ingredients']]
+    return f"{step['output_quantity']}x {step['output_item']} = {' + '.join(ingredients)}"
+
+
+def find_profitable_chains(store: RecipeStore, bazaar: DataFrame, max_depth: int = 3, top_n: int = 50,
+                           skip_empty_orders: bool = True) -> List[Dict[str, str or int or float or List]]:
+    """
+    Function to find the most profitable fusion chains of at most `max_depth` fusions.
+    Each chain ends with a recipe whose output is sold at its bazaar price, and every ingredient is either bought or
+    made by the cheapest chain of the remaining depth.
+
+    :param store: The recipes.
+    :param bazaar: The bazaar snapshot, as returned by `load_bazaar_frame`.
+    :param max_depth: The maximum number of chained fusions.
+    :param top_n: The number of chains to return.
+    :param skip_empty_orders: If True, products without buy orders cannot be bought.
+    :return: The chains sorted by profit, each with its profit, depth and step tree.
+    """
+    bazaar_prices: Dict[str, float] = dict(zip(bazaar['product_id'].to_list(), bazaar['buy_price'].to_list()))
+    sell_prices: List[Optional[float]] = [bazaar_prices.get(product_id) for product_id in store.product_ids]
+    rounds: List[ProductionCosts] = relax_production_costs(store, load_buy_prices(bazaar, skip_empty_orders),
+                                                           max_depth - 1)
+    costs, _ = rounds[-1]
+
+    scored: List[Tuple[float, int]] = []
+    for position in range(len(store)):
+        sell_price: Optional[float] = sell_prices[store.output_item[position]]
+        if sell_price is None:
+            continue
+
+        cost: float = store.quantity_1[position] * costs[store.ingredient_1[position]] + \
+            store.quantity_2[position] * costs[store.ingredient_2[position]]
+        if cost < inf:
+            scored.append((sell_price * store.output_quantity[position] - cost, position))
+
+    scored.sort(reverse=True)
+
+    chains: List[Dict[str, str or int or float or List]] = []
+    for profit, position in scored[:top_n]:
+        step: Dict[str, str or int or float or List] = expand_chain(position, len(rounds), store, rounds)
+        chains.append({
+            'profit': floor(profit),
+            'depth': chain_depth(step),
+            'chain': step
+        })
+
+    return chains
+
+
+@instrumented('calculate_chain_profits')
+def calculate_chain_profits(db_connection: Connection, max_depth: int = 3, top_n: int = 50,
+                            skip_empty_orders: bool = True, store: Optional[RecipeStore] = None) -> \
+        List[Dict[str, str or int or float or List]]:
+    """
+    Function to find the most profitable fusion chains using the recipes and bazaar data stored in the database.
+
+    :param db_connection: The connection to the SQLite database containing the shard recipes and bazaar data.
+    :param max_depth: The maximum number of chained fusions.
+    :param top_n: The number of chains to return.
+    :param skip_empty_orders: If True, products without buy orders cannot be bought.
+    :param store: The recipes, if they are already loaded. They are read from the database otherwise.
+    :return: The chains sorted by profit, as returned by `find_profitable_chains`.
+    """
+    if store is None:
+        store = RecipeStore.from_connection(db_connection)
+
+    return find_profitable_chains(store, load_bazaar_frame(db_connection), max_depth, top_n, skip_empty_orders)
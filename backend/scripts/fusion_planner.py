@@ -0,0 +1,173 @@
+from heapq import heapify, heappop, heappush
+from math import floor, inf
+from sqlite3 import Connection
+from typing import Dict, List, Optional, Tuple
+
+from polars import DataFrame, Float64, Int64, List as ListType, Struct, Utf8, col
+
+from backend.scripts.calculate_profits import fetch_frame, load_bazaar_frame
+from backend.scripts.metrics import instrumented
+from backend.scripts.recipe_store import RecipeStore
+
+# What one fusion of a recipe needs: (interned product, quantity, cost of one bought unit)
+Needs = List[Tuple[int, int, float]]
+
+INGREDIENTS_DTYPE = ListType(Struct({'name': Utf8, 'amount': Int64, 'cost': Float64}))
+
+
+def load_recipe_costs(db_connection: Connection) -> DataFrame:
+    """
+    Function to load the per-fusion profit of every recipe from `shard_profit_data`, with the cost of each of its
+    ingredients.
+
+    :param db_connection: The connection to the SQLite database containing the `shard_profit_data` table.
+    :return: A DataFrame with the recipe ID, profit, total cost and the cost of each ingredient of every recipe.
+    """
+    return (
+        fetch_frame(db_connection, 'SELECT recipe_id, profit, cost, ingredients FROM shard_profit_data',
+                    {'recipe_id': Int64, 'profit': Float64, 'cost': Float64, 'ingredients': Utf8})
+        .with_columns(col('ingredients').str.json_decode(INGREDIENTS_DTYPE))
+        .select(
+            'recipe_id',
+            'profit',
+            'cost',
+            col('ingredients').list.get(0).struct.field('cost').alias('cost_1'),
+            col('ingredients').list.get(1).struct.field('cost').alias('cost_2')
+        )
+    )
+
+
+def plan_fusions(store: RecipeStore, costs: DataFrame, bazaar: DataFrame, budget: float,
+                 held: Optional[Dict[str, int]] = None) -> List[Dict[str, str or int]]:
+    """
+    Function to choose how many times to run each recipe to make the most profit with a coin budget.
+
+    Ingredients are taken from the held shards first, which cost nothing, and bought otherwise, at most `buy_volume`
+    units of each product across all recipes. At most `sell_volume` units of each output are sold across all recipes.
+    Recipes are chosen greedily by profit per coin spent, in batches of fusions that all have the same marginal cost.
+    Using up held shards, bazaar volume or coins can only make the next fusions of a recipe worse, so the priority
+    of a recipe is only recomputed when it comes out of the heap, and it is put back if it dropped.
+
+    :param store: The recipes.
+    :param costs: The per-fusion profit and ingredient costs, as returned by `load_recipe_costs`.
+    :param bazaar: The bazaar snapshot, as returned by `load_bazaar_frame`.
+    :param budget: The coins that can be spent on ingredients.
+    :param held: The number of shards held, by product ID.
+    :return: The recipes to run, most profitable first, each with the number of fusions, the coins spent on them and
+    their profit.
+    """
+    held = held or {}
+    volumes: Dict[str, Tuple[Optional[int], Optional[int]]] = {
+        product_id: (buy_volume, sell_volume)
+        for product_id, buy_volume, sell_volume in bazaar.select('product_id', 'buy_volume', 'sell_volume').iter_rows()
+    }
+    buy_left: List[int] = [volumes.get(product_id, (0, 0))[0] or 0 for product_id in store.product_ids]
+    sell_left: List[int] = [volumes.get(product_id, (0, 0))[1] or 0 for product_id in store.product_ids]
+    held_left: List[int] = [held.get(product_id, 0) for product_id in store.product_ids]
+    coins_left: float = budget
+
+    positions: Dict[int, int] = {recipe_id: position for position, recipe_id in enumerate(store.recipe_ids)}
+    recipes: List[Tuple[int, float, Needs]] = []
+    for recipe_id, profit, cost, cost_1, cost_2 in costs.iter_rows():
+        position: Optional[int] = positions.get(recipe_id)
+        if position is None or profit is None or cost_1 is None or cost_2 is None:
+            continue
+
+        needs: Dict[int, List[float]] = {}
+        for quantity, ingredient, ingredient_cost in ((store.quantity_1[position], store.ingredient_1[position],
+                                                       cost_1),
+                                                      (store.quantity_2[position], store.ingredient_2[position],
+                                                       cost_2)):
+            need: List[float] = needs.setdefault(ingredient, [0, 0.0])
+            need[0] += quantity
+            need[1] += ingredient_cost
+        recipes.append((position, profit + cost, [(product, int(quantity), ingredient_cost / quantity)
+                                                  for product, (quantity, ingredient_cost) in needs.items()
+                                                  if quantity > 0]))
+
+    # The marginal profit and coin cost of the next fusion of a recipe, and how many fusions in a row keep them
+    def next_batch(index: int) -> Optional[Tuple[float, float, int]]:
+        position, revenue, needs = recipes[index]
+        batch: int = sell_left[store.output_item[position]] // max(store.output_quantity[position], 1)
+        coins: float = 0.0
+        for product, quantity, unit_cost in needs:
+            if held_left[product] >= quantity:
+                batch = min(batch, held_left[product] // quantity)
+                continue
+
+            bought: int = quantity - held_left[product]
+            if bought > buy_left[product]:
+                return None
+            coins += bought * unit_cost
+            # The fusion using up the last held shards costs less than the ones after it, so it is taken on its own
+            batch = min(batch, 1 if held_left[product] else buy_left[product] // quantity)
+
+        if coins > 0:
+            batch = min(batch, int(coins_left // coins))
+        if batch <= 0 or revenue - coins <= 0:
+            return None
+        return revenue - coins, coins, batch
+
+    def priority(profit: float, coins: float) -> float:
+        return profit / coins if coins > 0 else inf
+
+    heap: List[Tuple[float, int]] = []
+    for index in range(len(recipes)):
+        batch: Optional[Tuple[float, float, int]] = next_batch(index)
+        if batch is not None:
+            heap.append((-priority(*batch[:2]), index))
+    heapify(heap)
+
+    # Fusions, coins spent and profit of every planned recipe
+    planned: Dict[int, List[float]] = {}
+    while heap:
+        key, index = heappop(heap)
+        batch = next_batch(index)
+        if batch is None:
+            continue
+
+        profit, coins, fusions = batch
+        if priority(profit, coins) < -key:
+            heappush(heap, (-priority(profit, coins), index))
+            continue
+
+        position, _, needs = recipes[index]
+        for product, quantity, _ in needs:
+            from_held: int = min(held_left[product], quantity * fusions)
+            held_left[product] -= from_held
+            buy_left[product] -= quantity * fusions - from_held
+        sell_left[store.output_item[position]] -= store.output_quantity[position] * fusions
+        coins_left -= coins * fusions
+
+        plan: List[float] = planned.setdefault(index, [0, 0.0, 0.0])
+        plan[0] += fusions
+        plan[1] += coins * fusions
+        plan[2] += profit * fusions
+        heappush(heap, (key, index))
+
+    return sorted(({
+        'recipe_id': store.recipe_ids[recipes[index][0]],
+        'output_item': store.product_ids[store.output_item[recipes[index][0]]],
+        'fusions': int(fusions),
+        'cost': floor(coins),
+        'profit': floor(profit)
+    } for index, (fusions, coins, profit) in planned.items()), key=lambda step: step['profit'], reverse=True)
+
+
+@instrumented('plan_fusions')
+def calculate_fusion_plan(db_connection: Connection, budget: float, held: Optional[Dict[str, int]] = None,
+                          store: Optional[RecipeStore] = None) -> List[Dict[str, str or int]]:
+    """
+    Function to plan the most profitable fusions for a coin budget, using the profits stored by
+    `calculate_accurate_profit` and the bazaar volumes.
+
+    :param db_connection: The connection to the SQLite database containing the shard recipes, profits and bazaar data.
+    :param budget: The coins that can be spent on ingredients.
+    :param held: The number of shards held, by product ID.
+    :param store: The recipes, if they are already loaded. They are read from the database otherwise.
+    :return: The recipes to run, as returned by `plan_fusions`.
+    """
+    if store is None:
+        store = RecipeStore.from_connection(db_connection)
+
+    return plan_fusions(store, load_recipe_costs(db_connection), load_bazaar_frame(db_connection), budget, held)
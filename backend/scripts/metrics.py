@@ -0,0 +1,221 @@
+from contextlib import contextmanager
+from functools import wraps
+from sqlite3 import Connection, Cursor
+from time import perf_counter, time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# A metric is identified by its name and its sorted (label, value) pairs
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+METRICS_TABLE: str = '''
+                     CREATE TABLE IF NOT EXISTS pipeline_metrics
+                     (
+                         recorded_at INTEGER NOT NULL,
+                         name        TEXT    NOT NULL,
+                         labels      TEXT    NOT NULL,
+                         count       INTEGER NOT NULL,
+                         total       REAL    NOT NULL,
+                         maximum     REAL,
+                         PRIMARY KEY (recorded_at, name, labels)
+                     ) WITHOUT ROWID
+                     '''
+
+
+class Metrics:
+    """
+    Aggregated counters and timers of the pipeline.
+
+    Nothing is recorded per row: a counter keeps the number of increments and their total, and a timer the number of
+    observations, their total and the longest one. Every value is aggregated twice: `counters` and `timers` accumulate
+    until `reset` and are written out by `write_exposition`, whose counters must never go back to zero, while
+    `pending_counters` and `pending_timers` only hold the values since the last `store_metrics` snapshot.
+    """
+
+    def __init__(self):
+        self.counters: Dict[MetricKey, List[float]] = {}
+        self.timers: Dict[MetricKey, List[float]] = {}
+        self.pending_counters: Dict[MetricKey, List[float]] = {}
+        self.pending_timers: Dict[MetricKey, List[float]] = {}
+
+    @staticmethod
+    def key(name: str, labels: Dict[str, str]) -> MetricKey:
+        """
+        The key of a metric.
+
+        :param name: The name of the metric.
+        :param labels: The labels of the metric.
+        :return: The name and the sorted labels.
+        """
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def increment(self, name: str, value: float = 1, **labels: str) -> None:
+        """
+        Add to a counter, e.g. `increment('rows_skipped', 12, stage='profits', reason='empty_buy_orders')`.
+
+        :param name: The name of the counter.
+        :param value: The amount to add.
+        :param labels: The labels of the counter.
+        :return: None
+        """
+        key: MetricKey = self.key(name, labels)
+        for counters in (self.counters, self.pending_counters):
+            counter: List[float] = counters.setdefault(key, [0, 0.0])
+            counter[0] += 1
+            counter[1] += value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        """
+        Record one duration of a timer.
+
+        :param name: The name of the timer.
+        :param seconds: The duration.
+        :param labels: The labels of the timer.
+        :return: None
+        """
+        key: MetricKey = self.key(name, labels)
+        for timers in (self.timers, self.pending_timers):
+            timer: List[float] = timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """
+        Context manager recording the wall time of its body in a timer, even if the body raises.
+
+        :param name: The name of the timer.
+        :param labels: The labels of the timer.
+        :return: None
+        """
+        start: float = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def reset(self) -> None:
+        """
+        Drop every recorded value.
+
+        :return: None
+        """
+        self.counters = {}
+        self.timers = {}
+        self.clear_pending()
+
+    def clear_pending(self) -> None:
+        """
+        Drop the values recorded since the last snapshot, keeping the accumulated ones.
+
+        :return: None
+        """
+        self.pending_counters = {}
+        self.pending_timers = {}
+
+    def rows(self) -> List[Tuple[str, str, int, float, Optional[float]]]:
+        """
+        The values recorded since the last snapshot, one row per counter and timer.
+
+        :return: Tuples of (name, labels as 'label=value,...', count, total, maximum). The maximum is None for
+        counters.
+        """
+        def labels(pairs: Tuple[Tuple[str, str], ...]) -> str:
+            return ','.join(f'{label}={value}' for label, value in pairs)
+
+        return sorted(
+            [(name, labels(pairs), int(count), total, None)
+             for (name, pairs), (count, total) in self.pending_counters.items()]
+            + [(name, labels(pairs), int(count), total, maximum)
+               for (name, pairs), (count, total, maximum) in self.pending_timers.items()]
+        )
+
+
+# The metrics of the current process, shared by every script
+metrics: Metrics = Metrics()
+
+
+def instrumented(stage: str) -> Callable[[Callable], Callable]:
+    """
+    Decorator recording every call of a pipeline stage in the `stage_seconds` timer.
+
+    :param stage: The name of the stage, used as the `stage` label.
+    :return: The decorator.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.timer('stage_seconds', stage=stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def store_metrics(db_connection: Connection, recorded_at: Optional[int] = None) -> int:
+    """
+    Function to append the metrics recorded since the previous snapshot to the `pipeline_metrics` table, as one
+    snapshot keyed by its time, and start the next snapshot from zero. Every snapshot gets its own time, even if two of
+    them are stored within a second, so none overwrites another.
+
+    :param db_connection: The SQLite database connection.
+    :param recorded_at: The time of the snapshot, in seconds since the epoch. Defaults to now.
+    :return: The number of rows written.
+    """
+    if recorded_at is None:
+        recorded_at = int(time())
+
+    rows: List[Tuple[str, str, int, float, Optional[float]]] = metrics.rows()
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute(METRICS_TABLE)
+
+    cursor.execute('SELECT MAX(recorded_at) FROM pipeline_metrics')
+    last_snapshot: Optional[int] = cursor.fetchone()[0]
+    if last_snapshot is not None:
+        recorded_at = max(recorded_at, last_snapshot + 1)
+
+    with db_connection:
+        cursor.executemany('''
+                           INSERT INTO pipeline_metrics (recorded_at, name, labels, count, total, maximum)
+                           VALUES (?, ?, ?, ?, ?, ?)
+                           ''', ((recorded_at, *row) for row in rows))
+    metrics.clear_pending()
+    return len(rows)
+
+
+def write_exposition(filename: str) -> None:
+    """
+    Function to write the metrics accumulated since the start of the process in the Prometheus text exposition format,
+    e.g. for the node exporter's textfile collector. Counters are written as `<name>_total`, and timers as
+    `<name>_count`, `<name>_sum` and `<name>_max`.
+
+    :param filename: The file to write.
+    :return: None
+    """
+    def labels(pairs: Tuple[Tuple[str, str], ...]) -> str:
+        escaped: str = ','.join(
+            '{}="{}"'.format(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for label, value in pairs
+        )
+        return f'{{{escaped}}}' if escaped else ''
+
+    lines: List[str] = []
+    for name in sorted({name for name, _ in metrics.counters}):
+        lines.append(f'# TYPE {name}_total counter')
+        lines.extend(f'{name}_total{labels(pairs)} {total}'
+                     for (counter, pairs), (_, total) in sorted(metrics.counters.items()) if counter == name)
+
+    for name in sorted({name for name, _ in metrics.timers}):
+        timers: List[Tuple[MetricKey, List[float]]] = [(key, value) for key, value in sorted(metrics.timers.items())
+                                                        if key[0] == name]
+        lines.append(f'# TYPE {name} summary')
+        for (_, pairs), (count, total, _) in timers:
+            lines.append(f'{name}_count{labels(pairs)} {int(count)}')
+            lines.append(f'{name}_sum{labels(pairs)} {total}')
+        lines.append(f'# TYPE {name}_max gauge')
+        lines.extend(f'{name}_max{labels(pairs)} {maximum}' for (_, pairs), (_, _, maximum) in timers)
+
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
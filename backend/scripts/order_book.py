@@ -0,0 +1,279 @@
+from array import array
+from bisect import bisect_left
+from sqlite3 import Connection, Cursor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from polars import DataFrame, Float64, Int64
+
+from backend.scripts.metrics import instrumented
+from backend.scripts.recipe_store import RecipeStore
+
+FILL_SCHEMA = {
+    'recipe_id': Int64,
+    'max_batch': Int64,
+    'batch_profit': Float64,
+    'first_fusion_profit': Float64,
+    'marginal_profit': Float64
+}
+
+
+class OrderBookSide:
+    """
+    One side of the order book of a product, as prefix sums over its price levels.
+
+    `depth[i]` is the number of items available in the first i + 1 levels and `totals[i]` what they are worth, so the
+    value of any quantity is one binary search plus a partial level.
+    """
+
+    def __init__(self, prices: array, amounts: array):
+        self.prices: array = prices
+        self.depth: array = array('d')
+        self.totals: array = array('d')
+
+        depth: float = 0.0
+        total: float = 0.0
+        for price, amount in zip(prices, amounts):
+            depth += amount
+            total += price * amount
+            self.depth.append(depth)
+            self.totals.append(total)
+
+    @classmethod
+    def from_blob(cls, blob: bytes) -> 'OrderBookSide':
+        """
+        Build a side from its packed levels, as written by `pack_levels`.
+
+        :param blob: The levels, as interleaved (price, amount) doubles.
+        :return: The side.
+        """
+        levels: array = array('d')
+        levels.frombytes(blob)
+        return cls(levels[0::2], levels[1::2])
+
+    def available(self) -> float:
+        """
+        The number of items listed on this side.
+
+        :return: The total amount of every level.
+        """
+        return self.depth[-1] if self.depth else 0.0
+
+    def value(self, quantity: float) -> Optional[float]:
+        """
+        The total price of filling a quantity by walking the levels in order.
+
+        :param quantity: The number of items to fill.
+        :return: The total price, or None if the side is not deep enough.
+        """
+        if quantity <= 0:
+            return 0.0
+        if quantity > self.available():
+            return None
+
+        level: int = bisect_left(self.depth, quantity)
+        filled: float = self.depth[level - 1] if level else 0.0
+        total: float = self.totals[level - 1] if level else 0.0
+        return total + (quantity - filled) * self.prices[level]
+
+
+def pack_levels(levels: Iterable[Dict[str, float or int]], descending: bool = False) -> bytes:
+    """
+    Function to pack the levels of one side of the order book into interleaved (price, amount) doubles.
+
+    :param levels: The levels, as returned in `buy_summary` or `sell_summary`.
+    :param descending: If True, the levels are sorted from the highest price (the order buy orders are filled in).
+    :return: The packed levels.
+    """
+    packed: array = array('d')
+    for level in sorted(levels, key=lambda entry: entry['pricePerUnit'], reverse=descending):
+        packed.append(level['pricePerUnit'])
+        packed.append(level['amount'])
+    return packed.tobytes()
+
+
+def store_order_books(db_connection: Connection, products: Dict[str, Dict]) -> None:
+    """
+    Function to replace the stored order books with the ones of a Bazaar payload.
+    Each side is stored as a single packed BLOB: the insta-buy side comes from `buy_summary` (sell offers, cheapest
+    first) and the insta-sell side from `sell_summary` (buy orders, highest first).
+
+    :param db_connection: The SQLite database connection.
+    :param products: The `products` of the Bazaar payload, by product ID.
+    :return: None
+    """
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS bazaar_order_book
+                   (
+                       product_id  TEXT PRIMARY KEY,
+                       buy_levels  BLOB NOT NULL,
+                       sell_levels BLOB NOT NULL
+                   )
+                   ''')
+
+    with db_connection:
+        cursor.execute('DELETE FROM bazaar_order_book')
+        cursor.executemany('''
+                           INSERT INTO bazaar_order_book (product_id, buy_levels, sell_levels)
+                           VALUES (?, ?, ?)
+                           ''', (
+            (
+                product_id,
+                pack_levels(product.get('buy_summary', ())),
+                pack_levels(product.get('sell_summary', ()), descending=True)
+            )
+            for product_id, product in products.items()
+        ))
+
+
+def load_order_books(db_connection: Connection) -> Dict[str, Tuple[OrderBookSide, OrderBookSide]]:
+    """
+    Function to load the stored order books.
+
+    :param db_connection: The SQLite database connection.
+    :return: A dictionary mapping each product ID to its insta-buy and insta-sell sides.
+    """
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute('SELECT product_id, buy_levels, sell_levels FROM bazaar_order_book')
+    return {product_id: (OrderBookSide.from_blob(buy_levels), OrderBookSide.from_blob(sell_levels))
+            for product_id, buy_levels, sell_levels in cursor.fetchall()}
+
+
+def batch_profit(batch: int, ingredients: List[Tuple[OrderBookSide, int]], output: Tuple[OrderBookSide, int]) -> \
+        Optional[float]:
+    """
+    Function to compute the profit of doing a batch of fusions, insta-buying every ingredient and insta-selling every
+    output through the order book.
+
+    :param batch: The number of fusions.
+    :param ingredients: The insta-buy side of each distinct ingredient and how many of it one fusion uses.
+    :param output: The insta-sell side of the output and how many of it one fusion makes.
+    :return: The profit, or None if the order book is not deep enough for the batch.
+    """
+    revenue: Optional[float] = output[0].value(batch * output[1])
+    if revenue is None:
+        return None
+
+    for side, quantity in ingredients:
+        cost: Optional[float] = side.value(batch * quantity)
+        if cost is None:
+            return None
+        revenue -= cost
+
+    return revenue
+
+
+def simulate_recipe(ingredients: List[Tuple[OrderBookSide, int]], output: Tuple[OrderBookSide, int]) -> \
+        Tuple[int, float, float, float]:
+    """
+    Function to find the largest profitable batch of a recipe.
+
+    Buying deeper into the book only gets more expensive and selling deeper only gets cheaper, so the profit of each
+    extra fusion never increases with the batch size. The largest batch whose last fusion is still profitable is
+    therefore found with a binary search.
+
+    :param ingredients: The insta-buy side of each distinct ingredient and how many of it one fusion uses.
+    Ingredients used zero times are ignored.
+    :param output: The insta-sell side of the output and how many of it one fusion makes.
+    :return: The largest profitable batch size (0 if even one fusion loses money or the recipe makes nothing), the
+    profit of that batch, the profit of the first fusion and the profit of the last fusion of the batch.
+    """
+    if output[1] <= 0:
+        return 0, 0.0, 0.0, 0.0
+
+    # An ingredient the recipe does not use never limits the batch, like in `fusion_planner`
+    ingredients = [(side, quantity) for side, quantity in ingredients if quantity > 0]
+
+    limit: float = output[0].available() / output[1]
+    for side, quantity in ingredients:
+        limit = min(limit, side.available() / quantity)
+
+    first: Optional[float] = batch_profit(1, ingredients, output) if limit >= 1 else None
+    if first is None or first <= 0:
+        return 0, 0.0, first if first is not None else 0.0, 0.0
+
+    # Invariant: the low-th fusion is profitable, and the (high + 1)-th is not or cannot be filled
+    low: int = 1
+    high: int = int(limit)
+    while low < high:
+        middle: int = (low + high + 1) // 2
+        if batch_profit(middle, ingredients, output) - batch_profit(middle - 1, ingredients, output) > 0:
+            low = middle
+        else:
+            high = middle - 1
+
+    total: float = batch_profit(low, ingredients, output)
+    return low, total, first, total - batch_profit(low - 1, ingredients, output)
+
+
+def compute_fill_simulation(store: RecipeStore, books: Dict[str, Tuple[OrderBookSide, OrderBookSide]]) -> DataFrame:
+    """
+    Function to simulate walking the order book for every recipe whose ingredients and output are on the Bazaar.
+
+    :param store: The recipes.
+    :param books: The order books, as returned by `load_order_books`.
+    :return: A DataFrame with one row per simulated recipe: the largest profitable batch, its profit, the profit of
+    the first fusion and the profit of the last fusion of the batch (the marginal profit).
+    """
+    buy_sides: List[Optional[OrderBookSide]] = [books[product_id][0] if product_id in books else None
+                                                for product_id in store.product_ids]
+    sell_sides: List[Optional[OrderBookSide]] = [books[product_id][1] if product_id in books else None
+                                                 for product_id in store.product_ids]
+
+    rows: List[Tuple[int, int, float, float, float]] = []
+    for position in range(len(store)):
+        ingredient_1, ingredient_2 = store.ingredient_1[position], store.ingredient_2[position]
+        output_side: Optional[OrderBookSide] = sell_sides[store.output_item[position]]
+        if output_side is None or buy_sides[ingredient_1] is None or buy_sides[ingredient_2] is None or \
+                store.output_quantity[position] <= 0:
+            continue
+
+        # Both ingredients are bought from the same book when they are the same shard
+        if ingredient_1 == ingredient_2:
+            ingredients: List[Tuple[OrderBookSide, int]] = [
+                (buy_sides[ingredient_1], store.quantity_1[position] + store.quantity_2[position])
+            ]
+        else:
+            ingredients = [(buy_sides[ingredient_1], store.quantity_1[position]),
+                           (buy_sides[ingredient_2], store.quantity_2[position])]
+
+        rows.append((store.recipe_ids[position],
+                     *simulate_recipe(ingredients, (output_side, store.output_quantity[position]))))
+
+    return DataFrame(rows, schema=FILL_SCHEMA, orient='row')
+
+
+@instrumented('store_fill_simulation')
+def store_fill_simulation(db_connection: Connection, store: Optional[RecipeStore] = None) -> None:
+    """
+    Function to simulate every recipe against the stored order books and replace the content of
+    `shard_fill_simulation` with the results.
+
+    :param db_connection: The connection to the SQLite database containing the shard recipes and order books.
+    :param store: The recipes, if they are already loaded. They are read from the database otherwise.
+    :return: None
+    """
+    if store is None:
+        store = RecipeStore.from_connection(db_connection)
+
+    simulation: DataFrame = compute_fill_simulation(store, load_order_books(db_connection))
+
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS shard_fill_simulation
+                   (
+                       recipe_id           INTEGER PRIMARY KEY,
+                       max_batch           INTEGER,
+                       batch_profit        REAL,
+                       first_fusion_profit REAL,
+                       marginal_profit     REAL
+                   )
+                   ''')
+
+    with db_connection:
+        cursor.execute('DELETE FROM shard_fill_simulation')
+        cursor.executemany('''
+                           INSERT INTO shard_fill_simulation
+                           (recipe_id, max_batch, batch_profit, first_fusion_profit, marginal_profit)
+                           VALUES (?, ?, ?, ?, ?)
+                           ''', simulation.iter_rows())
@@ -0,0 +1,146 @@
+from sqlite3 import Connection, OperationalError
+from time import monotonic, sleep
+from typing import Dict, Optional, Set
+
+from polars import DataFrame
+from requests import RequestException, Session
+
+from backend.scripts.acquisition_costs import store_acquisition_costs
+from backend.scripts.arbitrage import FusionArbitrage
+from backend.scripts.calculate_profits import load_bazaar_frame, load_product_frame, update_profit_data
+from backend.scripts.fetch_info import PROFIT_COLUMNS, fetch_bazaar_data, store_bazaar_data
+from backend.scripts.fusion_chains import load_buy_prices
+from backend.scripts.metrics import instrumented, store_metrics, write_exposition
+from backend.scripts.order_book import store_fill_simulation
+from backend.scripts.profit_cache import ProfitCache, describe_profit
+from backend.scripts.recipe_store import RecipeStore
+
+
+class BazaarPoller:
+    """
+    Long-lived poller keeping the shard profits in sync with the Bazaar.
+
+    The recipes (as a `RecipeStore`, with its reverse indexes) and the shard metadata are loaded once when the poller
+    is created, unless they are given (e.g. from a recipe snapshot). Every poll then only costs one (conditional)
+    request, a snapshot swap and an incremental recomputation of the recipes whose prices moved. Payloads whose ETag
+    or `lastUpdated` did not change are skipped entirely. The acquisition costs (with `use_acquisition_costs`) and the
+    order book fill simulation (with `simulate_fills`) are only recomputed when some product moved. With
+    `detect_arbitrage`, `arbitrage` holds the profitable fusion loops, re-checked incrementally after every new
+    payload. With `top`, the most profitable recipes are printed after every new payload from `cache`, which keeps
+    the profits in memory between polls and only reloads them when they were recomputed.
+
+    The metrics of every poll are stored as their own snapshot in `pipeline_metrics` once the poll is done, so a
+    long-running poller does not keep them until it stops, and the totals since the poller started are rewritten to
+    `metrics_file`, if given.
+    """
+
+    def __init__(self, db_connection: Connection, interval: float = 60.0, skip_empty_orders: bool = True,
+                 cope_mode: bool = False, keep_snapshots: int = 0, store: Optional[RecipeStore] = None,
+                 products: Optional[DataFrame] = None, detect_arbitrage: bool = False,
+                 use_acquisition_costs: bool = False, simulate_fills: bool = False, top: int = 0,
+                 metrics_file: Optional[str] = None):
+        self.db_connection: Connection = db_connection
+        self.interval: float = interval
+        self.skip_empty_orders: bool = skip_empty_orders
+        self.cope_mode: bool = cope_mode
+        self.keep_snapshots: int = keep_snapshots
+        self.detect_arbitrage: bool = detect_arbitrage
+        self.use_acquisition_costs: bool = use_acquisition_costs
+        self.simulate_fills: bool = simulate_fills
+        self.top: int = top
+        self.metrics_file: Optional[str] = metrics_file
+
+        self.store: RecipeStore = store if store is not None else RecipeStore.from_connection(db_connection)
+        self.products: DataFrame = products if products is not None else load_product_frame(db_connection)
+        self.cache: ProfitCache = ProfitCache(db_connection)
+        self.arbitrage: Optional[FusionArbitrage] = None
+
+        self.session: Session = Session()
+        self.etag: Optional[str] = None
+        self.last_updated: Optional[int] = None
+
+    @instrumented('poll')
+    def poll_once(self) -> Optional[int]:
+        """
+        Fetch the Bazaar once and, if the payload is new, store it and recompute the affected profits.
+
+        :return: The number of recomputed recipes, or None if the payload was unchanged or the request failed.
+        """
+        data, self.etag = fetch_bazaar_data(self.session, self.etag)
+        if data is None or (self.last_updated is not None and data.get('lastUpdated') == self.last_updated):
+            return None
+
+        changed_product_ids: Set[str] = store_bazaar_data(self.db_connection, data, PROFIT_COLUMNS,
+                                                          self.keep_snapshots)
+        if changed_product_ids and self.use_acquisition_costs:
+            changed_product_ids |= store_acquisition_costs(self.db_connection, self.skip_empty_orders, self.store,
+                                                           self.products)
+        if changed_product_ids and self.simulate_fills:
+            store_fill_simulation(self.db_connection, self.store)
+
+        updated: int = update_profit_data(self.db_connection, changed_product_ids, self.skip_empty_orders,
+                                          self.cope_mode, self.use_acquisition_costs, self.store, self.products)
+
+        if self.detect_arbitrage:
+            buy_prices: Dict[str, float] = load_buy_prices(load_bazaar_frame(self.db_connection),
+                                                           self.skip_empty_orders)
+            if self.arbitrage is None:
+                self.arbitrage = FusionArbitrage(self.store, buy_prices)
+            else:
+                self.arbitrage.update(buy_prices)
+            print(f'{len(self.arbitrage.loops)} profitable fusion loops')
+
+        for row in self.cache.top_k(self.top):
+            print(describe_profit(row))
+
+        # Only set once the payload is fully stored, so a payload whose processing failed is not skipped next time
+        self.last_updated = data.get('lastUpdated')
+        return updated
+
+    def flush_metrics(self) -> None:
+        """
+        Store the metrics recorded since the last flush as one snapshot, and write the accumulated ones to
+        `metrics_file` if given.
+
+        :return: None
+        """
+        store_metrics(self.db_connection)
+        if self.metrics_file:
+            write_exposition(self.metrics_file)
+
+    def run(self, max_polls: Optional[int] = None) -> None:
+        """
+        Poll the Bazaar every `interval` seconds until interrupted (or until `max_polls` polls were made).
+
+        :param max_polls: The number of polls after which to stop. Runs forever if not given.
+        :return: None
+        """
+        polls: int = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                started: float = monotonic()
+                try:
+                    updated: Optional[int] = self.poll_once()
+                    self.flush_metrics()
+                except RequestException as e:
+                    print(f'Error polling the Bazaar: {e}')
+                except OperationalError as e:
+                    # E.g. the database is locked by another writer. The payload is fetched again on the next poll.
+                    self.db_connection.rollback()
+                    self.etag = None
+                    print(f'Error storing the Bazaar data, retrying on the next poll: {e}')
+                else:
+                    if updated is None:
+                        print('Bazaar data unchanged, skipping')
+                    else:
+                        print(f'{updated} recipes recomputed')
+
+                polls += 1
+                if max_polls is None or polls < max_polls:
+                    sleep(max(0.0, self.interval - (monotonic() - started)))
+
+        except KeyboardInterrupt:
+            print('Stopping the Bazaar poller')
+
+        finally:
+            self.session.close()
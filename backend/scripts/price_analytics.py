@@ -0,0 +1,194 @@
+from sqlite3 import Connection, Cursor
+from time import time
+from typing import List, Optional, Set
+
+from polars import DataFrame, Float64, Int64, Utf8, col
+
+from backend.scripts.price_history import DAY, HOUR, PRICE_HISTORY_TABLE, RETENTION
+from backend.scripts.schema import table_exists
+
+# The trailing window the statistics are computed over, in seconds
+WINDOW: int = 7 * DAY
+
+HOURLY_SCHEMA = {
+    'product_id': Utf8,
+    'bucket': Int64,
+    'buy_price': Float64,
+    'sell_price': Float64,
+    'samples': Int64,
+    'since': Int64
+}
+
+ANALYTICS_SCHEMA = {
+    'product_id': Utf8,
+    'median_price': Float64,
+    'std_price': Float64
+}
+
+PRICE_ANALYTICS_TABLE: str = '''
+                             CREATE TABLE IF NOT EXISTS price_analytics
+                             (
+                                 product_id   TEXT PRIMARY KEY,
+                                 updated_to   INTEGER NOT NULL,
+                                 samples      INTEGER NOT NULL,
+                                 mean_price   REAL,
+                                 median_price REAL,
+                                 std_price    REAL,
+                                 min_price    REAL,
+                                 max_price    REAL,
+                                 mean_spread  REAL,
+                                 last_samples INTEGER
+                             )
+                             '''
+
+# The statistics of the window ending at every hourly bucket, kept as long as the hourly buckets themselves
+PRICE_SERIES_TABLE: str = '''
+                          CREATE TABLE IF NOT EXISTS price_analytics_series
+                          (
+                              product_id   TEXT    NOT NULL,
+                              bucket       INTEGER NOT NULL,
+                              mean_price   REAL,
+                              median_price REAL,
+                              std_price    REAL,
+                              mean_spread  REAL,
+                              PRIMARY KEY (product_id, bucket)
+                          ) WITHOUT ROWID
+                          '''
+
+
+def compute_price_analytics(hourly: DataFrame) -> DataFrame:
+    """
+    Function to compute the statistics of the trailing window of every product from its hourly buckets.
+
+    :param hourly: The hourly buckets of every product, with the `HOURLY_SCHEMA` columns. Only the buckets in the
+    window ending at the last bucket of each product are used.
+    :return: A DataFrame with one row per product: the last bucket, the number of buckets, and the mean, median,
+    standard deviation, minimum and maximum of the buy price, the mean spread between the buy and sell prices, and the
+    sample count of the last bucket.
+    """
+    return (
+        hourly
+        .filter(col('bucket') > col('bucket').max().over('product_id') - WINDOW)
+        .sort('product_id', 'bucket')
+        .group_by('product_id')
+        .agg(
+            col('bucket').last().alias('updated_to'),
+            col('buy_price').count().alias('samples'),
+            col('buy_price').mean().alias('mean_price'),
+            col('buy_price').median().alias('median_price'),
+            col('buy_price').std().alias('std_price'),
+            col('buy_price').min().alias('min_price'),
+            col('buy_price').max().alias('max_price'),
+            (col('buy_price') - col('sell_price')).mean().alias('mean_spread'),
+            col('samples').last().alias('last_samples')
+        )
+        .sort('product_id')
+    )
+
+
+def compute_price_series(hourly: DataFrame) -> DataFrame:
+    """
+    Function to compute the rolling statistics of every product at each of its hourly buckets, over the window ending
+    at the bucket.
+
+    :param hourly: The hourly buckets of every product, with the `HOURLY_SCHEMA` columns. The series is only returned
+    from the `since` bucket of each product, the buckets before it being read for their windows.
+    :return: A DataFrame with one row per product and bucket: the rolling mean, median and standard deviation of the
+    buy price, and the rolling mean spread between the buy and sell prices.
+    """
+    window: str = f'{WINDOW}i'
+    return (
+        hourly
+        .sort('product_id', 'bucket')
+        .with_columns(
+            col('buy_price').rolling_mean_by('bucket', window).over('product_id').alias('mean_price'),
+            col('buy_price').rolling_median_by('bucket', window).over('product_id').alias('median_price'),
+            col('buy_price').rolling_std_by('bucket', window).over('product_id').alias('std_price'),
+            (col('buy_price') - col('sell_price')).rolling_mean_by('bucket', window).over('product_id')
+            .alias('mean_spread')
+        )
+        .filter(col('bucket') >= col('since'))
+        .select('product_id', 'bucket', 'mean_price', 'median_price', 'std_price', 'mean_spread')
+    )
+
+
+def update_price_analytics(db_connection: Connection, now: Optional[int] = None) -> Set[str]:
+    """
+    Function to bring `price_analytics` and `price_analytics_series` up to date with the hourly price history.
+
+    Only the products whose last hourly bucket is newer than their last analytics update, or got more samples since
+    (the current hour is updated in place as points arrive), are recomputed. Their series is only recomputed from
+    their last analytics update, and only the buckets of the windows ending there are read, so the cost of an update
+    does not grow with the retained history.
+
+    :param db_connection: The connection to the SQLite database containing the price history.
+    :param now: The current epoch timestamp used for the retention of the series, in seconds. Defaults to the current
+    time.
+    :return: The product IDs whose statistics were updated.
+    """
+    if now is None:
+        now = int(time())
+
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute(PRICE_HISTORY_TABLE)
+    cursor.execute(PRICE_ANALYTICS_TABLE)
+    cursor.execute(PRICE_SERIES_TABLE)
+
+    cursor.execute(f'''
+                   WITH latest AS (SELECT h.product_id, MAX(h.bucket) AS bucket
+                                   FROM price_history_points AS h
+                                   WHERE h.resolution = {HOUR}
+                                   GROUP BY h.product_id),
+                        stale AS (SELECT latest.product_id, COALESCE(a.updated_to, 0) AS since
+                                  FROM latest
+                                           JOIN price_history_points AS l
+                                                ON l.product_id = latest.product_id
+                                                    AND l.resolution = {HOUR}
+                                                    AND l.bucket = latest.bucket
+                                           LEFT JOIN price_analytics AS a ON a.product_id = latest.product_id
+                                  WHERE a.updated_to IS NULL
+                                     OR a.updated_to < latest.bucket
+                                     OR a.last_samples IS NOT l.samples)
+                   SELECT p.product_id, p.bucket, p.buy_price, p.sell_price, p.samples, stale.since
+                   FROM stale
+                            JOIN price_history_points AS p
+                                 ON p.product_id = stale.product_id
+                                     AND p.resolution = {HOUR}
+                                     AND p.bucket > stale.since - {WINDOW}
+                   ''')
+    hourly: DataFrame = DataFrame(list(zip(*cursor.fetchall())), schema=HOURLY_SCHEMA, orient='col')
+    if hourly.is_empty():
+        return set()
+
+    analytics: DataFrame = compute_price_analytics(hourly)
+    with db_connection:
+        cursor.executemany('''
+                           INSERT OR REPLACE INTO price_analytics
+                           (product_id, updated_to, samples, mean_price, median_price, std_price, min_price,
+                            max_price, mean_spread, last_samples)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                           ''', analytics.iter_rows())
+        cursor.executemany('''
+                           INSERT OR REPLACE INTO price_analytics_series
+                           (product_id, bucket, mean_price, median_price, std_price, mean_spread)
+                           VALUES (?, ?, ?, ?, ?, ?)
+                           ''', compute_price_series(hourly).iter_rows())
+        cursor.execute('DELETE FROM price_analytics_series WHERE bucket < ?', (now - RETENTION[HOUR],))
+
+    return set(analytics['product_id'].to_list())
+
+
+def load_analytics_frame(db_connection: Connection) -> Optional[DataFrame]:
+    """
+    Function to load the 7-day median and standard deviation of the buy price of every product.
+
+    :param db_connection: The connection to the SQLite database.
+    :return: A DataFrame with the `ANALYTICS_SCHEMA` columns, or None if no analytics were computed yet.
+    """
+    cursor: Cursor = db_connection.cursor()
+    if not table_exists(cursor, 'price_analytics'):
+        return None
+
+    cursor.execute('SELECT product_id, median_price, std_price FROM price_analytics')
+    rows: List[tuple] = cursor.fetchall()
+    return DataFrame(list(zip(*rows)), schema=ANALYTICS_SCHEMA, orient='col') if rows else None
@@ -0,0 +1,329 @@
+from datetime import datetime, timezone
+from sqlite3 import Connection, Cursor
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from polars import DataFrame, Float64, Int64
+
+# Resolutions, in seconds. Raw points keep the timestamp of the sample itself
+RAW: int = 0
+HOUR: int = 3600
+DAY: int = 86400
+
+# Each resolution is rolled up from the previous one
+ROLLUPS: Tuple[Tuple[int, int], ...] = ((RAW, HOUR), (HOUR, DAY))
+
+# How long the points of each resolution are kept, in seconds (None keeps them forever)
+RETENTION: Dict[int, Optional[int]] = {
+    RAW: 2 * DAY,
+    HOUR: 30 * DAY,
+    DAY: None
+}
+
+PRICE_HISTORY_SCHEMA = {
+    'timestamp': Int64,
+    'buy_price': Float64,
+    'sell_price': Float64,
+    'samples': Int64
+}
+
+# The points of a product at a resolution are contiguous on disk, so a chart range is a single b-tree range scan
+PRICE_HISTORY_TABLE: str = '''
+                           CREATE TABLE IF NOT EXISTS price_history_points
+                           (
+                               product_id TEXT    NOT NULL,
+                               resolution INTEGER NOT NULL,
+                               bucket     INTEGER NOT NULL,
+                               buy_price  REAL,
+                               sell_price REAL,
+                               samples    INTEGER NOT NULL,
+                               PRIMARY KEY (product_id, resolution, bucket)
+                           ) WITHOUT ROWID
+                           '''
+
+# View with the layout of the former `product_price_history` table, for the frontend chart and price history
+# writer. Each product uses its finest points, and coarser buckets only where they end before the finer points start
+PRICE_HISTORY_VIEW: str = f'''
+                          CREATE VIEW IF NOT EXISTS product_price_history AS
+                          SELECT product_id,
+                                 buy_price,
+                                 sell_price,
+                                 strftime('%Y-%m-%dT%H:%M:%S', bucket, 'unixepoch') AS timestamp
+                          FROM price_history_points AS p
+                          WHERE bucket + resolution <= COALESCE((SELECT MIN(bucket)
+                                                                 FROM price_history_points AS f
+                                                                 WHERE f.product_id = p.product_id
+                                                                   AND f.resolution < p.resolution),
+                                                                bucket + resolution)
+                          '''
+
+# The epoch timestamp of a row inserted into the `product_price_history` view
+NEW_BUCKET: str = "CAST(strftime('%s', NEW.timestamp) AS INTEGER)"
+
+# Rows inserted into the view (by the frontend) are stored as raw points, and the hourly and daily buckets holding
+# them are rolled up again. Points already stored, or in a bucket whose finer points have expired, are ignored. The
+# retention is applied by the next `add_price_points`. The buckets are upserted, because the conflict policy of the
+# outer INSERT (e.g. OR IGNORE) would replace an OR REPLACE inside the trigger.
+PRICE_HISTORY_TRIGGER: str = f'''
+                             CREATE TRIGGER IF NOT EXISTS product_price_history_insert
+                             INSTEAD OF INSERT ON product_price_history
+                             WHEN {NEW_BUCKET} IS NOT NULL
+                                 AND NOT EXISTS (SELECT 1
+                                                 FROM price_history_points
+                                                 WHERE product_id = NEW.product_id
+                                                   AND resolution = {RAW}
+                                                   AND bucket = {NEW_BUCKET})
+                                 AND NOT EXISTS (SELECT 1
+                                                 FROM price_history_points AS c
+                                                 WHERE c.product_id = NEW.product_id
+                                                   AND c.resolution = {HOUR}
+                                                   AND c.bucket = {NEW_BUCKET} / {HOUR} * {HOUR}
+                                                   AND NOT EXISTS (SELECT 1
+                                                                   FROM price_history_points AS f
+                                                                   WHERE f.product_id = NEW.product_id
+                                                                     AND f.resolution = {RAW}
+                                                                     AND f.bucket >= c.bucket
+                                                                     AND f.bucket < c.bucket + {HOUR}))
+                                 AND NOT EXISTS (SELECT 1
+                                                 FROM price_history_points AS c
+                                                 WHERE c.product_id = NEW.product_id
+                                                   AND c.resolution = {DAY}
+                                                   AND c.bucket = {NEW_BUCKET} / {DAY} * {DAY}
+                                                   AND NOT EXISTS (SELECT 1
+                                                                   FROM price_history_points AS f
+                                                                   WHERE f.product_id = NEW.product_id
+                                                                     AND f.resolution = {HOUR}
+                                                                     AND f.bucket >= c.bucket
+                                                                     AND f.bucket < c.bucket + {DAY}))
+                             BEGIN
+                                 INSERT INTO price_history_points
+                                 (product_id, resolution, bucket, buy_price, sell_price, samples)
+                                 VALUES (NEW.product_id, {RAW}, {NEW_BUCKET}, NEW.buy_price, NEW.sell_price, 1);
+                                 INSERT INTO price_history_points
+                                 (product_id, resolution, bucket, buy_price, sell_price, samples)
+                                 SELECT product_id,
+                                        {HOUR},
+                                        bucket / {HOUR} * {HOUR},
+                                        SUM(buy_price * samples) / SUM(samples),
+                                        SUM(sell_price * samples) / SUM(samples),
+                                        SUM(samples)
+                                 FROM price_history_points
+                                 WHERE product_id = NEW.product_id
+                                   AND resolution = {RAW}
+                                   AND bucket >= {NEW_BUCKET} / {HOUR} * {HOUR}
+                                   AND bucket < {NEW_BUCKET} / {HOUR} * {HOUR} + {HOUR}
+                                 ON CONFLICT (product_id, resolution, bucket) DO UPDATE
+                                 SET buy_price  = excluded.buy_price,
+                                     sell_price = excluded.sell_price,
+                                     samples    = excluded.samples;
+                                 INSERT INTO price_history_points
+                                 (product_id, resolution, bucket, buy_price, sell_price, samples)
+                                 SELECT product_id,
+                                        {DAY},
+                                        bucket / {DAY} * {DAY},
+                                        SUM(buy_price * samples) / SUM(samples),
+                                        SUM(sell_price * samples) / SUM(samples),
+                                        SUM(samples)
+                                 FROM price_history_points
+                                 WHERE product_id = NEW.product_id
+                                   AND resolution = {HOUR}
+                                   AND bucket >= {NEW_BUCKET} / {DAY} * {DAY}
+                                   AND bucket < {NEW_BUCKET} / {DAY} * {DAY} + {DAY}
+                                 ON CONFLICT (product_id, resolution, bucket) DO UPDATE
+                                 SET buy_price  = excluded.buy_price,
+                                     sell_price = excluded.sell_price,
+                                     samples    = excluded.samples;
+                             END
+                             '''
+
+
+def parse_timestamp(timestamp: str) -> int:
+    """
+    Function to convert an ISO 8601 timestamp into seconds since the epoch. Timestamps without an offset are in UTC.
+
+    :param timestamp: The timestamp, e.g. '2025-07-21T14:03:00.123' or '2025-07-21T14:03:00Z'.
+    :return: The epoch timestamp, in seconds.
+    """
+    parsed: datetime = datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def create_price_history_tables(cursor: Cursor) -> None:
+    """
+    Function to create the price history table, its compatibility view and the trigger storing the rows inserted into
+    the view if they do not exist.
+
+    :param cursor: A cursor on the database.
+    :return: None
+    """
+    cursor.execute(PRICE_HISTORY_TABLE)
+    cursor.execute(PRICE_HISTORY_VIEW)
+    cursor.execute(PRICE_HISTORY_TRIGGER)
+
+
+def stored_until(cursor: Cursor) -> Dict[str, int]:
+    """
+    Function to find, for every product, the timestamp up to which its history is already stored.
+    That is its last raw point, or the end of its last rolled up bucket if its raw points have expired.
+
+    :param cursor: A cursor on the database.
+    :return: A dictionary mapping each product ID to the timestamp.
+    """
+    cursor.execute('''
+                   SELECT product_id, resolution, MAX(bucket)
+                   FROM price_history_points
+                   GROUP BY product_id, resolution
+                   ORDER BY resolution DESC
+                   ''')
+
+    # Finer resolutions come last and overwrite the coarser ones
+    return {product_id: bucket + max(resolution - 1, 0) for product_id, resolution, bucket in cursor.fetchall()}
+
+
+def rollup_price_history(cursor: Cursor, since: Dict[str, int]) -> None:
+    """
+    Function to recompute the hourly and daily buckets of every product from the next finer resolution.
+    Only the buckets at or after the given timestamp are recomputed, and averages are weighted by sample counts, so a
+    daily bucket is the average of every raw point of the day.
+
+    :param cursor: A cursor on the database.
+    :param since: For each product, the timestamp of its oldest new raw point.
+    :return: None
+    """
+    for source, target in ROLLUPS:
+        cursor.executemany(f'''
+                           INSERT OR REPLACE INTO price_history_points
+                           (product_id, resolution, bucket, buy_price, sell_price, samples)
+                           SELECT product_id,
+                                  {target},
+                                  bucket / {target} * {target},
+                                  SUM(buy_price * samples) / SUM(samples),
+                                  SUM(sell_price * samples) / SUM(samples),
+                                  SUM(samples)
+                           FROM price_history_points
+                           WHERE product_id = ?
+                             AND resolution = {source}
+                             AND bucket >= ? / {target} * {target}
+                           GROUP BY bucket / {target}
+                           ''', since.items())
+
+
+def apply_retention(cursor: Cursor, now: Optional[int] = None) -> int:
+    """
+    Function to delete the points older than the retention of their resolution.
+
+    :param cursor: A cursor on the database.
+    :param now: The current epoch timestamp, in seconds. Defaults to the current time.
+    :return: The number of deleted points.
+    """
+    if now is None:
+        now = int(time())
+
+    deleted: int = 0
+    for resolution, retention in RETENTION.items():
+        if retention is not None:
+            cursor.execute('DELETE FROM price_history_points WHERE resolution = ? AND bucket < ?',
+                           (resolution, now - retention))
+            deleted += cursor.rowcount
+
+    return deleted
+
+
+def add_price_points(cursor: Cursor, points: Iterable[Tuple[str, int, float, float]], now: Optional[int] = None) -> \
+        int:
+    """
+    Function to add raw price points, roll them up into the hourly and daily buckets and apply the retention
+    policies, without committing. Points that are not newer than the stored history of their product are ignored, so
+    overlapping fetches can be stored as they are.
+
+    :param cursor: A cursor on the database containing the `price_history_points` table.
+    :param points: Tuples of (product_id, epoch timestamp, buy_price, sell_price).
+    :param now: The current epoch timestamp used for the retention, in seconds. Defaults to the current time.
+    :return: The number of new raw points.
+    """
+    latest: Dict[str, int] = stored_until(cursor)
+    since: Dict[str, int] = {}
+    new_points: List[Tuple[str, int, int, float, float, int]] = []
+    for product_id, timestamp, buy_price, sell_price in points:
+        if timestamp <= latest.get(product_id, -1):
+            continue
+
+        new_points.append((product_id, RAW, timestamp, buy_price, sell_price, 1))
+        since[product_id] = min(timestamp, since.get(product_id, timestamp))
+
+    cursor.executemany('''
+                       INSERT OR REPLACE INTO price_history_points
+                       (product_id, resolution, bucket, buy_price, sell_price, samples)
+                       VALUES (?, ?, ?, ?, ?, ?)
+                       ''', new_points)
+    rollup_price_history(cursor, since)
+    apply_retention(cursor, now)
+
+    return len(new_points)
+
+
+def store_price_points(db_connection: Connection, points: Iterable[Tuple[str, int, float, float]],
+                       now: Optional[int] = None) -> int:
+    """
+    Function to store raw price points with `add_price_points` in a single transaction.
+
+    :param db_connection: The connection to the SQLite database.
+    :param points: Tuples of (product_id, epoch timestamp, buy_price, sell_price).
+    :param now: The current epoch timestamp used for the retention, in seconds. Defaults to the current time.
+    :return: The number of new raw points.
+    """
+    cursor: Cursor = db_connection.cursor()
+    create_price_history_tables(cursor)
+
+    with db_connection:
+        return add_price_points(cursor, points, now)
+
+
+def choose_resolution(start: int, now: Optional[int] = None) -> int:
+    """
+    Function to pick the finest resolution whose retention still covers the start of a time range.
+
+    :param start: The start of the range, as an epoch timestamp in seconds.
+    :param now: The current epoch timestamp, in seconds. Defaults to the current time.
+    :return: The resolution.
+    """
+    if now is None:
+        now = int(time())
+
+    for resolution, retention in RETENTION.items():
+        if retention is None or start >= now - retention:
+            return resolution
+
+    return DAY
+
+
+def query_price_history(db_connection: Connection, product_id: str, start: int, end: Optional[int] = None,
+                        resolution: Optional[int] = None) -> DataFrame:
+    """
+    Function to read the price history of a product over a time range.
+
+    :param db_connection: The connection to the SQLite database.
+    :param product_id: The bazaar product ID.
+    :param start: The start of the range, as an epoch timestamp in seconds.
+    :param end: The end of the range, as an epoch timestamp in seconds. Defaults to the current time.
+    :param resolution: The resolution to read (RAW, HOUR or DAY). Chosen with `choose_resolution` if not given.
+    :return: A DataFrame with the bucket timestamp, average buy and sell prices and sample count of every point.
+    """
+    now: int = int(time())
+    if end is None:
+        end = now
+    if resolution is None:
+        resolution = choose_resolution(start, now)
+
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute('''
+                   SELECT bucket, buy_price, sell_price, samples
+                   FROM price_history_points
+                   WHERE product_id = ?
+                     AND resolution = ?
+                     AND bucket BETWEEN ? AND ?
+                   ORDER BY bucket
+                   ''', (product_id, resolution, start, end))
+    return DataFrame(list(zip(*cursor.fetchall())), schema=PRICE_HISTORY_SCHEMA, orient='col')
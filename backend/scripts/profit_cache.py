@@ -0,0 +1,165 @@
+from sqlite3 import Connection, Cursor
+from typing import Dict, List, Optional, Tuple
+
+from backend.scripts.schema import table_exists
+
+PROFIT_COLUMNS: Tuple[str, ...] = ('recipe_id', 'output_item', 'demand', 'profit', 'cost', 'ingredients', 'id',
+                                   'current_price', 'median_profit', 'profit_per_volatility', 'rarity', 'family')
+
+
+class ProfitCache:
+    """
+    In-memory copy of `shard_profit_data`, answering top-K queries without touching the database.
+
+    The rows are loaded once, sorted by profit, and indexed by rarity, family and output shard. Each index is a list
+    of row positions already in profit order, so a top-K query walks the shortest matching index and stops after K
+    matches, and the answers of repeated queries are kept until the rows change. The cache remembers the version
+    stamp of the rows it loaded (see `calculate_profits.bump_profit_version`) and checks it on every query, so rows
+    written since, by this process or another one, are reloaded before answering; `invalidate` drops the rows
+    without waiting for the next query.
+    """
+
+    def __init__(self, db_connection: Connection):
+        self.db_connection: Connection = db_connection
+        self.version: Optional[int] = None
+        self.rows: Optional[List[Tuple]] = None
+        self.by_rarity: Dict[str, List[int]] = {}
+        self.by_family: Dict[str, List[int]] = {}
+        self.by_output: Dict[str, List[int]] = {}
+        self.results: Dict[Tuple, List[Dict[str, str or int or float]]] = {}
+
+    def stored_version(self) -> int:
+        """
+        The version stamp of the profits currently in the database.
+
+        :return: The version, or 0 if the profits were never versioned.
+        """
+        cursor: Cursor = self.db_connection.cursor()
+        if not table_exists(cursor, 'profit_data_version'):
+            return 0
+
+        cursor.execute('SELECT version FROM profit_data_version WHERE id = 0')
+        row: Optional[Tuple[int]] = cursor.fetchone()
+        return row[0] if row else 0
+
+    def load(self) -> None:
+        """
+        Load the profits and build the indexes. The version stamp and the rows are read in the same transaction, so
+        they always match.
+
+        :return: None
+        """
+        cursor: Cursor = self.db_connection.cursor()
+        read_transaction: bool = not self.db_connection.in_transaction
+        if read_transaction:
+            cursor.execute('BEGIN')
+        try:
+            version: int = self.stored_version()
+            cursor.execute('''
+                           SELECT p.recipe_id,
+                                  p.output_item,
+                                  p.demand,
+                                  p.profit,
+                                  p.cost,
+                                  p.ingredients,
+                                  p.id,
+                                  p.current_price,
+                                  p.median_profit,
+                                  p.profit_per_volatility,
+                                  s.rarity,
+                                  s.family
+                           FROM shard_profit_data AS p
+                                    LEFT JOIN shard_to_productid AS s ON s.name = p.output_item
+                           ORDER BY p.profit DESC, p.recipe_id
+                           ''')
+            rows: List[Tuple] = cursor.fetchall()
+        finally:
+            if read_transaction:
+                self.db_connection.rollback()
+
+        by_rarity: Dict[str, List[int]] = {}
+        by_family: Dict[str, List[int]] = {}
+        by_output: Dict[str, List[int]] = {}
+        for position, row in enumerate(rows):
+            by_output.setdefault(row[1], []).append(position)
+            by_rarity.setdefault(row[10], []).append(position)
+            by_family.setdefault(row[11], []).append(position)
+
+        self.rows, self.version = rows, version
+        self.by_rarity, self.by_family, self.by_output = by_rarity, by_family, by_output
+        self.results = {}
+
+    def invalidate(self) -> None:
+        """
+        Drop the cached rows, so the next query reloads them.
+
+        :return: None
+        """
+        self.rows = None
+        self.version = None
+        self.results = {}
+
+    def refresh(self) -> bool:
+        """
+        Reload the rows if the database holds a newer version than the cached one.
+
+        :return: True if the rows were reloaded.
+        """
+        if self.rows is not None and self.version == self.stored_version():
+            return False
+
+        self.load()
+        return True
+
+    def top_k(self, k: int = 20, rarity: Optional[str] = None, family: Optional[str] = None,
+              output_item: Optional[str] = None) -> List[Dict[str, str or int or float]]:
+        """
+        The K most profitable recipes matching every given filter.
+
+        :param k: The number of recipes to return (none if it is not positive).
+        :param rarity: Only recipes whose output has this rarity.
+        :param family: Only recipes whose output belongs to this family.
+        :param output_item: Only recipes making this shard (by name).
+        :return: The recipes, most profitable first, as dictionaries of the `PROFIT_COLUMNS`. The same list is
+        returned to repeated queries, so it must not be modified.
+        """
+        if k <= 0:
+            return []
+        self.refresh()
+
+        key: Tuple = (k, rarity, family, output_item)
+        if key in self.results:
+            return self.results[key]
+
+        filters: List[Tuple[int, str]] = [(column, value) for column, value in
+                                          ((10, rarity), (11, family), (1, output_item)) if value is not None]
+        candidates: List[int] or range = range(len(self.rows))
+        for index, value in ((self.by_rarity, rarity), (self.by_family, family), (self.by_output, output_item)):
+            if value is not None and len(index.get(value, ())) < len(candidates):
+                candidates = index.get(value, [])
+
+        matches: List[Dict[str, str or int or float]] = []
+        for position in candidates:
+            row: Tuple = self.rows[position]
+            if all(row[column] == value for column, value in filters):
+                matches.append(dict(zip(PROFIT_COLUMNS, row)))
+                if len(matches) == k:
+                    break
+
+        self.results[key] = matches
+        return matches
+
+
+def describe_profit(row: Dict[str, str or int or float]) -> str:
+    """
+    Function to write a cached profit row on one line.
+
+    :param row: The row, as returned by `ProfitCache.top_k`.
+    :return: The output shard and recipe ID, followed by the profit and cost of one fusion. A missing value (e.g. the
+    cost of a row migrated from unparsable ingredients, until the next full calculation) is written as '?'.
+    """
+    def coins(value: Optional[float]) -> str:
+        return '?' if value is None else f'{value:,.0f}'
+
+    return f"{row['output_item']} (recipe {row['recipe_id']}): {coins(row['profit'])} coins profit for " \
+           f"{coins(row['cost'])} coins"
@@ -0,0 +1,356 @@
+from sqlite3 import Connection, Cursor
+from time import time
+from typing import Collection, Dict, List, Optional, Tuple
+
+from polars import DataFrame, Expr, Int64, col, lit, when
+
+from backend.scripts.price_history import DAY, HOUR
+
+# A delta row is followed by a keyframe after this many deltas, so decoding any point reads a bounded number of rows
+KEYFRAME_INTERVAL: int = 32
+
+# Changes older than this are compacted to the last state of every COMPACTION_RESOLUTION bucket, in seconds
+COMPACTION_AGE: int = 2 * DAY
+COMPACTION_RESOLUTION: int = HOUR
+
+PROFIT_HISTORY_SCHEMA = {
+    'timestamp': Int64,
+    'profit': Int64,
+    'current_price': Int64
+}
+
+# One row per change of a recipe. Keyframes hold the profit and price, delta rows the difference with the previous
+# row (small integers, which SQLite stores in a byte or two), and a keyframe of NULLs marks a recipe that stopped
+# being priced. The rows of a recipe are contiguous on disk, so a time range is a single b-tree range scan
+PROFIT_HISTORY_TABLE: str = '''
+                            CREATE TABLE IF NOT EXISTS shard_profit_history
+                            (
+                                recipe_id     INTEGER NOT NULL,
+                                recorded_at   INTEGER NOT NULL,
+                                keyframe      INTEGER NOT NULL,
+                                profit        INTEGER,
+                                current_price INTEGER,
+                                PRIMARY KEY (recipe_id, recorded_at)
+                            ) WITHOUT ROWID
+                            '''
+
+# The latest state of every recipe, which new runs are compared with, and the number of deltas since its keyframe
+PROFIT_HISTORY_HEAD_TABLE: str = '''
+                                 CREATE TABLE IF NOT EXISTS shard_profit_history_head
+                                 (
+                                     recipe_id     INTEGER PRIMARY KEY,
+                                     recorded_at   INTEGER NOT NULL,
+                                     profit        INTEGER,
+                                     current_price INTEGER,
+                                     deltas        INTEGER NOT NULL
+                                 )
+                                 '''
+
+# The time up to which the history is compacted
+PROFIT_HISTORY_COMPACTION_TABLE: str = '''
+                                       CREATE TABLE IF NOT EXISTS shard_profit_history_compaction
+                                       (
+                                           id              INTEGER PRIMARY KEY CHECK (id = 0),
+                                           compacted_until INTEGER NOT NULL
+                                       )
+                                       '''
+
+HEAD_SCHEMA = {
+    'recipe_id': Int64,
+    'profit': Int64,
+    'current_price': Int64,
+    'deltas': Int64
+}
+
+# The profit and price of a recipe, or None while it is not priced
+ProfitState = Optional[Tuple[int, Optional[int]]]
+
+
+def create_profit_history_tables(cursor: Cursor) -> None:
+    """
+    Function to create the profit history tables if they do not exist.
+
+    :param cursor: A cursor on the database.
+    :return: None
+    """
+    cursor.execute(PROFIT_HISTORY_TABLE)
+    cursor.execute(PROFIT_HISTORY_HEAD_TABLE)
+    cursor.execute(PROFIT_HISTORY_COMPACTION_TABLE)
+
+
+def decode_row(state: ProfitState, keyframe: int, profit: Optional[int], current_price: Optional[int]) -> ProfitState:
+    """
+    Function to apply a history row to the previous state of its recipe.
+
+    :param state: The state before the row.
+    :param keyframe: 1 if the row is a keyframe, 0 if it is a delta.
+    :param profit: The profit of the row, or its difference with the previous state.
+    :param current_price: The price of the row, or its difference with the previous state.
+    :return: The state after the row.
+    """
+    if keyframe:
+        return None if profit is None else (profit, current_price)
+    return state[0] + profit, state[1] + current_price
+
+
+def state_before(cursor: Cursor, recipe_id: int, before: int) -> ProfitState:
+    """
+    Function to decode the state of a recipe just before a time, from its last keyframe before it.
+
+    :param cursor: A cursor on the database.
+    :param recipe_id: The recipe ID.
+    :param before: The epoch timestamp, in seconds.
+    :return: The state in effect before the timestamp, or None if the recipe was not priced.
+    """
+    cursor.execute('''
+                   SELECT COALESCE(MAX(recorded_at), 0)
+                   FROM shard_profit_history
+                   WHERE recipe_id = ?
+                     AND keyframe = 1
+                     AND recorded_at < ?
+                   ''', (recipe_id, before))
+    decode_from: int = cursor.fetchone()[0]
+
+    cursor.execute('''
+                   SELECT keyframe, profit, current_price
+                   FROM shard_profit_history
+                   WHERE recipe_id = ?
+                     AND recorded_at >= ?
+                     AND recorded_at < ?
+                   ORDER BY recorded_at
+                   ''', (recipe_id, decode_from, before))
+
+    state: ProfitState = None
+    for keyframe, profit, current_price in cursor.fetchall():
+        state = decode_row(state, keyframe, profit, current_price)
+    return state
+
+
+def encode_states(recipe_id: int, states: List[Tuple[int, ProfitState]]) -> List[Tuple]:
+    """
+    Function to encode consecutive states of a recipe as history rows, the first of them as a keyframe.
+
+    :param recipe_id: The recipe ID.
+    :param states: Tuples of (recorded_at, state), in time order.
+    :return: Tuples of (recipe_id, recorded_at, keyframe, profit, current_price).
+    """
+    rows: List[Tuple] = []
+    previous: ProfitState = None
+    deltas: int = 0
+    for index, (recorded_at, state) in enumerate(states):
+        if index == 0 or state is None or previous is None or None in state or None in previous or \
+                deltas + 1 >= KEYFRAME_INTERVAL:
+            rows.append((recipe_id, recorded_at, 1, *(state or (None, None))))
+            deltas = 0
+        else:
+            rows.append((recipe_id, recorded_at, 0, state[0] - previous[0], state[1] - previous[1]))
+            deltas += 1
+        previous = state
+    return rows
+
+
+def add_profit_history(cursor: Cursor, profit_rows: DataFrame, recipe_ids: Optional[Collection[int]] = None,
+                       now: Optional[int] = None) -> int:
+    """
+    Function to append the changes of a profit run to the history and compact it, without committing.
+
+    Only the recipes whose profit or price differs from their last recorded state get a row, so the history grows
+    with the number of changes rather than with the number of runs. Recipes that were recorded but are no longer
+    priced get a keyframe of NULLs.
+
+    :param cursor: A cursor on the database.
+    :param profit_rows: The rows of the run, as returned by `calculate_profits.format_profit_frame`.
+    :param recipe_ids: The IDs of the recipes the run recomputed. Every recipe is considered if not given.
+    :param now: The epoch timestamp of the run, in seconds. Defaults to the current time.
+    :return: The number of recorded changes.
+    """
+    create_profit_history_tables(cursor)
+    if now is None:
+        now = int(time())
+
+    # Every run gets its own timestamp, even if two of them happen within a second
+    cursor.execute('SELECT MAX(recorded_at) FROM shard_profit_history_head')
+    last_run: Optional[int] = cursor.fetchone()[0]
+    recorded_at: int = now if last_run is None else max(now, last_run + 1)
+
+    cursor.execute('SELECT recipe_id, profit, current_price, deltas FROM shard_profit_history_head')
+    head: DataFrame = DataFrame(list(zip(*cursor.fetchall())), schema=HEAD_SCHEMA, orient='col')
+    current: DataFrame = profit_rows.select('recipe_id', 'profit', 'current_price').cast(Int64)
+    if recipe_ids is not None:
+        head = head.filter(col('recipe_id').is_in(list(recipe_ids)))
+
+    was_priced: Expr = col('profit').is_not_null()
+    is_priced: Expr = col('priced').fill_null(False)
+    keyframe: Expr = ~was_priced | ~is_priced | col('current_price').is_null() | \
+        col('current_price_new').is_null() | (col('deltas') + 1 >= KEYFRAME_INTERVAL)
+
+    changes: DataFrame = (
+        head.join(current.with_columns(lit(True).alias('priced')), on='recipe_id', how='full', coalesce=True,
+                  suffix='_new')
+        .filter(
+            (is_priced & (~was_priced | (col('profit') != col('profit_new')) |
+                          col('current_price').ne_missing(col('current_price_new'))))
+            | (~is_priced & was_priced)
+        )
+        .select(
+            'recipe_id',
+            keyframe.alias('keyframe'),
+            when(keyframe).then(col('profit_new')).otherwise(col('profit_new') - col('profit')).alias('profit'),
+            when(keyframe).then(col('current_price_new'))
+            .otherwise(col('current_price_new') - col('current_price')).alias('current_price'),
+            when(keyframe).then(0).otherwise(col('deltas') + 1).alias('deltas'),
+            col('profit_new').alias('head_profit'),
+            col('current_price_new').alias('head_price')
+        )
+    )
+
+    cursor.executemany('''
+                       INSERT INTO shard_profit_history (recipe_id, recorded_at, keyframe, profit, current_price)
+                       VALUES (?, ?, ?, ?, ?)
+                       ''', ((recipe_id, recorded_at, int(is_keyframe), profit, price)
+                             for recipe_id, is_keyframe, profit, price in
+                             changes.select('recipe_id', 'keyframe', 'profit', 'current_price').iter_rows()))
+    cursor.executemany('''
+                       INSERT OR REPLACE INTO shard_profit_history_head
+                           (recipe_id, recorded_at, profit, current_price, deltas)
+                       VALUES (?, ?, ?, ?, ?)
+                       ''', ((recipe_id, recorded_at, profit, price, deltas)
+                             for recipe_id, profit, price, deltas in
+                             changes.select('recipe_id', 'head_profit', 'head_price', 'deltas').iter_rows()))
+
+    compact_profit_history(cursor, now=now)
+    return changes.height
+
+
+def compact_profit_history(cursor: Cursor, age: int = COMPACTION_AGE, resolution: int = COMPACTION_RESOLUTION,
+                           now: Optional[int] = None) -> int:
+    """
+    Function to compact the changes older than `age` to the last state of every `resolution` bucket, without
+    committing. Each call only reads the changes since the previous compaction, and the first change after the
+    compacted range of every recipe is turned into a keyframe, so the next compaction can usually decode its range on
+    its own. A recipe without changes in a range keeps its next change as a delta, so the decoding of a recipe whose
+    first change in the range is a delta starts from its state before the range.
+
+    :param cursor: A cursor on the database.
+    :param age: The age from which changes are compacted, in seconds.
+    :param resolution: The size of the buckets compacted changes are kept at, in seconds.
+    :param now: The current epoch timestamp, in seconds. Defaults to the current time.
+    :return: The number of deleted rows.
+    """
+    create_profit_history_tables(cursor)
+    if now is None:
+        now = int(time())
+
+    until: int = (now - age) // resolution * resolution
+    cursor.execute('SELECT compacted_until FROM shard_profit_history_compaction WHERE id = 0')
+    row: Optional[Tuple[int]] = cursor.fetchone()
+    since: int = row[0] if row else 0
+    if until <= since:
+        return 0
+
+    cursor.execute('''
+                   SELECT recipe_id, recorded_at, keyframe, profit, current_price
+                   FROM shard_profit_history
+                   WHERE recorded_at >= ?
+                     AND recorded_at < ?
+                   ORDER BY recipe_id, recorded_at
+                   ''', (since, until))
+
+    # The last state of every bucket of every recipe, in time order
+    buckets: Dict[int, Dict[int, Tuple[int, ProfitState]]] = {}
+    state: ProfitState = None
+    read: int = 0
+    for recipe_id, recorded_at, keyframe, profit, current_price in cursor.fetchall():
+        if recipe_id not in buckets:
+            state = None if keyframe else state_before(cursor, recipe_id, since)
+        state = decode_row(state, keyframe, profit, current_price)
+        buckets.setdefault(recipe_id, {})[recorded_at // resolution] = (recorded_at, state)
+        read += 1
+
+    kept: List[Tuple] = []
+    boundaries: List[Tuple] = []
+    for recipe_id, states in buckets.items():
+        changes: List[Tuple[int, ProfitState]] = []
+        for recorded_at, bucket_state in states.values():
+            if not changes or bucket_state != changes[-1][1]:
+                changes.append((recorded_at, bucket_state))
+        kept.extend(encode_states(recipe_id, changes))
+
+        cursor.execute('''
+                       SELECT recorded_at, keyframe, profit, current_price
+                       FROM shard_profit_history
+                       WHERE recipe_id = ?
+                         AND recorded_at >= ?
+                       ORDER BY recorded_at
+                       LIMIT 1
+                       ''', (recipe_id, until))
+        boundary: Optional[Tuple] = cursor.fetchone()
+        if boundary is not None and not boundary[1]:
+            boundary_state: ProfitState = decode_row(changes[-1][1], *boundary[1:])
+            boundaries.append((*boundary_state, recipe_id, boundary[0]))
+
+    cursor.execute('DELETE FROM shard_profit_history WHERE recorded_at >= ? AND recorded_at < ?', (since, until))
+    cursor.executemany('''
+                       INSERT INTO shard_profit_history (recipe_id, recorded_at, keyframe, profit, current_price)
+                       VALUES (?, ?, ?, ?, ?)
+                       ''', kept)
+    cursor.executemany('''
+                       UPDATE shard_profit_history
+                       SET keyframe = 1, profit = ?, current_price = ?
+                       WHERE recipe_id = ?
+                         AND recorded_at = ?
+                       ''', boundaries)
+    cursor.execute('''
+                   INSERT OR REPLACE INTO shard_profit_history_compaction (id, compacted_until)
+                   VALUES (0, ?)
+                   ''', (until,))
+
+    return read - len(kept)
+
+
+def query_profit_history(db_connection: Connection, recipe_id: int, start: int, end: Optional[int] = None) -> \
+        DataFrame:
+    """
+    Function to read the profit and price of a recipe over a time range.
+    Decoding starts from the last keyframe before the range, so it reads at most `KEYFRAME_INTERVAL` rows more than
+    the range holds.
+
+    :param db_connection: The connection to the SQLite database.
+    :param recipe_id: The recipe ID.
+    :param start: The start of the range, as an epoch timestamp in seconds.
+    :param end: The end of the range, as an epoch timestamp in seconds. Defaults to the current time.
+    :return: A DataFrame with the time, profit and price of every change in the range, preceded by the change in
+    effect at its start (if any). The profit and price are null while the recipe is not priced.
+    """
+    if end is None:
+        end = int(time())
+
+    cursor: Cursor = db_connection.cursor()
+    create_profit_history_tables(cursor)
+    cursor.execute('''
+                   SELECT COALESCE(MAX(recorded_at), ?)
+                   FROM shard_profit_history
+                   WHERE recipe_id = ?
+                     AND keyframe = 1
+                     AND recorded_at <= ?
+                   ''', (start, recipe_id, start))
+    decode_from: int = cursor.fetchone()[0]
+
+    cursor.execute('''
+                   SELECT recorded_at, keyframe, profit, current_price
+                   FROM shard_profit_history
+                   WHERE recipe_id = ?
+                     AND recorded_at BETWEEN ? AND ?
+                   ORDER BY recorded_at
+                   ''', (recipe_id, decode_from, end))
+
+    points: List[Tuple[int, Optional[int], Optional[int]]] = []
+    state: ProfitState = None
+    for recorded_at, keyframe, profit, current_price in cursor.fetchall():
+        state = decode_row(state, keyframe, profit, current_price)
+        # Only the last change before the range is kept, as the state in effect at its start
+        if recorded_at <= start:
+            points.clear()
+        points.append((recorded_at, *(state or (None, None))))
+
+    return DataFrame(list(zip(*points)), schema=PROFIT_HISTORY_SCHEMA, orient='col')
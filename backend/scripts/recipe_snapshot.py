@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+from array import array
+from hashlib import sha256
+from json import dumps, loads
+from mmap import ACCESS_READ, mmap
+from os import path, replace
+from sqlite3 import Connection, Cursor
+from struct import Struct
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from backend.scripts.recipe_store import RecipeStore
+from backend.scripts.schema import table_exists
+
+if TYPE_CHECKING:
+    from polars import DataFrame
+
+SNAPSHOT_MAGIC: bytes = b'SHRDSNAP'
+SNAPSHOT_VERSION: int = 1
+
+# magic, byte order marker (1 in the native order of the writer), version, number of recipes, products, entries of
+# the by-ingredient and by-output indexes, length of the JSON strings section, and the key of the sources
+SNAPSHOT_HEADER: Struct = Struct('=8sIIQQQQQ32s')
+HEADER_SIZE: int = (SNAPSHOT_HEADER.size + 7) // 8 * 8
+
+# The shard metadata kept in the snapshot, in the order of `calculate_profits.PRODUCT_SCHEMA`
+SHARD_COLUMNS: Tuple[str, ...] = ('productID', 'name', 'rarity', 'family', 'craftingID')
+
+
+class RecipeSnapshot:
+    """
+    The recipe graph and shard metadata, as read from a snapshot file.
+
+    The recipe columns and indexes of `store` are memoryviews over the memory-mapped file, so loading costs the same
+    for any number of recipes: pages are only read from disk when they are first used.
+    """
+
+    def __init__(self, store: RecipeStore, shards: Dict[str, List[Optional[str]]]):
+        self.store: RecipeStore = store
+        self.shards: Dict[str, List[Optional[str]]] = shards
+
+    def products_frame(self) -> DataFrame:
+        """
+        The shard metadata, in the shape of `calculate_profits.load_product_frame`. Polars is only imported here.
+
+        :return: A DataFrame with one row per shard.
+        """
+        from backend.scripts.calculate_profits import PRODUCT_SCHEMA
+        from polars import DataFrame
+
+        return DataFrame(self.shards, schema=PRODUCT_SCHEMA)
+
+
+def source_key(cursor: Cursor) -> Optional[bytes]:
+    """
+    Function to identify the sources the recipe database was built from, using the digests of the `build_cache`.
+
+    :param cursor: A cursor on the database.
+    :return: A SHA-256 digest of the recorded source digests, or None if the database has no build cache.
+    """
+    if not table_exists(cursor, 'build_cache'):
+        return None
+
+    cursor.execute("SELECT source, digest FROM build_cache ORDER BY source")
+    digests: List[Tuple[str, str]] = cursor.fetchall()
+    return sha256(dumps(digests).encode()).digest() if digests else None
+
+
+def snapshot_path(db_path: str) -> str:
+    """
+    Function to name the snapshot of a database, next to it.
+
+    :param db_path: The path of the SQLite database.
+    :return: The path of the snapshot.
+    """
+    return f'{path.splitext(db_path)[0]}.snapshot'
+
+
+def read_snapshot_key(filename: str) -> Optional[bytes]:
+    """
+    Function to read the source key of a snapshot without mapping it.
+
+    :param filename: The path of the snapshot.
+    :return: The key, or None if the file is missing or is not a snapshot of the current format.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            header: bytes = f.read(SNAPSHOT_HEADER.size)
+    except OSError:
+        return None
+
+    if len(header) < SNAPSHOT_HEADER.size:
+        return None
+    magic, marker, version, *_, key = SNAPSHOT_HEADER.unpack(header)
+    return key if magic == SNAPSHOT_MAGIC and marker == 1 and version == SNAPSHOT_VERSION else None
+
+
+def write_snapshot(db_connection: Connection, filename: str) -> bool:
+    """
+    Function to write the recipes and shard metadata of a database to a snapshot file.
+
+    The file holds a fixed header, the recipe columns and the CSR indexes of `RecipeStore` as raw native integers
+    (each section padded to 8 bytes, so it can be cast in place), then the product IDs and shard metadata as JSON. It
+    is written to a temporary file first and moved into place, so readers never see a partial snapshot.
+
+    :param db_connection: The connection to the SQLite database containing the recipes and shards.
+    :param filename: The path of the snapshot.
+    :return: True if the snapshot was written, False if the database has no build cache to key it with.
+    """
+    cursor: Cursor = db_connection.cursor()
+    key: Optional[bytes] = source_key(cursor)
+    if key is None:
+        return False
+
+    store: RecipeStore = RecipeStore.from_connection(db_connection)
+    cursor.execute(f"SELECT {', '.join(SHARD_COLUMNS)} FROM shard_to_productid ORDER BY shard_id")
+    shard_rows: List[Tuple] = cursor.fetchall()
+    strings: bytes = dumps({
+        'product_ids': store.product_ids,
+        'shards': {name: [row[index] for row in shard_rows] for index, name in enumerate(SHARD_COLUMNS)}
+    }).encode()
+
+    sections: List[bytes] = [
+        array('q', store.recipe_ids).tobytes(),
+        *(array('i', column).tobytes() for column in (store.quantity_1, store.ingredient_1, store.quantity_2,
+                                                      store.ingredient_2, store.output_quantity, store.output_item)),
+        *(array('q', index).tobytes() for index in (store.by_ingredient_offsets, store.by_ingredient,
+                                                    store.by_output_offsets, store.by_output)),
+        strings
+    ]
+
+    temporary: str = f'{filename}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 1, SNAPSHOT_VERSION, len(store), len(store.product_ids),
+                                     len(store.by_ingredient), len(store.by_output), len(strings), key))
+        f.write(bytes(HEADER_SIZE - SNAPSHOT_HEADER.size))
+        for section in sections:
+            f.write(section)
+            f.write(bytes(-len(section) % 8))
+    replace(temporary, filename)
+    return True
+
+
+def read_snapshot(db_connection: Connection, filename: str) -> Optional[RecipeSnapshot]:
+    """
+    Function to map a snapshot, if it matches the sources the database was built from.
+
+    :param db_connection: The connection to the SQLite database the snapshot was written from.
+    :param filename: The path of the snapshot.
+    :return: The snapshot, or None if it is missing, of another format or out of date (the recipes should then be
+    read from the database).
+    """
+    key: Optional[bytes] = read_snapshot_key(filename)
+    if key is None or key != source_key(db_connection.cursor()):
+        return None
+
+    with open(filename, 'rb') as f:
+        mapped: mmap = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    view: memoryview = memoryview(mapped)
+    _, _, _, recipes, products, by_ingredient, by_output, strings_length, _ = \
+        SNAPSHOT_HEADER.unpack(view[:SNAPSHOT_HEADER.size])
+
+    offset: int = HEADER_SIZE
+
+    def section(size: int, typecode: Optional[str] = None) -> memoryview:
+        nonlocal offset
+        start: int = offset
+        offset += (size + 7) // 8 * 8
+        return view[start:start + size].cast(typecode) if typecode else view[start:start + size]
+
+    recipe_ids: memoryview = section(recipes * 8, 'q')
+    columns: List[memoryview] = [section(recipes * 4, 'i') for _ in range(6)]
+    indexes: List[memoryview] = [section(count * 8, 'q')
+                                 for count in (products + 1, by_ingredient, products + 1, by_output)]
+    strings: Dict = loads(bytes(section(strings_length)))
+
+    store: RecipeStore = RecipeStore(strings['product_ids'], recipe_ids, *columns, indexes=indexes)
+    return RecipeSnapshot(store, strings['shards'])
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+from array import array
+from sqlite3 import Connection, Cursor
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from polars import DataFrame
+
+
+class RecipeStore:
+    """
+    Compact in-memory copy of `shard_recipes_processed`.
+
+    Product IDs are interned to small integers (their position in `product_ids`), and every recipe column is kept in
+    a typed array, so a recipe costs a few dozen bytes instead of a dictionary of strings. Recipes are addressed by
+    their position in the store; `recipe_ids` maps positions back to the recipe IDs used in the database. The
+    by-ingredient and by-output indexes are stored as offset arrays (CSR), which makes the recipes of a product an O(1)
+    slice.
+
+    The columns and indexes can also be memoryviews over a memory-mapped snapshot (see `recipe_snapshot`), and Polars
+    is only imported by `to_frame`, so a store can be loaded without it.
+    """
+
+    def __init__(self, product_ids: List[str], recipe_ids: array, quantity_1: array, ingredient_1: array,
+                 quantity_2: array, ingredient_2: array, output_quantity: array, output_item: array,
+                 indexes: Optional[Sequence[array]] = None):
+        self.product_ids: List[str] = product_ids
+        self.product_index: Dict[str, int] = {product_id: index for index, product_id in enumerate(product_ids)}
+
+        self.recipe_ids: array = recipe_ids
+        self.quantity_1: array = quantity_1
+        self.ingredient_1: array = ingredient_1
+        self.quantity_2: array = quantity_2
+        self.ingredient_2: array = ingredient_2
+        self.output_quantity: array = output_quantity
+        self.output_item: array = output_item
+
+        # Prebuilt indexes, e.g. from a snapshot, in the order of the attributes below
+        if indexes is not None:
+            self.by_ingredient_offsets, self.by_ingredient, self.by_output_offsets, self.by_output = indexes
+        else:
+            self.by_ingredient_offsets, self.by_ingredient = self._build_index((ingredient_1, ingredient_2))
+            self.by_output_offsets, self.by_output = self._build_index((output_item,))
+
+    def _build_index(self, columns: Sequence[array]) -> Tuple[array, array]:
+        """
+        Build a CSR index from products to the positions of the recipes that reference them in any of the columns.
+
+        :param columns: The interned product columns to index.
+        :return: The offsets (one more than the number of products) and the recipe positions.
+        """
+        counts: List[int] = [0] * (len(self.product_ids) + 1)
+        for position in range(len(self)):
+            for product in {column[position] for column in columns}:
+                counts[product + 1] += 1
+
+        for product in range(len(self.product_ids)):
+            counts[product + 1] += counts[product]
+
+        offsets: array = array('l', counts)
+        positions: array = array('l', bytes(offsets.itemsize * counts[-1]))
+        cursor: List[int] = counts[:-1]
+        for position in range(len(self)):
+            for product in {column[position] for column in columns}:
+                positions[cursor[product]] = position
+                cursor[product] += 1
+
+        return offsets, positions
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[int, int, str, int, str, int, str]]) -> 'RecipeStore':
+        """
+        Build a store from recipe rows.
+
+        :param rows: Tuples of (recipe_id, quantity_1, ingredient_1, quantity_2, ingredient_2, output_quantity,
+        output_item).
+        :return: The store.
+        """
+        product_ids: List[str] = []
+        product_index: Dict[str, int] = {}
+
+        def intern(product_id: str) -> int:
+            index: Optional[int] = product_index.get(product_id)
+            if index is None:
+                index = product_index[product_id] = len(product_ids)
+                product_ids.append(product_id)
+            return index
+
+        columns: Tuple[array, ...] = tuple(array('l') if code == 'l' else array('i') for code in 'liiiiii')
+        recipe_ids, quantity_1, ingredient_1, quantity_2, ingredient_2, output_quantity, output_item = columns
+        for row in rows:
+            recipe_ids.append(row[0])
+            quantity_1.append(row[1])
+            ingredient_1.append(intern(row[2]))
+            quantity_2.append(row[3])
+            ingredient_2.append(intern(row[4]))
+            output_quantity.append(row[5])
+            output_item.append(intern(row[6]))
+
+        return cls(product_ids, *columns)
+
+    @classmethod
+    def from_connection(cls, db_connection: Connection) -> 'RecipeStore':
+        """
+        Build a store from `shard_recipes_processed`, ordered by recipe ID.
+
+        :param db_connection: The connection to the SQLite database containing the shard recipes.
+        :return: The store.
+        """
+        cursor: Cursor = db_connection.cursor()
+        cursor.execute("""
+                       SELECT recipe_id,
+                              quantity_1,
+                              ingredient_1,
+                              quantity_2,
+                              ingredient_2,
+                              output_quantity,
+                              output_item
+                       FROM shard_recipes_processed
+                       ORDER BY recipe_id
+                       """)
+        return cls.from_rows(cursor)
+
+    def __len__(self) -> int:
+        return len(self.recipe_ids)
+
+    def recipes_using(self, product_id: str) -> array:
+        """
+        The positions of the recipes that use a product as an ingredient.
+
+        :param product_id: The product ID.
+        :return: The recipe positions (empty if the product is unknown).
+        """
+        index: Optional[int] = self.product_index.get(product_id)
+        if index is None:
+            return array('l')
+        return self.by_ingredient[self.by_ingredient_offsets[index]:self.by_ingredient_offsets[index + 1]]
+
+    def recipes_producing(self, product_id: str) -> array:
+        """
+        The positions of the recipes that output a product.
+
+        :param product_id: The product ID.
+        :return: The recipe positions (empty if the product is unknown).
+        """
+        index: Optional[int] = self.product_index.get(product_id)
+        if index is None:
+            return array('l')
+        return self.by_output[self.by_output_offsets[index]:self.by_output_offsets[index + 1]]
+
+    def recipes_referencing(self, product_ids: Iterable[str]) -> List[int]:
+        """
+        The positions of the recipes that use any of the products as an ingredient or output.
+
+        :param product_ids: The product IDs.
+        :return: The sorted, unique recipe positions.
+        """
+        positions: Set[int] = set()
+        for product_id in product_ids:
+            positions.update(self.recipes_using(product_id))
+            positions.update(self.recipes_producing(product_id))
+        return sorted(positions)
+
+    def to_frame(self, positions: Optional[Sequence[int]] = None) -> DataFrame:
+        """
+        Build a recipe DataFrame, in the same shape as `calculate_profits.load_recipe_frame`.
+
+        :param positions: The positions of the recipes to include. Every recipe is included if not given.
+        :return: A DataFrame with a `recipe_id` column and the recipe columns, with product IDs as strings.
+        """
+        from polars import DataFrame, Int64, Series, UInt32, Utf8
+
+        columns: Dict[str, array] = {
+            'recipe_id': self.recipe_ids,
+            'quantity_1': self.quantity_1,
+            'ingredient_1': self.ingredient_1,
+            'quantity_2': self.quantity_2,
+            'ingredient_2': self.ingredient_2,
+            'output_quantity': self.output_quantity,
+            'output_item': self.output_item
+        }
+        if positions is not None:
+            columns = {name: array(values.typecode if isinstance(values, array) else values.format,
+                                   (values[position] for position in positions))
+                       for name, values in columns.items()}
+
+        products: Series = Series(self.product_ids, dtype=Utf8)
+        return DataFrame({
+            'recipe_id': Series(columns['recipe_id'], dtype=UInt32),
+            'quantity_1': Series(columns['quantity_1'], dtype=Int64),
+            'ingredient_1': products.gather(Series(columns['ingredient_1'], dtype=UInt32)),
+            'quantity_2': Series(columns['quantity_2'], dtype=Int64),
+            'ingredient_2': products.gather(Series(columns['ingredient_2'], dtype=UInt32)),
+            'output_quantity': Series(columns['output_quantity'], dtype=Int64),
+            'output_item': products.gather(Series(columns['output_item'], dtype=UInt32))
+        })
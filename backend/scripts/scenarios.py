@@ -0,0 +1,216 @@
+from dataclasses import asdict, dataclass, field
+from json import JSONDecodeError, dumps, load as json_load
+from sqlite3 import Connection, Cursor
+from typing import Dict, Iterable, List, Optional
+
+from polars import Boolean, DataFrame, Float64, Int64, Utf8, col, when
+
+from backend.scripts.calculate_profits import load_bazaar_frame, load_product_frame
+from backend.scripts.recipe_store import RecipeStore
+
+# How ingredients are priced: insta-buying them, or placing buy orders at the best current buy order price
+INSTA_BUY: str = 'insta_buy'
+BUY_ORDER: str = 'buy_order'
+
+
+@dataclass(frozen=True)
+class Scenario:
+    """
+    One set of assumptions to evaluate every recipe under.
+
+    `price_shocks` multiplies the bazaar prices of the given products (e.g. {'SHARD_GROVE': 1.1} for a 10% rise), and
+    `tax_rate` is the fraction of the revenue lost to the bazaar tax.
+    """
+    scenario_id: str
+    cope_mode: bool = False
+    skip_empty_orders: bool = True
+    pricing: str = INSTA_BUY
+    tax_rate: float = 0.0
+    price_shocks: Dict[str, float] = field(default_factory=dict)
+
+
+def load_scenarios(configs: Iterable[Dict]) -> List[Scenario]:
+    """
+    Function to build scenarios from their configurations, e.g. as loaded from a JSON file.
+
+    :param configs: One dictionary per scenario, with the fields of `Scenario`.
+    :return: The scenarios.
+    """
+    scenarios: List[Scenario] = [Scenario(**config) for config in configs]
+    for scenario in scenarios:
+        if scenario.pricing not in (INSTA_BUY, BUY_ORDER):
+            raise ValueError(f'Unknown pricing {scenario.pricing!r} in scenario {scenario.scenario_id!r}')
+
+    if len({scenario.scenario_id for scenario in scenarios}) != len(scenarios):
+        raise ValueError('Scenario IDs must be unique')
+    return scenarios
+
+
+def read_scenarios(filename: str) -> List[Scenario]:
+    """
+    Function to read scenarios from a JSON file holding a list of scenario configurations (see `load_scenarios`).
+    Unlike `fetch_info.json_to_dict`, a file that is missing or malformed is an error, not an empty list.
+
+    :param filename: The JSON file.
+    :return: The scenarios. A ValueError naming the file is raised if it cannot be read, or does not hold a list of
+    valid scenario configurations.
+    """
+    try:
+        with open(filename) as f:
+            configs: List[Dict] = json_load(f)
+    except (OSError, JSONDecodeError) as e:
+        raise ValueError(f'Could not read the scenarios from {filename}: {e}') from e
+
+    if not isinstance(configs, list) or not all(isinstance(config, dict) for config in configs):
+        raise ValueError(f'{filename} must hold a list of scenario objects')
+
+    try:
+        return load_scenarios(configs)
+    except TypeError as e:
+        # Unknown or missing fields
+        raise ValueError(f'Invalid scenario in {filename}: {e}') from e
+
+
+def compute_scenario_frame(recipes: DataFrame, bazaar: DataFrame, products: DataFrame,
+                           scenarios: List[Scenario]) -> DataFrame:
+    """
+    Function to compute the profit of every recipe under every scenario in one vectorized pass.
+
+    The recipes and bazaar prices are crossed with a scenario axis, so every scenario is evaluated by the same
+    expressions, which Polars runs across all cores, and the recipe and bazaar data are only loaded once. With the
+    default scenario settings, the profits are the ones of `calculate_profits.compute_profit_frame`.
+
+    :param recipes: The recipes, as returned by `load_recipe_frame` or `RecipeStore.to_frame`.
+    :param bazaar: The bazaar snapshot, as returned by `load_bazaar_frame`.
+    :param products: The shard metadata, as returned by `load_product_frame`.
+    :param scenarios: The scenarios to evaluate.
+    :return: A DataFrame with the scenario ID, recipe ID, cost, revenue and profit of every priced recipe.
+    """
+    settings: DataFrame = DataFrame({
+        'scenario_id': [scenario.scenario_id for scenario in scenarios],
+        'cope_mode': [scenario.cope_mode for scenario in scenarios],
+        'skip_empty_orders': [scenario.skip_empty_orders for scenario in scenarios],
+        'buy_order_pricing': [scenario.pricing == BUY_ORDER for scenario in scenarios],
+        'tax_rate': [float(scenario.tax_rate) for scenario in scenarios]
+    }, schema={'scenario_id': Utf8, 'cope_mode': Boolean, 'skip_empty_orders': Boolean,
+               'buy_order_pricing': Boolean, 'tax_rate': Float64})
+    shocks: DataFrame = DataFrame([
+        (scenario.scenario_id, product_id, float(multiplier))
+        for scenario in scenarios for product_id, multiplier in scenario.price_shocks.items()
+    ], schema={'scenario_id': Utf8, 'product_id': Utf8, 'shock': Float64}, orient='row')
+
+    # One row per scenario and product, with the prices of that scenario
+    prices: DataFrame = (
+        bazaar.select('product_id', 'buy_price', 'sell_price', 'sell_volume', 'buy_orders')
+        .join(settings, how='cross')
+        .join(shocks, on=['scenario_id', 'product_id'], how='left')
+        .with_columns(col('shock').fill_null(1.0))
+        .select(
+            'scenario_id',
+            'product_id',
+            (when(col('buy_order_pricing')).then(col('sell_price')).otherwise(col('buy_price')) * col('shock'))
+            .alias('ingredient_price'),
+            (col('buy_price') * col('shock')).alias('output_price'),
+            'sell_volume',
+            'buy_orders'
+        )
+    )
+    reptiles: DataFrame = products.select(col('productID').alias('product_id'),
+                                          (col('family') == 'Reptile').alias('is_reptile'))
+
+    def ingredient(position: int) -> DataFrame:
+        return prices.select(
+            'scenario_id',
+            col('product_id').alias(f'ingredient_{position}'),
+            col('ingredient_price').alias(f'ingredient_{position}_price'),
+            col('buy_orders').alias(f'ingredient_{position}_buy_orders')
+        ).join(reptiles.rename({'product_id': f'ingredient_{position}',
+                                'is_reptile': f'ingredient_{position}_is_reptile'}),
+               on=f'ingredient_{position}', how='left')
+
+    return (
+        recipes.lazy()
+        .join(settings.lazy(), how='cross')
+        .join(prices.select('scenario_id', col('product_id').alias('output_item'), 'output_price', 'sell_volume')
+              .lazy(), on=['scenario_id', 'output_item'], how='inner')
+        .join(ingredient(1).lazy(), on=['scenario_id', 'ingredient_1'], how='left')
+        .join(ingredient(2).lazy(), on=['scenario_id', 'ingredient_2'], how='left')
+        .filter(
+            ~col('skip_empty_orders') |
+            ~(col('ingredient_1_buy_orders').eq(0).fill_null(False) |
+              col('ingredient_2_buy_orders').eq(0).fill_null(False))
+        )
+        .with_columns(
+            (col('ingredient_1_price') * col('quantity_1')).alias('cost_1'),
+            (col('ingredient_2_price') * col('quantity_2')).alias('cost_2'),
+            # Reptile shards have 20% chance to double the output in COPE mode
+            (col('output_price') * col('output_quantity') *
+             when(col('cope_mode') &
+                  (col('ingredient_1_is_reptile').fill_null(False) | col('ingredient_2_is_reptile').fill_null(False)))
+             .then(1.2)
+             .otherwise(1.0) *
+             (1 - col('tax_rate'))).alias('revenue')
+        )
+        .filter(col('cost_1').is_not_null() & col('cost_2').is_not_null())
+        .select(
+            'scenario_id',
+            'recipe_id',
+            (col('cost_1') + col('cost_2')).alias('cost'),
+            'revenue',
+            (col('revenue') - (col('cost_1') + col('cost_2'))).floor().cast(Int64).alias('profit'),
+            col('sell_volume').alias('demand')
+        )
+        .sort('scenario_id', 'recipe_id')
+        .collect()
+    )
+
+
+def store_scenario_profits(db_connection: Connection, scenarios: List[Scenario],
+                           store: Optional[RecipeStore] = None) -> DataFrame:
+    """
+    Function to evaluate scenarios against the stored recipes and bazaar data, and store the results keyed by scenario
+    ID. The previous results of the same scenario IDs are replaced, and those of other scenarios are kept.
+
+    :param db_connection: The connection to the SQLite database containing the shard recipes and bazaar data.
+    :param scenarios: The scenarios to evaluate.
+    :param store: The recipes, if they are already loaded. They are read from the database otherwise.
+    :return: The results, as returned by `compute_scenario_frame`.
+    """
+    if store is None:
+        store = RecipeStore.from_connection(db_connection)
+
+    results: DataFrame = compute_scenario_frame(store.to_frame(), load_bazaar_frame(db_connection),
+                                                load_product_frame(db_connection), scenarios)
+
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS profit_scenarios
+                   (
+                       scenario_id TEXT PRIMARY KEY,
+                       config      TEXT NOT NULL
+                   )
+                   ''')
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS shard_profit_scenarios
+                   (
+                       scenario_id TEXT    NOT NULL,
+                       recipe_id   INTEGER NOT NULL,
+                       cost        REAL,
+                       revenue     REAL,
+                       profit      REAL,
+                       demand      REAL,
+                       PRIMARY KEY (scenario_id, recipe_id)
+                   ) WITHOUT ROWID
+                   ''')
+
+    with db_connection:
+        cursor.executemany('DELETE FROM shard_profit_scenarios WHERE scenario_id = ?',
+                           ((scenario.scenario_id,) for scenario in scenarios))
+        cursor.executemany('INSERT OR REPLACE INTO profit_scenarios (scenario_id, config) VALUES (?, ?)',
+                           ((scenario.scenario_id, dumps(asdict(scenario))) for scenario in scenarios))
+        cursor.executemany('''
+                           INSERT INTO shard_profit_scenarios (scenario_id, recipe_id, cost, revenue, profit, demand)
+                           VALUES (?, ?, ?, ?, ?, ?)
+                           ''', results.iter_rows())
+
+    return results
@@ -0,0 +1,291 @@
+from ast import literal_eval
+from json import dumps
+from sqlite3 import Connection, Cursor
+from time import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# The version of the database layout written by the current scripts
+SCHEMA_VERSION: int = 5
+
+SHARD_TABLE: str = '''
+                   CREATE TABLE IF NOT EXISTS shard_to_productid
+                   (
+                       shard_id   INTEGER PRIMARY KEY,
+                       name       TEXT NOT NULL UNIQUE,
+                       productID  TEXT UNIQUE,
+                       rarity     TEXT,
+                       family     TEXT,
+                       craftingID TEXT
+                   )
+                   '''
+
+RECIPE_TABLE: str = '''
+                    CREATE TABLE IF NOT EXISTS shard_recipes_processed
+                    (
+                        recipe_id       INTEGER PRIMARY KEY,
+                        quantity_1      INTEGER,
+                        ingredient_1    TEXT,
+                        quantity_2      INTEGER,
+                        ingredient_2    TEXT,
+                        output_quantity INTEGER,
+                        output_item     TEXT
+                    )
+                    '''
+
+PROFIT_TABLE: str = '''
+                    CREATE TABLE IF NOT EXISTS shard_profit_data
+                    (
+                        recipe_id             INTEGER PRIMARY KEY,
+                        output_item           TEXT,
+                        demand                REAL,
+                        profit                REAL,
+                        cost                  REAL,
+                        ingredients           TEXT,
+                        id                    TEXT,
+                        current_price         REAL,
+                        median_profit         REAL,
+                        profit_per_volatility REAL
+                    )
+                    '''
+
+# Each recipe index holds every column, so lookups by ingredient or output never touch the table itself
+RECIPE_INDEXES: Tuple[str, ...] = (
+    '''CREATE INDEX IF NOT EXISTS idx_recipes_ingredient_1
+       ON shard_recipes_processed (ingredient_1, quantity_1, ingredient_2, quantity_2, output_quantity, output_item)''',
+    '''CREATE INDEX IF NOT EXISTS idx_recipes_ingredient_2
+       ON shard_recipes_processed (ingredient_2, quantity_2, ingredient_1, quantity_1, output_quantity, output_item)''',
+    '''CREATE INDEX IF NOT EXISTS idx_recipes_output_item
+       ON shard_recipes_processed (output_item, output_quantity, ingredient_1, quantity_1, ingredient_2, quantity_2)'''
+)
+
+PROFIT_INDEXES: Tuple[str, ...] = (
+    '''CREATE INDEX IF NOT EXISTS idx_profit_output_item ON shard_profit_data (output_item, profit)''',
+    '''CREATE INDEX IF NOT EXISTS idx_profit_profit ON shard_profit_data (profit DESC)'''
+)
+
+
+def table_exists(cursor: Cursor, table_name: str) -> bool:
+    """
+    Function to check whether a table exists in the database.
+
+    :param cursor: A cursor on the database.
+    :param table_name: The name of the table.
+    :return: True if the table exists.
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
+    return cursor.fetchone() is not None
+
+
+def table_columns(cursor: Cursor, table_name: str) -> List[str]:
+    """
+    Function to list the columns of a table.
+
+    :param cursor: A cursor on the database.
+    :param table_name: The name of the table.
+    :return: The column names, in order (empty if the table does not exist).
+    """
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    return [row[1] for row in cursor.fetchall()]
+
+
+def get_schema_version(db_connection: Connection) -> int:
+    """
+    Function to read the schema version of a database.
+
+    :param db_connection: The connection to the SQLite database.
+    :return: The last applied version, or 0 for databases written before versioning existed.
+    """
+    cursor: Cursor = db_connection.cursor()
+    if not table_exists(cursor, 'schema_version'):
+        return 0
+
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    version: Optional[int] = cursor.fetchone()[0]
+    return version or 0
+
+
+def ingredients_to_json(ingredients: str) -> Tuple[str, Optional[int]]:
+    """
+    Function to convert an ingredient list written with `str()` of a list of dictionaries into JSON.
+
+    :param ingredients: The serialised ingredients.
+    :return: The JSON ingredients and their total cost (None if the text could not be parsed).
+    """
+    try:
+        parsed: List[Dict[str, str or int]] = literal_eval(ingredients)
+    except (ValueError, SyntaxError):
+        return ingredients, None
+
+    return dumps(parsed, separators=(',', ':')), sum(ingredient.get('cost', 0) for ingredient in parsed)
+
+
+def migrate_to_1(cursor: Cursor) -> None:
+    """
+    Migration to version 1:
+        - `shard_to_productid` gets an integer `shard_id` key, with unique names and product IDs.
+        - `shard_recipes_processed` gets an integer `recipe_id` key (its former row order, from 0) and covering
+          indexes on both ingredients and the output.
+        - `shard_profit_data` stores its ingredients as JSON, gets a `cost` column and indexes on the output and
+          profit.
+
+    :param cursor: A cursor on the database, inside a transaction.
+    :return: None
+    """
+    if table_exists(cursor, 'shard_to_productid') and 'shard_id' not in table_columns(cursor, 'shard_to_productid'):
+        cursor.execute("ALTER TABLE shard_to_productid RENAME TO shard_to_productid_old")
+        cursor.execute(SHARD_TABLE)
+        cursor.execute('''
+                       INSERT INTO shard_to_productid (name, productID, rarity, family, craftingID)
+                       SELECT name, productID, rarity, family, craftingID
+                       FROM shard_to_productid_old
+                       ORDER BY rowid
+                       ''')
+        cursor.execute("DROP TABLE shard_to_productid_old")
+
+    if table_exists(cursor, 'shard_recipes_processed') and \
+            'recipe_id' not in table_columns(cursor, 'shard_recipes_processed'):
+        cursor.execute("ALTER TABLE shard_recipes_processed RENAME TO shard_recipes_processed_old")
+        cursor.execute(RECIPE_TABLE)
+        cursor.execute('''
+                       INSERT INTO shard_recipes_processed
+                       (recipe_id, quantity_1, ingredient_1, quantity_2, ingredient_2, output_quantity, output_item)
+                       SELECT ROW_NUMBER() OVER (ORDER BY rowid) - 1,
+                              quantity_1,
+                              ingredient_1,
+                              quantity_2,
+                              ingredient_2,
+                              output_quantity,
+                              output_item
+                       FROM shard_recipes_processed_old
+                       ''')
+        cursor.execute("DROP TABLE shard_recipes_processed_old")
+
+    if table_exists(cursor, 'shard_recipes_processed'):
+        for statement in RECIPE_INDEXES:
+            cursor.execute(statement)
+
+    if table_exists(cursor, 'shard_profit_data') and 'cost' not in table_columns(cursor, 'shard_profit_data'):
+        cursor.execute("ALTER TABLE shard_profit_data ADD COLUMN cost REAL")
+        cursor.execute("SELECT recipe_id, ingredients FROM shard_profit_data")
+        cursor.executemany("UPDATE shard_profit_data SET ingredients = ?, cost = ? WHERE recipe_id = ?",
+                           [(*ingredients_to_json(ingredients), recipe_id)
+                            for recipe_id, ingredients in cursor.fetchall()])
+
+    if table_exists(cursor, 'shard_profit_data'):
+        for statement in PROFIT_INDEXES:
+            cursor.execute(statement)
+
+
+def migrate_to_2(cursor: Cursor) -> None:
+    """
+    Migration to version 2: the rows of the `product_price_history` table, keyed by ISO text timestamps, are moved
+    into `price_history_points` (see `price_history`) and rolled up, and the table is replaced by a view with the same
+    columns, whose inserted rows are stored in `price_history_points`.
+
+    :param cursor: A cursor on the database, inside a transaction.
+    :return: None
+    """
+    if not table_exists(cursor, 'product_price_history'):
+        return
+
+    # Imported here, so reading the schema does not load Polars through `price_history`
+    from backend.scripts.price_history import add_price_points, create_price_history_tables, parse_timestamp
+
+    cursor.execute("SELECT product_id, buy_price, sell_price, timestamp FROM product_price_history")
+    history_rows: List[Tuple[str, float, float, str]] = cursor.fetchall()
+    cursor.execute("DROP TABLE product_price_history")
+
+    create_price_history_tables(cursor)
+    add_price_points(cursor, sorted((product_id, parse_timestamp(timestamp), buy_price, sell_price)
+                                    for product_id, buy_price, sell_price, timestamp in history_rows))
+
+
+def migrate_to_3(cursor: Cursor) -> None:
+    """
+    Migration to version 3: `shard_profit_data` gets the `median_profit` and `profit_per_volatility` columns (see
+    `price_analytics`), left empty until the next profit calculation.
+
+    :param cursor: A cursor on the database, inside a transaction.
+    :return: None
+    """
+    if not table_exists(cursor, 'shard_profit_data'):
+        return
+
+    columns: List[str] = table_columns(cursor, 'shard_profit_data')
+    for column in ('median_profit', 'profit_per_volatility'):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE shard_profit_data ADD COLUMN {column} REAL")
+
+
+def migrate_to_4(cursor: Cursor) -> None:
+    """
+    Migration to version 4: the price history tables are created if they do not exist, with the trigger storing the
+    rows inserted into the `product_price_history` view, so the frontend can write its price history through the view
+    and read the chart ranges from `price_history_points`.
+
+    :param cursor: A cursor on the database, inside a transaction.
+    :return: None
+    """
+    # Imported here, so reading the schema does not load Polars through `price_history`
+    from backend.scripts.price_history import create_price_history_tables
+
+    create_price_history_tables(cursor)
+
+
+def migrate_to_5(cursor: Cursor) -> None:
+    """
+    Migration to version 5: `price_analytics` gets the `last_samples` column (see `price_analytics`), and its rows
+    are cleared, so the next update recomputes every product along with its `price_analytics_series`.
+
+    :param cursor: A cursor on the database, inside a transaction.
+    :return: None
+    """
+    if not table_exists(cursor, 'price_analytics'):
+        return
+
+    if 'last_samples' not in table_columns(cursor, 'price_analytics'):
+        cursor.execute("ALTER TABLE price_analytics ADD COLUMN last_samples INTEGER")
+    cursor.execute("DELETE FROM price_analytics")
+
+
+# Migrations by the version they bring the database to
+MIGRATIONS: Dict[int, Callable[[Cursor], None]] = {
+    1: migrate_to_1,
+    2: migrate_to_2,
+    3: migrate_to_3,
+    4: migrate_to_4,
+    5: migrate_to_5
+}
+
+
+def migrate_database(db_connection: Connection) -> int:
+    """
+    Function to bring a database to the current schema version, applying every missing migration in place.
+    Each migration runs in its own transaction, together with the `schema_version` row recording it, so an
+    interrupted migration leaves the database at the previous version.
+
+    Migrations only rewrite the tables that already exist, apart from the price history tables the frontend writes to,
+    so they can also be run on an empty database before the tables are built.
+
+    :param db_connection: The connection to the SQLite database.
+    :return: The schema version of the database after the migration.
+    """
+    cursor: Cursor = db_connection.cursor()
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS schema_version
+                   (
+                       version    INTEGER PRIMARY KEY,
+                       applied_at INTEGER NOT NULL
+                   )
+                   ''')
+    db_connection.commit()
+
+    for version in range(get_schema_version(db_connection) + 1, SCHEMA_VERSION + 1):
+        with db_connection:
+            cursor.execute("BEGIN")
+            MIGRATIONS[version](cursor)
+            cursor.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                           (version, int(time())))
+        print(f'Migrated the database to schema version {version}')
+
+    return SCHEMA_VERSION
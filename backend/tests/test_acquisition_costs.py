@@ -0,0 +1,38 @@
+from unittest import TestCase, main
+
+from polars import DataFrame
+
+from backend.scripts.acquisition_costs import compute_acquisition_costs
+from backend.scripts.recipe_store import RecipeStore
+
+BAZAAR: DataFrame = DataFrame({
+    'product_id': ['SHARD_A', 'SHARD_B', 'SHARD_C', 'SHARD_D', 'SHARD_E'],
+    'buy_price': [10.0, 10.0, 100.0, 1.0, 5.0],
+    'buy_orders': [1, 1, 1, 1, 1]
+})
+PRODUCTS: DataFrame = DataFrame({'productID': BAZAAR['product_id']})
+
+
+class AcquisitionCostsTest(TestCase):
+    def test_loop_gaining_value_keeps_buy_prices(self) -> None:
+        # Two A make three B and two B make three A, so fusing back and forth drives both costs towards zero, and C is
+        # fused from A. E does not depend on the loop and is still cheaper to fuse
+        store: RecipeStore = RecipeStore.from_rows([
+            (0, 1, 'SHARD_A', 1, 'SHARD_A', 3, 'SHARD_B'),
+            (1, 1, 'SHARD_B', 1, 'SHARD_B', 3, 'SHARD_A'),
+            (2, 1, 'SHARD_A', 1, 'SHARD_D', 1, 'SHARD_C'),
+            (3, 1, 'SHARD_D', 1, 'SHARD_D', 1, 'SHARD_E')
+        ])
+        acquisition: DataFrame = compute_acquisition_costs(store, BAZAAR, PRODUCTS)
+
+        self.assertEqual(acquisition.select('product_id', 'acquisition_cost', 'source').rows(), [
+            ('SHARD_A', 10.0, 'buy'),
+            ('SHARD_B', 10.0, 'buy'),
+            ('SHARD_C', 100.0, 'buy'),
+            ('SHARD_D', 1.0, 'buy'),
+            ('SHARD_E', 2.0, 'craft')
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+from os import path
+from sqlite3 import connect, Connection
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional, Tuple
+from unittest import TestCase, main
+
+from polars import DataFrame
+
+from backend.scripts.build_database import store_data_in_database
+
+RECIPES: DataFrame = DataFrame({
+    'quantity_1': [1],
+    'ingredient_1': ['Alpha'],
+    'quantity_2': [1],
+    'ingredient_2': ['Beta'],
+    'output_quantity': [1],
+    'output_item': ['Gamma']
+})
+
+
+def shards_data(product_ids: Dict[str, Optional[str]]) -> Dict:
+    return {'shards': {name: {'name': name, 'productID': product_id, 'rarity': 'common', 'family': ['Test'],
+                              'id': name}
+                       for name, product_id in product_ids.items()}}
+
+
+class StoreShardsTest(TestCase):
+    def setUp(self) -> None:
+        self.directory: TemporaryDirectory = TemporaryDirectory()
+        self.db_path: str = path.join(self.directory.name, 'shard_recipes.db')
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def store(self, product_ids: Dict[str, Optional[str]]) -> List[Tuple[int, str, Optional[str]]]:
+        store_data_in_database(RECIPES, shards_data(product_ids), db_path=self.db_path)
+        db_connection: Connection = connect(self.db_path)
+        try:
+            return db_connection.execute('SELECT shard_id, name, productID FROM shard_to_productid ORDER BY shard_id') \
+                .fetchall()
+        finally:
+            db_connection.close()
+
+    def test_renamed_shard_keeps_its_id(self) -> None:
+        self.store({'Alpha': 'SHARD_ALPHA', 'Beta': 'SHARD_BETA', 'Gamma': 'SHARD_GAMMA'})
+        self.assertEqual(self.store({'Alpha': 'SHARD_ALPHA', 'Bet': 'SHARD_BETA', 'Gamma': 'SHARD_GAMMA'}),
+                         [(1, 'Alpha', 'SHARD_ALPHA'), (2, 'Bet', 'SHARD_BETA'), (3, 'Gamma', 'SHARD_GAMMA')])
+
+    def test_shards_swapping_product_ids(self) -> None:
+        self.store({'Alpha': 'SHARD_ALPHA', 'Beta': 'SHARD_BETA', 'Gamma': 'SHARD_GAMMA'})
+        self.assertEqual(self.store({'Alpha': 'SHARD_BETA', 'Beta': 'SHARD_ALPHA', 'Gamma': 'SHARD_GAMMA'}),
+                         [(1, 'Alpha', 'SHARD_BETA'), (2, 'Beta', 'SHARD_ALPHA'), (3, 'Gamma', 'SHARD_GAMMA')])
+
+    def test_product_id_moving_to_another_shard(self) -> None:
+        self.store({'Alpha': 'SHARD_ALPHA', 'Beta': 'SHARD_BETA', 'Gamma': 'SHARD_GAMMA'})
+        self.assertEqual(self.store({'Alpha': 'SHARD_BETA', 'Beta': None, 'Gamma': 'SHARD_GAMMA',
+                                     'Delta': 'SHARD_ALPHA'}),
+                         [(1, 'Alpha', 'SHARD_BETA'), (2, 'Beta', None), (3, 'Gamma', 'SHARD_GAMMA'),
+                          (4, 'Delta', 'SHARD_ALPHA')])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+from os import path
+from sqlite3 import connect, Connection
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+
+from backend.scripts.metrics import metrics, store_metrics, write_exposition
+
+
+class StoreMetricsTest(TestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+        self.db_connection: Connection = connect(':memory:')
+
+    def tearDown(self) -> None:
+        metrics.reset()
+        self.db_connection.close()
+
+    def test_snapshots_hold_their_own_values_and_the_exposition_the_totals(self) -> None:
+        metrics.increment('rows_processed', 5, stage='profits')
+        store_metrics(self.db_connection, recorded_at=100)
+        metrics.increment('rows_processed', 2, stage='profits')
+        store_metrics(self.db_connection, recorded_at=100)
+
+        self.assertEqual(self.db_connection.execute('SELECT recorded_at, count, total FROM pipeline_metrics')
+                         .fetchall(), [(100, 1, 5.0), (101, 1, 2.0)])
+
+        with TemporaryDirectory() as directory:
+            filename: str = path.join(directory, 'metrics.prom')
+            write_exposition(filename)
+            with open(filename) as f:
+                self.assertIn('rows_processed_total{stage="profits"} 7.0\n', f.read())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+from sqlite3 import connect, Connection
+from typing import List, Optional, Tuple
+from unittest import TestCase, main
+
+from polars import DataFrame
+
+from backend.scripts.price_history import DAY, HOUR
+from backend.scripts.profit_history import add_profit_history, query_profit_history
+
+START: int = 1_800_000_000 // DAY * DAY
+
+
+def profit_rows(profits: List[int]) -> DataFrame:
+    return DataFrame({'recipe_id': list(range(len(profits))), 'profit': profits, 'current_price': [100] * len(profits)})
+
+
+class CompactProfitHistoryTest(TestCase):
+    def setUp(self) -> None:
+        self.db_connection: Connection = connect(':memory:')
+
+    def tearDown(self) -> None:
+        self.db_connection.close()
+
+    def history(self, recipe_id: int) -> List[Tuple[int, Optional[int], Optional[int]]]:
+        return query_profit_history(self.db_connection, recipe_id, START, START + 10 * DAY).rows()
+
+    def test_delta_after_a_range_without_changes(self) -> None:
+        # Recipe 0 has no change in the range compacted by the third run, so its change at START + 3 days stays a
+        # delta, which the fourth run compacts
+        cursor = self.db_connection.cursor()
+        add_profit_history(cursor, profit_rows([10, 20]), now=START)
+        add_profit_history(cursor, profit_rows([10, 21]), now=START + DAY * 5 // 2)
+        add_profit_history(cursor, profit_rows([11, 22]), now=START + 3 * DAY)
+        add_profit_history(cursor, profit_rows([11, 22]), now=START + 5 * DAY + 2 * HOUR)
+        add_profit_history(cursor, profit_rows([12, 22]), now=START + 8 * DAY)
+
+        self.assertEqual(self.history(0), [(START, 10, 100), (START + 3 * DAY, 11, 100),
+                                           (START + 8 * DAY, 12, 100)])
+        self.assertEqual(self.history(1), [(START, 20, 100), (START + DAY * 5 // 2, 21, 100),
+                                           (START + 3 * DAY, 22, 100)])
+
+
+if __name__ == '__main__':
+    main()
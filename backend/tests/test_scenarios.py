@@ -0,0 +1,36 @@
+from os import path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+
+from backend.scripts.scenarios import BUY_ORDER, Scenario, read_scenarios
+
+
+class ReadScenariosTest(TestCase):
+    def setUp(self) -> None:
+        self.directory: TemporaryDirectory = TemporaryDirectory()
+        self.filename: str = path.join(self.directory.name, 'scenarios.json')
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def write(self, content: str) -> None:
+        with open(self.filename, 'w') as f:
+            f.write(content)
+
+    def test_reads_the_scenarios(self) -> None:
+        self.write('[{"scenario_id": "orders", "pricing": "buy_order", "tax_rate": 0.0125}]')
+        self.assertEqual(read_scenarios(self.filename),
+                         [Scenario(scenario_id='orders', pricing=BUY_ORDER, tax_rate=0.0125)])
+
+    def test_missing_or_malformed_files_are_errors(self) -> None:
+        with self.assertRaisesRegex(ValueError, 'Could not read'):
+            read_scenarios(self.filename)
+
+        for content in ('[{"scenario_id": ', '{"scenario_id": "base"}', '[{"scenario": "base"}]'):
+            self.write(content)
+            with self.assertRaises(ValueError):
+                read_scenarios(self.filename)
+
+
+if __name__ == '__main__':
+    main()
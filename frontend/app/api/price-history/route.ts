@@ -20,16 +20,17 @@ export async function GET(request: Request) {
       path.join(process.cwd(), "data", "shard_recipes.db")
     );
 
-    // Get price history and average price for last 24 hours
+    // Get the hourly price history of the last 7 days (raw points are only kept for 2 days)
     const priceHistory = db
       .prepare(
         `
-        SELECT a.buy_price, a.timestamp
-        FROM product_price_history as a
+        SELECT a.buy_price, strftime('%Y-%m-%dT%H:%M:%S', a.bucket, 'unixepoch') as timestamp
+        FROM price_history_points as a
         JOIN shard_to_productid as b ON a.product_id = b.productID
         WHERE b.name = ?
-        AND timestamp >= datetime('now', '-7 days')
-        ORDER BY timestamp ASC
+        AND a.resolution = 3600
+        AND a.bucket >= CAST(strftime('%s', 'now', '-7 days') AS INTEGER)
+        ORDER BY a.bucket ASC
       `
       )
       .all(productName);
@@ -39,10 +40,11 @@ export async function GET(request: Request) {
       .prepare(
         `
         SELECT AVG(a.buy_price) as avg_price
-        FROM product_price_history as a
+        FROM price_history_points as a
         JOIN shard_to_productid as b ON a.product_id = b.productID
         WHERE b.name = ?
-        AND timestamp >= datetime('now', '-1 day')
+        AND a.resolution = 0
+        AND a.bucket >= CAST(strftime('%s', 'now', '-1 day') AS INTEGER)
       `
       )
       .get(productName) as { avg_price: number } | undefined;